@@ -1,12 +1,27 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, send_file
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, send_file, Response
 import sqlite3
-from datetime import datetime, time, timedelta
+from datetime import datetime, time, timedelta, timezone
 import os
+import sys
 import csv
 import zipfile
 import io
+import json
 import traceback
+import threading
+import time as time_module
+import heapq
+import hmac
+import hashlib
+import queue
+import secrets
+import socket
+import socketserver
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
 from functools import wraps
+from itertools import islice
 
 # Дополнительные импорты
 try:
@@ -14,6 +29,17 @@ try:
     HAS_FPDF = True
 except ImportError:
     HAS_FPDF = False
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+try:
+    from flask_sock import Sock
+    from simple_websocket import ConnectionClosed
+    HAS_SOCK = True
+except ImportError:
+    HAS_SOCK = False
 try:
     import pandas as pd
     HAS_PANDAS = True
@@ -22,8 +48,60 @@ except ImportError:
     HAS_PANDAS = False
     print("⚠️ Pandas не установлен. Экспорт в Excel будет недоступен.")
     print(" Установите: pip install pandas openpyxl")
+# DELETE ... RETURNING доступен начиная с SQLite 3.35
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Секреты не хранятся в репозитории: значение берётся из переменной окружения, иначе из файла
+# в ASKUD_KEY_DIR (по умолчанию ~/.askud), который создаётся со случайным ключом при первом запуске
+# и затем читается всеми процессами
+KEY_DIR = os.environ.get('ASKUD_KEY_DIR', os.path.join(os.path.expanduser('~'), '.askud'))
+
+
+def load_secret_key(env_name, filename):
+    """Секрет из переменной окружения или из файла ключа (создаётся один раз)"""
+    value = os.environ.get(env_name)
+    if value:
+        return value.encode('utf-8')
+
+    path = os.path.join(KEY_DIR, filename)
+    if not os.path.exists(path):
+        os.makedirs(KEY_DIR, mode=0o700, exist_ok=True)
+        # Ключ пишется во временный файл и появляется под своим именем атомарно (os.link),
+        # поэтому одновременно стартующие воркеры получат один и тот же ключ
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as key_file:
+            key_file.write(secrets.token_hex(32))
+        try:
+            os.link(temp_path, path)
+            print(f"🔑 Создан ключ {path}")
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(temp_path)
+
+    with open(path, 'rb') as key_file:
+        key = key_file.read().strip()
+    if not key:
+        raise RuntimeError(f'Пустой файл ключа {path}')
+    return key
+
+
 app = Flask(__name__)
-app.secret_key = 'askud_secret_key_2025'
+app.secret_key = load_secret_key('ASKUD_SECRET_KEY', 'session.key')
+sock = Sock(app) if HAS_SOCK else None
+
+# PIN-коды хранятся только как HMAC-SHA256 с секретом сервера (employees.pin_digest).
+# Смена ключа делает все сохранённые PIN-коды недействительными.
+PIN_HMAC_KEY = load_secret_key('ASKUD_PIN_KEY', 'pin.key')
+PIN_KEY_CHECK = hmac.new(PIN_HMAC_KEY, b'askud-pin-key-check', hashlib.sha256).hexdigest()
+
+# Автономные терминалы сверяют PIN-коды по HMAC с отдельным ключом (employees.terminal_digest),
+# чтобы ни снимок допуска, ни ключ на терминале не раскрывали серверный pin_digest
+TERMINAL_PIN_KEY = load_secret_key('ASKUD_TERMINAL_PIN_KEY', 'terminal_pin.key')
+
+# Поля сотрудника, которые не отдаются ни в API, ни в шаблоны
+EMPLOYEE_SECRET_COLUMNS = ('password', 'pin_digest', 'terminal_digest')
 
 # Конфигурация системы
 MIN_PIN_LENGTH = 4
@@ -74,6 +152,9 @@ def init_database():
                 if not cursor.fetchone():
                     print(f"⚠️  Таблица {table} отсутствует! Возможно, база повреждена.")
 
+            upgrade_schema(cursor)
+            check_pin_key(cursor)
+            conn.commit()
             conn.close()
             return
 
@@ -87,7 +168,8 @@ def init_database():
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 login TEXT UNIQUE NOT NULL,
                 password TEXT NOT NULL,
-                pin_code TEXT UNIQUE NOT NULL,
+                pin_digest TEXT NOT NULL,
+                terminal_digest TEXT,
                 full_name TEXT NOT NULL,
                 department TEXT,
                 position TEXT,
@@ -188,8 +270,8 @@ def init_database():
 
         # Добавляем администратора по умолчанию
         cursor.execute(
-            "INSERT INTO employees (login, password, pin_code, full_name, department, position, user_type, is_active) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            ("admin", "admin123", "0000", "Администратор Системы", "ИТ-отдел",
+            "INSERT INTO employees (login, password, pin_digest, terminal_digest, full_name, department, position, user_type, is_active) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ("admin", "admin123", pin_digest("0000"), terminal_pin_digest("0000"), "Администратор Системы", "ИТ-отдел",
              "Системный администратор", "admin", True)
         )
 
@@ -206,8 +288,9 @@ def init_database():
         ]
 
         cursor.executemany(
-            "INSERT INTO employees (login, password, pin_code, full_name, department, position, user_type, is_active) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            employees
+            "INSERT INTO employees (login, password, pin_digest, terminal_digest, full_name, department, position, user_type, is_active) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [employee[:2] + (pin_digest(employee[2]), terminal_pin_digest(employee[2])) + employee[3:]
+             for employee in employees]
         )
 
         # Назначаем права доступа
@@ -223,6 +306,9 @@ def init_database():
             access_schedules
         )
 
+        upgrade_schema(cursor)
+        set_engine_state(cursor, 'pin_key_check', PIN_KEY_CHECK)
+
         conn.commit()
         print("✅ База данных инициализирована с расширенной структурой")
 
@@ -235,6 +321,347 @@ def init_database():
             conn.close()
 
 
+def upgrade_schema(cursor):
+    """Создание индексов и служебных таблиц, отсутствующих в исходной схеме"""
+    # Диапазонные выборки событий по времени (статистика, отчёты)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_access_events_time ON access_events(event_time)")
+
+    # До создания триггеров: миграция пересоздаёт таблицу employees
+    pins_migrated = migrate_pin_digests(cursor)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_employees_pin_digest ON employees(pin_digest)")
+
+    # Базы, переведённые на pin_digest раньше: открытых PIN-кодов уже нет, поэтому такие
+    # сотрудники попадут в снимки терминалов после следующей смены PIN-кода
+    cursor.execute("PRAGMA table_info(employees)")
+    if 'terminal_digest' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE employees ADD COLUMN terminal_digest TEXT")
+
+    init_counters(cursor)
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS engine_state (
+            name TEXT PRIMARY KEY,
+            value
+        )
+    ''')
+    if pins_migrated:
+        set_engine_state(cursor, 'pin_key_check', PIN_KEY_CHECK)
+
+    init_schedule_engine(cursor)
+
+    # Визиты и табель досчитываются по событиям, накопившимся с прошлого запуска
+    init_visits(cursor)
+    init_timesheets(cursor)
+    init_occupancy(cursor)
+    init_presence_checkpoints(cursor)
+    init_overstays(cursor)
+    init_terminal_sync(cursor)
+    init_terminals(cursor)
+    init_invalidations(cursor)
+
+    # Один раз: проверки доступа, сохранённые как входы, и построенные по ним визиты
+    if not get_engine_state(cursor, 'check_events_migrated'):
+        if migrate_check_events(cursor):
+            reconcile_counters(cursor)
+            rebuild_visits(cursor)
+            rebuild_timesheets(cursor)
+            cursor.execute("DELETE FROM presence_checkpoints")
+            cursor.execute("DELETE FROM occupancy_days")
+        set_engine_state(cursor, 'check_events_migrated', 1)
+
+    # Один раз: табель, разбитый по дням UTC, перестраивается по местным дням
+    if not get_engine_state(cursor, 'timesheets_local_days'):
+        rebuild_timesheets(cursor)
+        set_engine_state(cursor, 'timesheets_local_days', 1)
+
+    # Один раз: кэш заполненности по дням UTC сбрасывается и досчитывается по местным дням
+    if not get_engine_state(cursor, 'occupancy_local_days'):
+        cursor.execute("DELETE FROM occupancy_days")
+        set_engine_state(cursor, 'occupancy_local_days', 1)
+
+    # Один раз: триггеры событий, считавшие дни по UTC, пересоздаются, счётчики пересчитываются
+    if not get_engine_state(cursor, 'counters_local_days'):
+        for name in ('trg_counters_events_insert', 'trg_counters_events_delete'):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+            cursor.execute(f"CREATE TRIGGER {name} {COUNTER_TRIGGERS[name]}")
+        reconcile_counters(cursor)
+        set_engine_state(cursor, 'counters_local_days', 1)
+    sync_event_views(cursor)
+
+
+def check_pin_key(cursor):
+    """Предупреждение, если PIN-коды в базе созданы другим ключом"""
+    stored = get_engine_state(cursor, 'pin_key_check', None)
+    cursor.execute("SELECT COUNT(*) FROM employees")
+    has_employees = cursor.fetchone()[0] > 0
+
+    if stored is None and has_employees:
+        print("⚠️ Ключ PIN-кодов не был зафиксирован. Если PIN-коды создавались без ASKUD_PIN_KEY, "
+              "задайте прежний ключ в ASKUD_PIN_KEY или назначьте PIN-коды заново")
+    elif stored is not None and stored != PIN_KEY_CHECK:
+        print("⚠️ PIN-коды в базе созданы другим ключом: задайте прежний ASKUD_PIN_KEY "
+              "или назначьте PIN-коды заново")
+        return
+
+    set_engine_state(cursor, 'pin_key_check', PIN_KEY_CHECK)
+
+
+def employee_public_dict(row):
+    """Данные сотрудника без пароля и HMAC PIN-кода"""
+    employee = dict(row)
+    for column in EMPLOYEE_SECRET_COLUMNS:
+        employee.pop(column, None)
+    return employee
+
+
+def pin_digest(pin_code):
+    """HMAC-SHA256 PIN-кода с секретом сервера (hex)"""
+    return hmac.new(PIN_HMAC_KEY, str(pin_code).strip().encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def terminal_pin_digest(pin_code):
+    """HMAC-SHA256 PIN-кода с ключом автономных терминалов (hex)"""
+    return hmac.new(TERMINAL_PIN_KEY, str(pin_code).strip().encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def migrate_pin_digests(cursor):
+    """Замена открытых PIN-кодов (employees.pin_code) на pin_digest; True, если миграция выполнена.
+
+    Столбец pin_code объявлен UNIQUE NOT NULL и не удаляется через ALTER TABLE,
+    поэтому таблица пересоздаётся с сохранением id. Триггеры, ссылающиеся
+    на employees, удаляются и создаются заново дальше в upgrade_schema.
+    """
+    cursor.execute("PRAGMA table_info(employees)")
+    if 'pin_code' not in [column[1] for column in cursor.fetchall()]:
+        return False
+
+    print("🔄 Перевод PIN-кодов на хранение в виде HMAC...")
+    for name in list(COUNTER_TRIGGERS) + list(SCHEDULE_TRIGGERS):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+    cursor.execute('''
+        CREATE TABLE employees_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            login TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            pin_digest TEXT NOT NULL,
+            terminal_digest TEXT,
+            full_name TEXT NOT NULL,
+            department TEXT,
+            position TEXT,
+            phone TEXT,
+            email TEXT,
+            is_active BOOLEAN DEFAULT TRUE,
+            user_type TEXT DEFAULT 'employee',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute("SELECT * FROM employees")
+    rows = [dict(zip([column[0] for column in cursor.description], row)) for row in cursor.fetchall()]
+    cursor.executemany('''
+        INSERT INTO employees_new (id, login, password, pin_digest, terminal_digest, full_name, department,
+                                   position, phone, email, is_active, user_type, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (row['id'], row['login'], row['password'], pin_digest(row['pin_code']),
+         terminal_pin_digest(row['pin_code']), row['full_name'],
+         row.get('department'), row.get('position'), row.get('phone'), row.get('email'),
+         row.get('is_active', True), row.get('user_type', 'employee'), row.get('created_at'))
+        for row in rows
+    ])
+
+    cursor.execute("DROP TABLE employees")
+    cursor.execute("ALTER TABLE employees_new RENAME TO employees")
+    print(f"✅ PIN-коды переведены на HMAC: {len(rows)} сотрудников")
+    return True
+
+
+# Триггеры, поддерживающие таблицы счётчиков в актуальном состоянии. Время событий хранится
+# в UTC, а дни daily_event_counters - местные (как «сегодня» в get_statistics)
+COUNTER_TRIGGERS = {
+    'trg_counters_employees_insert': '''
+        AFTER INSERT ON employees BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = 'employees_total';
+            UPDATE counters SET value = value + 1 WHERE name = 'employees_active' AND NEW.is_active;
+        END
+    ''',
+    'trg_counters_employees_delete': '''
+        AFTER DELETE ON employees BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = 'employees_total';
+            UPDATE counters SET value = value - 1 WHERE name = 'employees_active' AND OLD.is_active;
+        END
+    ''',
+    'trg_counters_employees_active': '''
+        AFTER UPDATE OF is_active ON employees BEGIN
+            UPDATE counters
+            SET value = value + (CASE WHEN NEW.is_active THEN 1 ELSE 0 END) - (CASE WHEN OLD.is_active THEN 1 ELSE 0 END)
+            WHERE name = 'employees_active';
+        END
+    ''',
+    'trg_counters_laboratories_insert': '''
+        AFTER INSERT ON laboratories BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = 'laboratories_total';
+            UPDATE counters SET value = value + 1 WHERE name = 'laboratories_active' AND NEW.is_active;
+        END
+    ''',
+    'trg_counters_laboratories_delete': '''
+        AFTER DELETE ON laboratories BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = 'laboratories_total';
+            UPDATE counters SET value = value - 1 WHERE name = 'laboratories_active' AND OLD.is_active;
+        END
+    ''',
+    'trg_counters_laboratories_active': '''
+        AFTER UPDATE OF is_active ON laboratories BEGIN
+            UPDATE counters
+            SET value = value + (CASE WHEN NEW.is_active THEN 1 ELSE 0 END) - (CASE WHEN OLD.is_active THEN 1 ELSE 0 END)
+            WHERE name = 'laboratories_active';
+        END
+    ''',
+    'trg_counters_schedules_insert': '''
+        AFTER INSERT ON access_schedules BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = 'access_schedules_total';
+        END
+    ''',
+    'trg_counters_schedules_delete': '''
+        AFTER DELETE ON access_schedules BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = 'access_schedules_total';
+        END
+    ''',
+    'trg_counters_presence_insert': '''
+        AFTER INSERT ON current_presence BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = 'current_presence_total';
+        END
+    ''',
+    'trg_counters_presence_delete': '''
+        AFTER DELETE ON current_presence BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = 'current_presence_total';
+        END
+    ''',
+    'trg_counters_events_insert': '''
+        AFTER INSERT ON access_events BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = 'access_events_total';
+            INSERT INTO daily_event_counters (day, events, entries, exits, denials)
+            VALUES (
+                DATE(NEW.event_time, 'localtime'), 1,
+                CASE WHEN NEW.event_type = 'entry' AND NEW.success THEN 1 ELSE 0 END,
+                CASE WHEN NEW.event_type = 'exit' AND NEW.success THEN 1 ELSE 0 END,
+                CASE WHEN NEW.success THEN 0 ELSE 1 END
+            )
+            ON CONFLICT(day) DO UPDATE SET
+                events = events + 1,
+                entries = entries + excluded.entries,
+                exits = exits + excluded.exits,
+                denials = denials + excluded.denials;
+        END
+    ''',
+    'trg_counters_events_delete': '''
+        AFTER DELETE ON access_events BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = 'access_events_total';
+            UPDATE daily_event_counters SET
+                events = events - 1,
+                entries = entries - (CASE WHEN OLD.event_type = 'entry' AND OLD.success THEN 1 ELSE 0 END),
+                exits = exits - (CASE WHEN OLD.event_type = 'exit' AND OLD.success THEN 1 ELSE 0 END),
+                denials = denials - (CASE WHEN OLD.success THEN 0 ELSE 1 END)
+            WHERE day = DATE(OLD.event_time, 'localtime');
+        END
+    '''
+}
+
+COUNTER_NAMES = [
+    'employees_total', 'employees_active', 'laboratories_total', 'laboratories_active',
+    'access_schedules_total', 'current_presence_total', 'access_events_total'
+]
+
+
+def init_counters(cursor):
+    """Создание таблиц счётчиков и триггеров, которые их поддерживают"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_event_counters (
+            day DATE PRIMARY KEY,
+            events INTEGER NOT NULL DEFAULT 0,
+            entries INTEGER NOT NULL DEFAULT 0,
+            exits INTEGER NOT NULL DEFAULT 0,
+            denials INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    for name, body in COUNTER_TRIGGERS.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+    # Первичное заполнение для базы, созданной до появления счётчиков
+    cursor.execute("SELECT COUNT(*) FROM counters")
+    if cursor.fetchone()[0] < len(COUNTER_NAMES):
+        reconcile_counters(cursor)
+
+
+def reconcile_counters(cursor):
+    """Полный пересчёт счётчиков по исходным таблицам"""
+    counter_queries = {
+        'employees_total': "SELECT COUNT(*) FROM employees",
+        'employees_active': "SELECT COUNT(*) FROM employees WHERE is_active = TRUE",
+        'laboratories_total': "SELECT COUNT(*) FROM laboratories",
+        'laboratories_active': "SELECT COUNT(*) FROM laboratories WHERE is_active = TRUE",
+        'access_schedules_total': "SELECT COUNT(*) FROM access_schedules",
+        'current_presence_total': "SELECT COUNT(*) FROM current_presence",
+        'access_events_total': "SELECT COUNT(*) FROM access_events"
+    }
+
+    counters = {}
+    for name in COUNTER_NAMES:
+        cursor.execute(counter_queries[name])
+        counters[name] = cursor.fetchone()[0]
+        cursor.execute('''
+            INSERT INTO counters (name, value) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET value = excluded.value
+        ''', (name, counters[name]))
+
+    cursor.execute("DELETE FROM daily_event_counters")
+    cursor.execute('''
+        INSERT INTO daily_event_counters (day, events, entries, exits, denials)
+        SELECT
+            DATE(event_time, 'localtime'),
+            COUNT(*),
+            SUM(CASE WHEN event_type = 'entry' AND success = TRUE THEN 1 ELSE 0 END),
+            SUM(CASE WHEN event_type = 'exit' AND success = TRUE THEN 1 ELSE 0 END),
+            SUM(CASE WHEN success = FALSE THEN 1 ELSE 0 END)
+        FROM access_events
+        GROUP BY DATE(event_time, 'localtime')
+    ''')
+
+    return counters
+
+
+def read_counters(cursor):
+    """Чтение всех счётчиков одной выборкой"""
+    cursor.execute("SELECT name, value FROM counters")
+    counters = {name: 0 for name in COUNTER_NAMES}
+    counters.update({row[0]: row[1] for row in cursor.fetchall()})
+    return counters
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Пересчитать таблицы счётчиков с нуля"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    init_counters(cursor)
+    counters = reconcile_counters(cursor)
+    conn.commit()
+    conn.close()
+
+    for name, value in counters.items():
+        print(f"  {name}: {value}")
+    print("✅ Счётчики пересчитаны")
+
+
 # Добавьте этот фильтр для Jinja2
 @app.template_filter('split')
 def split_filter(s, delimiter=','):
@@ -273,1114 +700,5376 @@ def get_db_connection():
     return conn
 
 
-def validate_credentials(login, password):
-    """Проверка логина и пароля"""
-    conn = get_db_connection()
+# Один процесс записи для развёртываний с несколькими воркерами (gunicorn, waitress).
+# Проходы, загрузка автономных событий и превышения времени пишут в access_events и
+# current_presence через команды записи. Если задан ASKUD_WRITER_SOCKET, воркер отправляет
+# команду процессу записи (python app.py --writer) по UNIX-сокету и ждёт ответа; процесс записи
+# собирает команды, пришедшие почти одновременно, и выполняет их пачкой в одной транзакции -
+# каждую под своей точкой сохранения, а сопоставление визитов и табеля один раз на пачку.
+# Без переменной команда выполняется в процессе воркера, как раньше. Чтение остаётся в воркерах.
+#
+# Изменения администратора (сотрудники, лаборатории, правила и шаблоны расписаний, исключения,
+# терминалы, отчёты, импорт из CSV) - тоже команды записи: проверки и чтение выполняет воркер,
+# а запись и запись о сбросе кэшей - процесс записи. Импорт отправляется частями по
+# WRITER_IMPORT_CHUNK_ROWS строк, чтобы проходы не ждали загрузки всего файла. В воркерах
+# остаётся только кэш загрузки по дням (occupancy_days): его однократно дописывает запрос статистики.
+WRITER_SOCKET = os.environ.get('ASKUD_WRITER_SOCKET')
+WRITER_BATCH_SIZE = 200
+WRITER_BATCH_WINDOW_SECONDS = 0.005
+WRITER_TIMEOUT_SECONDS = 30
+WRITER_IMPORT_CHUNK_ROWS = 500
+
+WRITE_COMMANDS = {}  # имя -> {'handler': функция(cursor, **args), 'sync': нужно ли sync_event_views}
+
+
+def write_command(name, sync=False):
+    """Регистрация команды записи; обработчик получает курсор открытой транзакции"""
+    def decorator(handler):
+        WRITE_COMMANDS[name] = {'handler': handler, 'sync': sync}
+        return handler
+    return decorator
+
+
+def run_write_batch(conn, commands):
+    """Выполнение команд [(имя, аргументы)] одной транзакцией; возвращает [(успех, результат или ошибка)]"""
     cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+
+    results = []
+    needs_sync = False
+    for name, args in commands:
+        cursor.execute("SAVEPOINT write_command")
+        try:
+            command = WRITE_COMMANDS.get(name)
+            if command is None:
+                raise ValueError(f'Неизвестная команда записи: {name}')
+            result = command['handler'](cursor, **args)
+            cursor.execute("RELEASE write_command")
+            needs_sync = needs_sync or command['sync']
+            results.append((True, result))
+        except Exception as e:
+            # Ошибка одной команды откатывает только её
+            cursor.execute("ROLLBACK TO write_command")
+            cursor.execute("RELEASE write_command")
+            results.append((False, str(e)))
+
+    # Визиты и табель сопоставляются по новым событиям в той же транзакции
+    if needs_sync:
+        sync_event_views(cursor)
 
+    conn.commit()
+    return results
+
+
+def submit_write(command, **args):
+    """Выполнение команды записи (в процессе записи, если он настроен); ошибка - RuntimeError"""
+    if WRITER_SOCKET:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(WRITER_TIMEOUT_SECONDS)
+            client.connect(WRITER_SOCKET)
+            client.sendall(json.dumps({'command': command, 'args': args}, ensure_ascii=False).encode('utf-8') + b'\n')
+            reply = json.loads(client.makefile('rb').readline() or b'{}')
+        ok, result = reply.get('ok', False), reply.get('result', 'Процесс записи не ответил')
+    else:
+        conn = get_db_connection()
+        try:
+            [(ok, result)] = run_write_batch(conn, [(command, args)])
+        finally:
+            conn.close()
+
+    if not ok:
+        raise RuntimeError(result)
+    return result
+
+
+def update_row(cursor, table, columns, row_id, fields):
+    """UPDATE столбцов fields строки row_id; столбцы вне columns - ValueError. Возвращает rowcount"""
+    unknown = set(fields) - set(columns)
+    if not fields or unknown:
+        raise ValueError(f'Недопустимые поля для {table}: {", ".join(sorted(unknown)) or "нет полей"}')
     cursor.execute(
-        "SELECT id, full_name, user_type FROM employees WHERE login = ? AND password = ? AND is_active = TRUE",
-        (login, password)
+        f"UPDATE {table} SET {', '.join(f'{column} = ?' for column in fields)} WHERE id = ?",
+        [*fields.values(), row_id]
     )
+    return cursor.rowcount
+
+
+class WriterRequestHandler(socketserver.StreamRequestHandler):
+    """Соединение воркера с процессом записи: одна команда JSON в строке, ответ - тоже строкой"""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+                item = {
+                    'command': (str(message['command']), dict(message.get('args') or {})),
+                    'done': threading.Event()
+                }
+            except (ValueError, TypeError, KeyError, AttributeError):
+                reply = {'ok': False, 'result': 'Неверный формат команды'}
+            else:
+                self.server.commands.put(item)
+                item['done'].wait()
+                reply = {'ok': item['ok'], 'result': item['result']}
+            self.wfile.write(json.dumps(reply, ensure_ascii=False, default=str).encode('utf-8') + b'\n')
 
-    user = cursor.fetchone()
-    conn.close()
 
-    return dict(user) if user else None
+def run_writer_loop(commands):
+    """Поток записи: забирает команды из очереди и выполняет их пачками"""
+    conn = sqlite3.connect('access_system.db', timeout=WRITER_TIMEOUT_SECONDS)
+    conn.row_factory = sqlite3.Row
+    while True:
+        batch = [commands.get()]
+        deadline = time_module.monotonic() + WRITER_BATCH_WINDOW_SECONDS
+        while len(batch) < WRITER_BATCH_SIZE:
+            remaining = deadline - time_module.monotonic()
+            try:
+                batch.append(commands.get(timeout=remaining) if remaining > 0 else commands.get_nowait())
+            except queue.Empty:
+                break
 
+        try:
+            results = run_write_batch(conn, [item['command'] for item in batch])
+        except Exception as e:
+            conn.rollback()
+            results = [(False, str(e))] * len(batch)
 
-def verify_access(employee_id, laboratory_id, method='pin'):
-    """Проверка доступа сотрудника в лабораторию"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+        for item, (ok, result) in zip(batch, results):
+            item.update(ok=ok, result=result)
+            item['done'].set()
 
-    # Получаем текущее время и день недели
-    now = datetime.now()
-    current_time = now.time()
-    day_of_week = now.weekday()  # 0 = понедельник
 
-    # Проверяем расписание доступа
-    cursor.execute('''
-        SELECT time_start, time_end, days_of_week 
-        FROM access_schedules 
-        WHERE employee_id = ? AND laboratory_id = ?
-    ''', (employee_id, laboratory_id))
+def run_writer(path):
+    """Процесс записи: принимает команды воркеров на UNIX-сокете path"""
+    if os.path.exists(path):
+        os.unlink(path)
 
-    schedule = cursor.fetchone()
+    server = socketserver.ThreadingUnixStreamServer(path, WriterRequestHandler)
+    server.daemon_threads = True
+    server.commands = queue.Queue()
+    os.chmod(path, 0o600)
 
-    if not schedule:
-        # Логируем отказ в доступе
-        cursor.execute(
-            "INSERT INTO access_events (employee_id, laboratory_id, event_type, success, reason, method) VALUES (?, ?, 'entry', FALSE, 'Нет расписания доступа', ?)",
-            (employee_id, laboratory_id, method)
-        )
-        conn.commit()
-        conn.close()
-        return False, "Доступ в эту лабораторию не разрешён"
-
-    # Проверяем, разрешен ли доступ в текущий день недели
-    days_allowed = schedule['days_of_week']
-    if days_allowed:
-        # Преобразуем строку дней в список
-        allowed_days = [int(d) for d in days_allowed.split(',') if d.isdigit()]
-        if day_of_week not in allowed_days:
-            cursor.execute(
-                "INSERT INTO access_events (employee_id, laboratory_id, event_type, success, reason, method) VALUES (?, ?, 'entry', FALSE, 'День недели не разрешен', ?)",
-                (employee_id, laboratory_id, method)
-            )
-            conn.commit()
-            conn.close()
-            return False, f"Доступ в этот день недели не разрешен"
+    threading.Thread(target=run_writer_loop, args=(server.commands,), daemon=True).start()
+    print(f"✍️ Процесс записи слушает {path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
 
-    time_start = time.fromisoformat(schedule['time_start'])
-    time_end = time.fromisoformat(schedule['time_end'])
 
-    # Проверяем временной интервал
-    if not (time_start <= current_time <= time_end):
-        cursor.execute(
-            "INSERT INTO access_events (employee_id, laboratory_id, event_type, success, reason, method) VALUES (?, ?, 'entry', FALSE, 'Вне времени доступа', ?)",
-            (employee_id, laboratory_id, method)
-        )
-        conn.commit()
-        conn.close()
-        return False, f"Доступ разрешён с {time_start.strftime('%H:%M')} до {time_end.strftime('%H:%M')}"
+# Шина сброса кэшей между процессами. Реестр присутствия, справочник лабораторий, реестр
+# терминалов и предзагруженный допуск живут в памяти каждого воркера, а изменения приходят
+# только в один из них. Изменивший процесс пишет в cache_invalidations запись (область и ключ:
+# 'presence'/'employees' - id сотрудника, 'laboratories', 'terminals', 'schedules' - без ключа).
+# Поток каждого воркера раз в INVALIDATION_POLL_SECONDS сверяет PRAGMA data_version (меняется,
+# когда базу зафиксировало другое соединение) и только тогда читает новые записи.
+# Расписания кэшируются по версии schedules_version и шины не требуют.
+INVALIDATION_POLL_SECONDS = 0.2
+INVALIDATION_PRUNE_EVERY = 1000
+INVALIDATION_RETENTION_ROWS = 10000
 
-    # Проверяем, находится ли сотрудник уже внутри
-    cursor.execute("SELECT id FROM current_presence WHERE employee_id = ?", (employee_id,))
-    current_presence = cursor.fetchone()
+invalidation_listener = {'thread': None, 'last_id': 0}
 
-    event_type = 'exit' if current_presence else 'entry'
-    success = True
-    message = "Выход выполнен" if current_presence else "Вход разрешён"
 
-    if current_presence:
-        # Выход из лаборатории
-        cursor.execute("DELETE FROM current_presence WHERE employee_id = ?", (employee_id,))
-    else:
-        # Вход в лабораторию
-        expected_exit = datetime.combine(now.date(), time_end)
-        cursor.execute(
-            "INSERT INTO current_presence (employee_id, laboratory_id, expected_exit_time) VALUES (?, ?, ?)",
-            (employee_id, laboratory_id, expected_exit)
+def init_invalidations(cursor):
+    """Таблица записей о сбросе кэшей"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cache_invalidations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scope TEXT NOT NULL,
+            key INTEGER,
+            origin INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
+    ''')
 
-    # Логируем событие
+
+def publish_invalidation(cursor, scope, key=None):
+    """Запись о сбросе кэша в открытой транзакции (видна другим процессам после фиксации)"""
     cursor.execute(
-        "INSERT INTO access_events (employee_id, laboratory_id, event_type, success, method) VALUES (?, ?, ?, ?, ?)",
-        (employee_id, laboratory_id, event_type, success, method)
+        "INSERT INTO cache_invalidations (scope, key, origin) VALUES (?, ?, ?)",
+        (scope, key, os.getpid())
     )
-
-    conn.commit()
-    conn.close()
-    return True, message
+    # Изредка удаляем старые записи: воркеры читают только хвост журнала
+    if cursor.lastrowid % INVALIDATION_PRUNE_EVERY == 0:
+        cursor.execute(
+            "DELETE FROM cache_invalidations WHERE id <= ?",
+            (cursor.lastrowid - INVALIDATION_RETENTION_ROWS,)
+        )
 
 
-def get_statistics():
-    """Получение статистики для дашборда"""
+def refresh_presence_entries(cursor, employee_ids):
+    """Перечитывание присутствия сотрудников из базы в реестр этого процесса"""
+    cursor.execute(f'''
+        SELECT cp.employee_id, cp.laboratory_id, cp.entry_time, cp.expected_exit_time,
+               e.full_name, e.department, e.position
+        FROM current_presence cp
+        JOIN employees e ON cp.employee_id = e.id
+        WHERE cp.employee_id IN ({','.join('?' * len(employee_ids))})
+    ''', list(employee_ids))
+    records = {row['employee_id']: presence_record(row) for row in cursor.fetchall()}
+
+    for employee_id in employee_ids:
+        with presence_lock:
+            current = presence_registry['employees'].get(employee_id)
+        record = records.get(employee_id)
+        if record and record != current:
+            registry_enter(record)
+        elif not record and current:
+            registry_exit(employee_id)
+
+
+def apply_invalidations(cursor, rows):
+    """Сброс кэшей этого процесса по записям других процессов"""
+    scopes = {}
+    for row in rows:
+        if row['origin'] != os.getpid():
+            scopes.setdefault(row['scope'], set()).add(row['key'])
+
+    if 'laboratories' in scopes:
+        invalidate_laboratory_directory()
+    if 'terminals' in scopes:
+        terminal_registry['loaded'] = False
+    if 'employees' in scopes or 'schedules' in scopes:
+        invalidate_terminal_prefetch()
+    if 'employees' in scopes:
+        clear_rejected_pins()
+    if presence_registry['loaded']:
+        # Изменение сотрудника меняет и его данные в списке присутствующих
+        employee_ids = {key for key in scopes.get('presence', set()) | scopes.get('employees', set()) if key}
+        if employee_ids:
+            refresh_presence_entries(cursor, employee_ids)
+
+
+def run_invalidation_listener():
+    """Цикл фонового потока: новые записи о сбросе кэшей, как только базу изменил другой процесс"""
     conn = get_db_connection()
     cursor = conn.cursor()
+    data_version = None
+    while True:
+        time_module.sleep(INVALIDATION_POLL_SECONDS)
+        try:
+            cursor.execute("PRAGMA data_version")
+            current = cursor.fetchone()[0]
+            if current == data_version:
+                continue
+            data_version = current
 
-    # Количество сотрудников
-    cursor.execute("SELECT COUNT(*) FROM employees WHERE is_active = TRUE")
-    employees_count = cursor.fetchone()[0]
+            cursor.execute(
+                "SELECT id, scope, key, origin FROM cache_invalidations WHERE id > ? ORDER BY id",
+                (invalidation_listener['last_id'],)
+            )
+            rows = cursor.fetchall()
+            if rows:
+                invalidation_listener['last_id'] = rows[-1]['id']
+                apply_invalidations(cursor, rows)
+        except Exception as e:
+            print(f"Ошибка при сбросе кэшей: {e}")
+
+
+def start_invalidation_listener():
+    """Запуск потока шины один раз на процесс; записи до запуска не нужны - кэши грузятся заново"""
+    if invalidation_listener['thread'] is not None:
+        return
+    conn = get_db_connection()
+    try:
+        last_id = conn.execute("SELECT MAX(id) FROM cache_invalidations").fetchone()[0]
+    finally:
+        conn.close()
+    invalidation_listener['last_id'] = last_id or 0
+    thread = threading.Thread(target=run_invalidation_listener, daemon=True)
+    invalidation_listener['thread'] = thread
+    thread.start()
 
-    # Количество лабораторий
-    cursor.execute("SELECT COUNT(*) FROM laboratories WHERE is_active = TRUE")
-    labs_count = cursor.fetchone()[0]
 
-    # Сейчас в лабораториях
-    cursor.execute("SELECT COUNT(*) FROM current_presence")
-    active_count = cursor.fetchone()[0]
+def validate_credentials(login, password):
+    """Проверка логина и пароля"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
 
-    # Событий сегодня
-    today = datetime.now().strftime('%Y-%m-%d')
-    cursor.execute("""
-        SELECT COUNT(*) FROM access_events 
-        WHERE DATE(event_time) = DATE(?)
-    """, (today,))
-    today_events = cursor.fetchone()[0]
+    cursor.execute(
+        "SELECT id, full_name, user_type FROM employees WHERE login = ? AND password = ? AND is_active = TRUE",
+        (login, password)
+    )
 
+    user = cursor.fetchone()
     conn.close()
 
-    return {
-        'employees_count': employees_count,
-        'labs_count': labs_count,
-        'active_count': active_count,
-        'today_events': today_events
-    }
+    return dict(user) if user else None
 
 
-def migrate_old_data():
-    """Миграция старых данных из старого формата в новый"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def schedule_minute_sql(column):
+    """SQL-выражение: время 'ЧЧ:ММ[:СС]' из столбца в минуты от начала суток"""
+    return (f"CAST(substr({column}, 1, instr({column}, ':') - 1) AS INTEGER) * 60 + "
+            f"CAST(substr({column}, instr({column}, ':') + 1, 2) AS INTEGER)")
 
-    try:
-        # Проверяем, существует ли столбец day_of_week
-        cursor.execute("PRAGMA table_info(access_schedules)")
-        columns = [col[1] for col in cursor.fetchall()]
 
-        if 'day_of_week' in columns and 'days_of_week' not in columns:
-            print("🔄 Обнаружена старая структура данных, начинаю миграцию...")
+def schedule_mask_sql(column):
+    """SQL-выражение: строка дней '0,1,2' из столбца в битовую маску (бит 0 - понедельник)"""
+    days = f"(',' || replace({column}, ' ', '') || ',')"
+    bits = ' + '.join(f"(CASE WHEN instr({days}, ',{day},') > 0 THEN {1 << day} ELSE 0 END)" for day in range(7))
+    # Пустая строка дней означает доступ в любой день
+    return f"(CASE WHEN COALESCE({column}, '') = '' THEN 127 ELSE {bits} END)"
 
-            # Создаем временную таблицу для группировки данных
-            cursor.execute('''
-                SELECT employee_id, laboratory_id, 
-                       GROUP_CONCAT(day_of_week) as days_of_week,
-                       time_start, time_end
-                FROM access_schedules
-                GROUP BY employee_id, laboratory_id, time_start, time_end
-            ''')
 
-            grouped_data = cursor.fetchall()
+def schedule_compile_sql(table):
+    """UPDATE, пересчитывающий скомпилированные столбцы окна доступа в таблице"""
+    return f'''
+        UPDATE {table}
+        SET day_mask = {schedule_mask_sql('days_of_week')},
+            start_minute = {schedule_minute_sql('time_start')},
+            end_minute = {schedule_minute_sql('time_end')}
+    '''
 
-            # Создаем новую таблицу
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS access_schedules_new (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    employee_id INTEGER,
-                    laboratory_id INTEGER,
-                    days_of_week TEXT,
-                    time_start TIME,
-                    time_end TIME,
-                    FOREIGN KEY (employee_id) REFERENCES employees (id),
-                    FOREIGN KEY (laboratory_id) REFERENCES laboratories (id),
-                    UNIQUE(employee_id, laboratory_id)
-                )
-            ''')
 
-            # Вставляем новые данные
-            for row in grouped_data:
-                cursor.execute('''
-                    INSERT INTO access_schedules_new 
-                    (employee_id, laboratory_id, days_of_week, time_start, time_end)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (row[0], row[1], row[2], row[3], row[4]))
+SCHEDULE_VERSION_SQL = '''
+    INSERT INTO engine_state (name, value) VALUES ('schedules_version', 1)
+    ON CONFLICT(name) DO UPDATE SET value = value + 1;
+'''
 
-            # Удаляем старую таблицу и переименовываем новую
-            cursor.execute("DROP TABLE access_schedules")
-            cursor.execute("ALTER TABLE access_schedules_new RENAME TO access_schedules")
 
-            conn.commit()
-            print("✅ Миграция данных завершена успешно")
-        else:
-            print("✅ Структура данных уже обновлена")
+def template_scope_sql(template):
+    """SQL-условие: сотрудник e попадает под шаблон (отдел и/или должность)"""
+    return (f"(({template}.department IS NULL OR e.department = {template}.department) AND "
+            f"({template}.position IS NULL OR e.position = {template}.position))")
 
-    except Exception as e:
-        print(f"❌ Ошибка миграции данных: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
 
+EFFECTIVE_WINDOW_COLUMNS = 'employee_id, laboratory_id, template_id, day_mask, start_minute, end_minute'
 
-# Маршруты приложения
-@app.route('/')
-def index():
-    return render_template('index.html',
-                           MIN_PIN_LENGTH=MIN_PIN_LENGTH,
-                           MAX_PIN_LENGTH=MAX_PIN_LENGTH)
 
+def effective_refresh_sql(employee_filter):
+    """Пересчёт действующих окон для сотрудников e, отобранных условием"""
+    return f'''
+        DELETE FROM effective_windows WHERE employee_id IN (SELECT e.id FROM employees e WHERE {employee_filter});
+        INSERT INTO effective_windows ({EFFECTIVE_WINDOW_COLUMNS})
+        {effective_select_sql(employee_filter)};
+    '''
 
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    if request.method == 'POST':
-        login = request.form.get('username', '').strip()
-        password = request.form.get('password', '').strip()
 
-        user = validate_credentials(login, password)
+def effective_select_sql(employee_filter):
+    """Действующие окна сотрудников e, отобранных условием.
 
-        if user:
-            session['user_id'] = user['id']
-            session['user_name'] = user['full_name']
-            session['user_type'] = user['user_type']
+    Личное правило на лабораторию заменяет шаблоны для этой лаборатории.
+    """
+    return f'''
+        SELECT s.employee_id, s.laboratory_id, NULL, s.day_mask, s.start_minute, s.end_minute
+        FROM access_schedules s JOIN employees e ON e.id = s.employee_id
+        WHERE {employee_filter}
+        UNION ALL
+        SELECT s.employee_id, s.laboratory_id, NULL, w.day_mask, w.start_minute, w.end_minute
+        FROM access_schedule_windows w
+        JOIN access_schedules s ON s.id = w.schedule_id
+        JOIN employees e ON e.id = s.employee_id
+        WHERE {employee_filter}
+        UNION ALL
+        SELECT e.id, t.laboratory_id, t.id, w.day_mask, w.start_minute, w.end_minute
+        FROM employees e
+        JOIN schedule_templates t ON {template_scope_sql('t')}
+        JOIN schedule_template_windows w ON w.template_id = t.id
+        WHERE ({employee_filter})
+          AND NOT EXISTS (
+              SELECT 1 FROM access_schedules s
+              WHERE s.employee_id = e.id AND s.laboratory_id = t.laboratory_id
+          )
+    '''
 
-            if user['user_type'] == 'admin':
-                return redirect(url_for('admin_dashboard'))
-            else:
-                return redirect(url_for('employee_dashboard'))
-        else:
-            flash('Неверный логин или пароль', 'danger')
 
-    return render_template('login.html')
+def template_employees_sql(template_id):
+    """SQL-условие: сотрудник e попадает под шаблон с указанным id"""
+    return f"EXISTS (SELECT 1 FROM schedule_templates t WHERE t.id = {template_id} AND {template_scope_sql('t')})"
+
+
+# Триггеры компилируют окна при каждой записи, пересчитывают действующие окна только
+# затронутых сотрудников и меняют версию для кэша в памяти. Первое окно личного правила
+# хранится в самой строке access_schedules, дополнительные - в access_schedule_windows
+SCHEDULE_TRIGGERS = {
+    'trg_schedules_compile_insert': f'''
+        AFTER INSERT ON access_schedules BEGIN
+            {schedule_compile_sql('access_schedules')} WHERE id = NEW.id;
+            {effective_refresh_sql('e.id = NEW.employee_id')}
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_schedules_compile_update': f'''
+        AFTER UPDATE OF employee_id, laboratory_id, days_of_week, time_start, time_end ON access_schedules BEGIN
+            {schedule_compile_sql('access_schedules')} WHERE id = NEW.id;
+            {effective_refresh_sql('e.id IN (OLD.employee_id, NEW.employee_id)')}
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_schedules_delete': f'''
+        AFTER DELETE ON access_schedules BEGIN
+            DELETE FROM access_schedule_windows WHERE schedule_id = OLD.id;
+            {effective_refresh_sql('e.id = OLD.employee_id')}
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_schedule_windows_compile_insert': f'''
+        AFTER INSERT ON access_schedule_windows BEGIN
+            {schedule_compile_sql('access_schedule_windows')} WHERE id = NEW.id;
+            {effective_refresh_sql('e.id = (SELECT employee_id FROM access_schedules WHERE id = NEW.schedule_id)')}
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_schedule_windows_compile_update': f'''
+        AFTER UPDATE OF schedule_id, days_of_week, time_start, time_end ON access_schedule_windows BEGIN
+            {schedule_compile_sql('access_schedule_windows')} WHERE id = NEW.id;
+            {effective_refresh_sql('e.id IN (SELECT employee_id FROM access_schedules WHERE id IN (OLD.schedule_id, NEW.schedule_id))')}
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_schedule_windows_delete': f'''
+        AFTER DELETE ON access_schedule_windows BEGIN
+            {effective_refresh_sql('e.id = (SELECT employee_id FROM access_schedules WHERE id = OLD.schedule_id)')}
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_schedule_templates_insert': f'''
+        AFTER INSERT ON schedule_templates BEGIN
+            {effective_refresh_sql(template_scope_sql('NEW'))}
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_schedule_templates_update': f'''
+        AFTER UPDATE OF department, position, laboratory_id ON schedule_templates BEGIN
+            {effective_refresh_sql(template_scope_sql('OLD') + ' OR ' + template_scope_sql('NEW'))}
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_schedule_templates_delete': f'''
+        AFTER DELETE ON schedule_templates BEGIN
+            DELETE FROM schedule_template_windows WHERE template_id = OLD.id;
+            {effective_refresh_sql(template_scope_sql('OLD'))}
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_template_windows_compile_insert': f'''
+        AFTER INSERT ON schedule_template_windows BEGIN
+            {schedule_compile_sql('schedule_template_windows')} WHERE id = NEW.id;
+            {effective_refresh_sql(template_employees_sql('NEW.template_id'))}
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_template_windows_compile_update': f'''
+        AFTER UPDATE OF template_id, days_of_week, time_start, time_end ON schedule_template_windows BEGIN
+            {schedule_compile_sql('schedule_template_windows')} WHERE id = NEW.id;
+            {effective_refresh_sql(template_employees_sql('OLD.template_id') + ' OR ' + template_employees_sql('NEW.template_id'))}
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_template_windows_delete': f'''
+        AFTER DELETE ON schedule_template_windows BEGIN
+            {effective_refresh_sql(template_employees_sql('OLD.template_id'))}
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_access_exceptions_insert': f'''
+        AFTER INSERT ON access_exceptions BEGIN
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_access_exceptions_update': f'''
+        AFTER UPDATE ON access_exceptions BEGIN
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_access_exceptions_delete': f'''
+        AFTER DELETE ON access_exceptions BEGIN
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_effective_employees_insert': f'''
+        AFTER INSERT ON employees BEGIN
+            {effective_refresh_sql('e.id = NEW.id')}
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_effective_employees_scope': f'''
+        AFTER UPDATE OF department, position ON employees BEGIN
+            {effective_refresh_sql('e.id = NEW.id')}
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+    'trg_effective_employees_delete': f'''
+        AFTER DELETE ON employees BEGIN
+            DELETE FROM effective_windows WHERE employee_id = OLD.id;
+            {SCHEDULE_VERSION_SQL}
+        END
+    ''',
+}
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+HOURS_PER_WEEK = 7 * 24
+
+# Скомпилированные расписания: {(employee_id, laboratory_id): (starts, ends, covered_days, windows)}
+compiled_schedules = {'version': None, 'rules': {}}
+
+# Календарь исключений: дни предрасчёта вперёд и причина отказа при закрытии
+SCHEDULE_PRECOMPUTE_DAYS = 3
+EXCEPTION_CLOSED_REASON = 'Закрыто по календарю исключений'
+
+# Расписания по дням с учётом исключений: {'rules': правила, по которым построен кэш,
+# 'today': дата построения, 'days': {дата: {'exceptions': ..., 'pairs': {(employee_id, laboratory_id):
+# (starts, ends, closures, reason)}}}}, интервалы - минуты от начала суток
+daily_schedules = {'rules': None, 'today': None, 'days': {}}
+
+# Индекс допуска по лабораториям: {laboratory_id: (full, partial)}, где full и partial -
+# списки из 168 часовых корзин недели. Корзина - битовое множество сотрудников (бит = id),
+# full - допуск на весь час, partial - на часть часа (уточняется по расписанию)
+authorisation_index = {}
+
+
+def init_schedule_engine(cursor):
+    """Миграция расписаний на битовую маску дней, минуты от начала суток и несколько окон"""
+    cursor.execute("PRAGMA table_info(access_schedules)")
+    columns = [col[1] for col in cursor.fetchall()]
+
+    for column in ('day_mask', 'start_minute', 'end_minute'):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE access_schedules ADD COLUMN {column} INTEGER")
 
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS access_schedule_windows (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            schedule_id INTEGER NOT NULL,
+            days_of_week TEXT,
+            time_start TIME,
+            time_end TIME,
+            day_mask INTEGER,
+            start_minute INTEGER,
+            end_minute INTEGER,
+            FOREIGN KEY (schedule_id) REFERENCES access_schedules (id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_schedule_windows_schedule ON access_schedule_windows(schedule_id)")
 
-@app.route('/logout')
-def logout():
-    session.clear()
-    return redirect(url_for('index'))
+    # Шаблоны расписаний для отдела и/или должности
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schedule_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            department TEXT,
+            position TEXT,
+            laboratory_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (laboratory_id) REFERENCES laboratories (id)
+        )
+    ''')
 
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schedule_template_windows (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            template_id INTEGER NOT NULL,
+            days_of_week TEXT,
+            time_start TIME,
+            time_end TIME,
+            day_mask INTEGER,
+            start_minute INTEGER,
+            end_minute INTEGER,
+            FOREIGN KEY (template_id) REFERENCES schedule_templates (id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_template_windows_template ON schedule_template_windows(template_id)")
 
-@app.route('/terminal')
-def terminal():
-    return render_template('terminal.html',
-                           min_pin_length=MIN_PIN_LENGTH,
-                           max_pin_length=MAX_PIN_LENGTH)
+    # Действующие окна сотрудников: личные правила и шаблоны, которые они не переопределяют
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS effective_windows (
+            employee_id INTEGER NOT NULL,
+            laboratory_id INTEGER NOT NULL,
+            template_id INTEGER,
+            day_mask INTEGER,
+            start_minute INTEGER,
+            end_minute INTEGER
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_effective_windows_employee ON effective_windows(employee_id)")
 
+    # Календарь исключений: закрытия (глобальные, по лаборатории, по сотруднику) и разовые допуски
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS access_exceptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL CHECK (kind IN ('closed', 'open')),
+            date_from DATE NOT NULL,
+            date_to DATE NOT NULL,
+            employee_id INTEGER,
+            laboratory_id INTEGER,
+            time_start TIME,
+            time_end TIME,
+            reason TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (employee_id) REFERENCES employees (id),
+            FOREIGN KEY (laboratory_id) REFERENCES laboratories (id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_access_exceptions_dates ON access_exceptions(date_from, date_to)")
 
-@app.route('/employee/dashboard')
-@login_required
-def employee_dashboard():
-    if session.get('user_type') == 'admin':
-        return redirect(url_for('admin_dashboard'))
+    # Триггеры пересоздаются, чтобы база получила их актуальные версии
+    for name, body in SCHEDULE_TRIGGERS.items():
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute(f"CREATE TRIGGER {name} {body}")
 
-    conn = get_db_connection()
+    # Правила, записанные до появления триггеров
+    cursor.execute(schedule_compile_sql('access_schedules') +
+                   " WHERE day_mask IS NULL OR start_minute IS NULL OR end_minute IS NULL")
+    if cursor.rowcount:
+        print(f"🔄 Скомпилировано правил расписания: {cursor.rowcount}")
 
-    # Получаем информацию о сотруднике
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM employees WHERE id = ?", (session['user_id'],))
-    employee = dict(cursor.fetchone())
+    rebuild_effective_windows(cursor)
 
-    # Получаем последние события сотрудника
-    cursor.execute('''
-        SELECT ae.event_time, l.name, ae.event_type, ae.success
-        FROM access_events ae
-        JOIN laboratories l ON ae.laboratory_id = l.id
-        WHERE ae.employee_id = ?
-        ORDER BY ae.event_time DESC
-        LIMIT 10
-    ''', (session['user_id'],))
 
-    recent_events = [dict(row) for row in cursor.fetchall()]
+def rebuild_effective_windows(cursor):
+    """Пересчёт действующих окон всех сотрудников, если они разошлись с правилами и шаблонами.
 
-    # Получаем доступные лаборатории
-    cursor.execute('''
-        SELECT DISTINCT l.* 
-        FROM access_schedules a
-        JOIN laboratories l ON a.laboratory_id = l.id
-        WHERE a.employee_id = ? AND l.is_active = TRUE
-    ''', (session['user_id'],))
+    Таблица переписывается только при расхождении: иначе каждый запуск заново записывал бы
+    все окна, меняя версию расписаний и наполняя журнал изменений для терминалов.
+    """
+    cursor.execute("CREATE TEMP TABLE expected_windows AS SELECT * FROM effective_windows WHERE 0")
+    cursor.execute(f"INSERT INTO temp.expected_windows ({EFFECTIVE_WINDOW_COLUMNS}) {effective_select_sql('1')}")
+    cursor.execute(f'''
+        SELECT (SELECT COUNT(*) FROM effective_windows) != (SELECT COUNT(*) FROM temp.expected_windows)
+            OR EXISTS (SELECT {EFFECTIVE_WINDOW_COLUMNS} FROM effective_windows
+                       EXCEPT SELECT {EFFECTIVE_WINDOW_COLUMNS} FROM temp.expected_windows)
+            OR EXISTS (SELECT {EFFECTIVE_WINDOW_COLUMNS} FROM temp.expected_windows
+                       EXCEPT SELECT {EFFECTIVE_WINDOW_COLUMNS} FROM effective_windows)
+    ''')
+    stale = cursor.fetchone()[0]
 
-    accessible_labs = [dict(row) for row in cursor.fetchall()]
+    if stale:
+        cursor.execute("DELETE FROM effective_windows")
+        cursor.execute(f"INSERT INTO effective_windows ({EFFECTIVE_WINDOW_COLUMNS}) "
+                       f"SELECT {EFFECTIVE_WINDOW_COLUMNS} FROM temp.expected_windows")
+        cursor.execute(SCHEDULE_VERSION_SQL)
+    cursor.execute("DROP TABLE temp.expected_windows")
 
-    conn.close()
 
-    return render_template('employee_dashboard.html',
-                           employee=employee,
-                           recent_events=recent_events,
-                           accessible_labs=accessible_labs)
+def compile_schedule(windows):
+    """Окна (day_mask, start_minute, end_minute) в отсортированный массив интервалов недели.
 
+    Интервалы [начало, конец) в минутах от понедельника 00:00 объединяются,
+    поэтому проверка момента - один двоичный поиск. Окно с началом позже
+    конца переходит через полночь и относится к дню, в который началось.
+    """
+    intervals = []
+    covered_days = 0
+
+    for day_mask, start_minute, end_minute in windows:
+        crosses_midnight = start_minute > end_minute
+        for day in range(7):
+            if not day_mask & (1 << day):
+                continue
+            covered_days |= 1 << day
+            begin = day * MINUTES_PER_DAY + start_minute
+            finish = day * MINUTES_PER_DAY + end_minute + 1
+            if crosses_midnight:
+                covered_days |= 1 << ((day + 1) % 7)
+                finish += MINUTES_PER_DAY
+            if finish > MINUTES_PER_WEEK:
+                # Окно воскресенья, заканчивающееся в понедельник
+                intervals.append((begin, MINUTES_PER_WEEK))
+                intervals.append((0, finish - MINUTES_PER_WEEK))
+            else:
+                intervals.append((begin, finish))
 
-# Админ-маршруты
-@app.route('/admin')
-@login_required
-@admin_required
-def admin_dashboard():
-    stats = get_statistics()
+    starts, ends = array('l'), array('l')
+    for begin, finish in sorted(intervals):
+        if ends and begin <= ends[-1]:
+            ends[-1] = max(ends[-1], finish)
+        else:
+            starts.append(begin)
+            ends.append(finish)
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    return starts, ends, covered_days, windows
 
-    # Получаем последние события
-    cursor.execute('''
-        SELECT ae.event_time, e.full_name, l.name, ae.event_type, ae.success, ae.reason
-        FROM access_events ae
-        JOIN employees e ON ae.employee_id = e.id
-        JOIN laboratories l ON ae.laboratory_id = l.id
-        ORDER BY ae.event_time DESC
-        LIMIT 20
-    ''')
 
-    recent_events = [dict(row) for row in cursor.fetchall()]
+def load_compiled_schedules(cursor):
+    """Скомпилированные правила из кэша, перечитываются при изменении версии"""
+    version = get_engine_state(cursor, 'schedules_version')
+    if compiled_schedules['version'] != version:
+        cursor.execute('''
+            SELECT employee_id, laboratory_id, day_mask, start_minute, end_minute
+            FROM effective_windows
+        ''')
+        windows = {}
+        for row in cursor.fetchall():
+            windows.setdefault((row[0], row[1]), []).append((row[2], row[3], row[4]))
 
-    # Получаем сотрудников в лабораториях
-    cursor.execute('''
-        SELECT cp.entry_time, e.full_name, l.name, l.location
-        FROM current_presence cp
-        JOIN employees e ON cp.employee_id = e.id
-        JOIN laboratories l ON cp.laboratory_id = l.id
-        ORDER BY cp.entry_time DESC
-    ''')
+        rules = {key: compile_schedule(items) for key, items in windows.items()}
 
-    current_presence = [dict(row) for row in cursor.fetchall()]
+        # Индекс допуска обновляется только для изменившихся пар сотрудник/лаборатория
+        previous = compiled_schedules['rules']
+        for key in previous.keys() | rules.keys():
+            old_rule, new_rule = previous.get(key), rules.get(key)
+            if old_rule is None or new_rule is None or old_rule[:3] != new_rule[:3]:
+                index_schedule(key[0], key[1], new_rule)
 
-    conn.close()
+        compiled_schedules['rules'] = rules
+        compiled_schedules['version'] = version
+    return compiled_schedules['rules']
 
-    return render_template('admin_dashboard.html',
-                           stats=stats,
-                           recent_events=recent_events,
-                           current_presence=current_presence,
-                           now=datetime.now())
 
+def index_schedule(employee_id, laboratory_id, rule):
+    """Перезапись битов сотрудника в часовых корзинах индекса допуска лаборатории"""
+    full, partial = authorisation_index.setdefault(
+        laboratory_id, ([0] * HOURS_PER_WEEK, [0] * HOURS_PER_WEEK)
+    )
+    bit = 1 << employee_id
+    for hour in range(HOURS_PER_WEEK):
+        full[hour] &= ~bit
+        partial[hour] &= ~bit
+
+    if rule is None:
+        return
+
+    for begin, finish in zip(rule[0], rule[1]):
+        for hour in range(begin // 60, (finish - 1) // 60 + 1):
+            if begin <= hour * 60 and finish >= (hour + 1) * 60:
+                full[hour] |= bit
+            else:
+                partial[hour] |= bit
+
+
+def bitset_members(bits):
+    """Номера установленных битов множества по возрастанию"""
+    members = []
+    while bits:
+        lowest = bits & -bits
+        members.append(lowest.bit_length() - 1)
+        bits ^= lowest
+    return members
+
+
+def get_authorised_bitset(cursor, laboratory_id, moment):
+    """Множество сотрудников (битами), допущенных в лабораторию в указанный момент"""
+    day = load_day_schedules(cursor, moment.date())
+    minute = moment.hour * 60 + moment.minute
+
+    # В дни с исключениями недельный индекс неточен, проверяем расписание дня целиком
+    if day['exceptions']:
+        authorised = 0
+        for (employee_id, entry_laboratory_id), entry in day['pairs'].items():
+            if entry_laboratory_id == laboratory_id and day_schedule_allows(entry, minute):
+                authorised |= 1 << employee_id
+        return authorised
+
+    if laboratory_id not in authorisation_index:
+        return 0
+
+    full, partial = authorisation_index[laboratory_id]
+    hour = moment.weekday() * 24 + moment.hour
+    authorised = full[hour]
+
+    # Допуск на часть часа проверяется по точным интервалам
+    for employee_id in bitset_members(partial[hour]):
+        if day_schedule_allows(day['pairs'][(employee_id, laboratory_id)], minute):
+            authorised |= 1 << employee_id
+
+    return authorised
+
+
+def load_exceptions(cursor, first_day, last_day):
+    """Исключения календаря по дням: {дата: ((employee_id, laboratory_id, kind, начало, конец), ...)}"""
+    cursor.execute(f'''
+        SELECT date_from, date_to, employee_id, laboratory_id, kind,
+               CASE WHEN time_start IS NULL THEN 0 ELSE {schedule_minute_sql('time_start')} END,
+               CASE WHEN time_end IS NULL THEN {MINUTES_PER_DAY} ELSE {schedule_minute_sql('time_end')} + 1 END
+        FROM access_exceptions
+        WHERE date_from <= ? AND date_to >= ?
+        ORDER BY id
+    ''', (last_day.strftime('%Y-%m-%d'), first_day.strftime('%Y-%m-%d')))
+
+    exceptions = {}
+    for date_from, date_to, employee_id, laboratory_id, kind, start_minute, end_minute in cursor.fetchall():
+        day = max(datetime.strptime(date_from, '%Y-%m-%d').date(), first_day)
+        until = min(datetime.strptime(date_to, '%Y-%m-%d').date(), last_day)
+        while day <= until:
+            exceptions.setdefault(day, []).append((employee_id, laboratory_id, kind, start_minute, end_minute))
+            day += timedelta(days=1)
+
+    return {day: tuple(items) for day, items in exceptions.items()}
+
+
+def build_day_entry(rule, weekday, exceptions, employee_id, laboratory_id):
+    """Интервалы допуска пары сотрудник/лаборатория на один день с учётом исключений"""
+    intervals = []
+    if rule:
+        day_start = weekday * MINUTES_PER_DAY
+        day_end = day_start + MINUTES_PER_DAY
+        for begin, finish in zip(rule[0], rule[1]):
+            if begin < day_end and finish > day_start:
+                intervals.append((max(begin, day_start) - day_start, min(finish, day_end) - day_start))
+
+    # Сначала вычитаются закрытия, затем добавляются разовые допуски
+    closures = []
+    openings = []
+    for exception_employee, exception_laboratory, kind, start_minute, end_minute in exceptions:
+        if exception_employee not in (None, employee_id) or exception_laboratory not in (None, laboratory_id):
+            continue
+        if kind == 'closed':
+            closures.append((start_minute, end_minute))
+            intervals = [
+                piece for begin, finish in intervals
+                for piece in ((begin, min(finish, start_minute)), (max(begin, end_minute), finish))
+                if piece[0] < piece[1]
+            ]
+        else:
+            openings.append((start_minute, end_minute))
 
-@app.route('/admin/employees')
-@login_required
-@admin_required
-def admin_employees():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    starts, ends = array('l'), array('l')
+    for begin, finish in sorted(intervals + openings):
+        if ends and begin <= ends[-1]:
+            ends[-1] = max(ends[-1], finish)
+        else:
+            starts.append(begin)
+            ends.append(finish)
 
-    # Получаем сотрудников
-    cursor.execute('''
-        SELECT e.*, 
-               GROUP_CONCAT(DISTINCT l.name) as accessible_labs
-        FROM employees e
-        LEFT JOIN access_schedules a ON e.id = a.employee_id
-        LEFT JOIN laboratories l ON a.laboratory_id = l.id
-        GROUP BY e.id
-        ORDER BY e.created_at DESC
-    ''')
+    if rule is None or not rule[2] & (1 << weekday):
+        reason = 'День недели не разрешен'
+    else:
+        reason = 'Вне времени доступа'
 
-    employees = [dict(row) for row in cursor.fetchall()]
+    return starts, ends, tuple(closures), reason
 
-    # Получаем список лабораторий для выпадающего списка
-    cursor.execute('''
-        SELECT id, name, code 
-        FROM laboratories 
-        WHERE is_active = TRUE
-        ORDER BY name
-    ''')
 
-    laboratories = [dict(row) for row in cursor.fetchall()]
+def build_day_schedule(rules, day, exceptions):
+    """Расписание всех пар сотрудник/лаборатория на день"""
+    weekday = day.weekday()
+    pairs = set(rules)
+    pairs.update((item[0], item[1]) for item in exceptions if item[2] == 'open')
+    return {
+        'exceptions': exceptions,
+        'pairs': {
+            pair: build_day_entry(rules.get(pair), weekday, exceptions, pair[0], pair[1])
+            for pair in pairs
+        }
+    }
 
-    conn.close()
 
-    # Дни недели для отображения
-    days_of_week = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
+def load_day_schedules(cursor, day):
+    """Расписание на день из кэша, предрасчитанного на несколько дней вперёд.
 
-    return render_template('admin_employees.html',
-                           employees=employees,
-                           laboratories=laboratories,
-                           days_of_week=days_of_week,
-                           min_pin_length=MIN_PIN_LENGTH,
-                           max_pin_length=MAX_PIN_LENGTH)
+    При изменении правил пересчитываются только изменившиеся пары, при
+    изменении исключений - только дни, которых они касаются.
+    """
+    rules = load_compiled_schedules(cursor)
+    today = datetime.now().date()
 
+    if daily_schedules['rules'] is not rules or daily_schedules['today'] != today:
+        window = [today + timedelta(days=offset) for offset in range(SCHEDULE_PRECOMPUTE_DAYS + 1)]
+        exceptions = load_exceptions(cursor, window[0], window[-1])
 
-@app.route('/admin/laboratories')
-@login_required
-@admin_required
-def admin_laboratories():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+        previous = daily_schedules['rules'] or {}
+        changed = [
+            pair for pair in previous.keys() | rules.keys()
+            if pair not in previous or pair not in rules or previous[pair][:3] != rules[pair][:3]
+        ]
 
-    cursor.execute('''
-        SELECT l.*, 
-               COUNT(DISTINCT a.employee_id) as employee_count,
-               COUNT(DISTINCT cp.employee_id) as current_count
-        FROM laboratories l
-        LEFT JOIN access_schedules a ON l.id = a.laboratory_id
-        LEFT JOIN current_presence cp ON l.id = cp.laboratory_id
-        GROUP BY l.id
-        ORDER BY l.name
-    ''')
+        days = {}
+        for window_day in window:
+            day_exceptions = exceptions.get(window_day, ())
+            cached = daily_schedules['days'].get(window_day)
+            if cached is None or cached['exceptions'] != day_exceptions:
+                days[window_day] = build_day_schedule(rules, window_day, day_exceptions)
+                continue
+
+            openings = {(item[0], item[1]) for item in day_exceptions if item[2] == 'open'}
+            for pair in changed:
+                if pair in rules or pair in openings:
+                    cached['pairs'][pair] = build_day_entry(
+                        rules.get(pair), window_day.weekday(), day_exceptions, pair[0], pair[1]
+                    )
+                else:
+                    cached['pairs'].pop(pair, None)
+            days[window_day] = cached
 
-    laboratories = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+        daily_schedules.update(rules=rules, today=today, days=days)
 
-    return render_template('admin_laboratories.html', laboratories=laboratories)
+    if day in daily_schedules['days']:
+        return daily_schedules['days'][day]
 
+    # Дни вне окна предрасчёта (запросы за прошлые даты) считаются по требованию
+    return build_day_schedule(rules, day, load_exceptions(cursor, day, day).get(day, ()))
 
-@app.route('/admin/reports')
-@login_required
-@admin_required
-def admin_reports():
-    conn = get_db_connection()
-    cursor = conn.cursor()
 
-    # Получаем доступные отчеты
+def day_schedule_allows(entry, minute):
+    """Попадает ли минута суток в интервалы допуска дня"""
+    index = bisect_right(entry[0], minute) - 1
+    return index >= 0 and minute < entry[1][index]
+
+
+def check_schedule(cursor, employee_id, laboratory_id, moment):
+    """Проверка доступа по расписанию дня.
+
+    Возвращает (None, ожидаемое время выхода) при разрешённом доступе
+    или (причина отказа, None).
+    """
+    day = moment.date()
+    pair = (employee_id, laboratory_id)
+    entry = load_day_schedules(cursor, day)['pairs'].get(pair)
+    if entry is None:
+        return 'Нет расписания доступа', None
+
+    starts, ends, closures, reason = entry
+    minute = moment.hour * 60 + moment.minute
+    index = bisect_right(starts, minute) - 1
+
+    if index >= 0 and minute < ends[index]:
+        finish = ends[index]
+        # Интервал, доходящий до полуночи, продолжается интервалом следующего дня
+        if finish == MINUTES_PER_DAY:
+            following = load_day_schedules(cursor, day + timedelta(days=1))['pairs'].get(pair)
+            if following and following[0] and following[0][0] == 0:
+                finish += following[1][0]
+        return None, datetime.combine(day, time()) + timedelta(minutes=finish - 1)
+
+    if any(start_minute <= minute < end_minute for start_minute, end_minute in closures):
+        return EXCEPTION_CLOSED_REASON, None
+    return reason, None
+
+
+def compile_proposed_windows(windows):
+    """Окна из parse_access_windows в скомпилированное правило (как у триггеров)"""
+    compiled = []
+    for days_str, time_start, time_end in windows:
+        day_mask = sum(1 << day for day in parse_days_of_week(days_str)) or 127
+        start = time.fromisoformat(time_start)
+        end = time.fromisoformat(time_end)
+        compiled.append((day_mask, start.hour * 60 + start.minute, end.hour * 60 + end.minute))
+    return compile_schedule(compiled)
+
+
+def replay_schedule_proposal(cursor, proposals, date_from, date_to):
+    """Проигрывание исторических попыток входа по предлагаемым расписаниям.
+
+    proposals - список (laboratory_id, employee_id, department, правило); правило
+    сотрудника важнее правила отдела, правило отдела - правила всей лаборатории.
+    Календарь исключений не учитывается. Возвращает счётчики по парам
+    сотрудник/лаборатория: {(employee_id, laboratory_id): [попыток, было разрешено,
+    стало бы разрешено, стало бы запрещено, стало бы разрешено из запрещённых]}.
+    """
+    laboratory_ids = sorted({proposal[0] for proposal in proposals})
+    cursor.execute(f'''
+        SELECT DISTINCT ae.employee_id, ae.laboratory_id, e.department
+        FROM access_events ae
+        JOIN employees e ON e.id = ae.employee_id
+        WHERE ae.laboratory_id IN ({','.join('?' * len(laboratory_ids))})
+          AND ae.event_time >= ? AND ae.event_time < ?
+    ''', laboratory_ids + [date_from, next_day(date_to)])
+    candidates = cursor.fetchall()
+
+    by_employee = {(proposal[0], proposal[1]): proposal[3] for proposal in proposals if proposal[1]}
+    by_department = {(proposal[0], proposal[2]): proposal[3] for proposal in proposals if proposal[2]}
+    by_laboratory = {proposal[0]: proposal[3] for proposal in proposals if not proposal[1] and not proposal[2]}
+
+    # Номер пары задаёт смещение её недели в общем отсортированном массиве интервалов
+    pairs = []
+    starts, ends = array('q'), array('q')
+    for employee_id, laboratory_id, department in candidates:
+        rule = (by_employee.get((laboratory_id, employee_id)) or
+                by_department.get((laboratory_id, department)) or
+                by_laboratory.get(laboratory_id))
+        if rule is None:
+            continue
+        offset = len(pairs) * MINUTES_PER_WEEK
+        pairs.append((employee_id, laboratory_id))
+        starts.extend(begin + offset for begin in rule[0])
+        ends.extend(finish + offset for finish in rule[1])
+
+    cursor.execute("DROP TABLE IF EXISTS temp.what_if_pairs")
     cursor.execute('''
-        SELECT r.*, e.full_name as created_by_name
-        FROM reports r
-        LEFT JOIN employees e ON r.created_by = e.id
-        ORDER BY r.generated_at DESC
+        CREATE TEMP TABLE what_if_pairs (
+            employee_id INTEGER,
+            laboratory_id INTEGER,
+            pair_index INTEGER,
+            PRIMARY KEY (employee_id, laboratory_id)
+        )
     ''')
+    cursor.executemany(
+        "INSERT INTO what_if_pairs (employee_id, laboratory_id, pair_index) VALUES (?, ?, ?)",
+        [(employee_id, laboratory_id, index) for index, (employee_id, laboratory_id) in enumerate(pairs)]
+    )
 
-    reports = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    # Минута недели (понедельник 00:00 = 0) считается в SQLite: 01.01.1970 - четверг.
+    # Курсор без sqlite3.Row, чтобы миллионы строк читались простыми кортежами
+    events_cursor = cursor.connection.cursor()
+    events_cursor.row_factory = None
+    events_cursor.execute(f'''
+        SELECT p.pair_index * {MINUTES_PER_WEEK}
+               + (CAST(strftime('%s', ae.event_time) AS INTEGER) / 60 + 3 * {MINUTES_PER_DAY}) % {MINUTES_PER_WEEK},
+               p.pair_index,
+               CASE WHEN ae.success THEN 1 ELSE 0 END
+        FROM access_events ae
+        JOIN what_if_pairs p ON p.employee_id = ae.employee_id AND p.laboratory_id = ae.laboratory_id
+        WHERE ae.event_type IN ('entry', 'entry_denied', 'check')
+          AND ae.event_time >= ? AND ae.event_time < ?
+    ''', (date_from, next_day(date_to)))
+    rows = events_cursor.fetchall()
+    cursor.execute("DROP TABLE temp.what_if_pairs")
+
+    counters = [[0, 0, 0, 0, 0] for _ in pairs]
+
+    if HAS_NUMPY and rows:
+        events = np.array(rows, dtype=np.int64)
+        keys, indexes, allowed_before = events[:, 0], events[:, 1], events[:, 2]
+        interval_starts = np.frombuffer(starts, dtype=np.int64)
+        interval_ends = np.frombuffer(ends, dtype=np.int64)
+
+        position = np.searchsorted(interval_starts, keys, side='right') - 1
+        allowed_after = (position >= 0) & (keys < interval_ends[np.maximum(position, 0)])
+
+        size = len(pairs)
+        columns = [
+            np.bincount(indexes, minlength=size),
+            np.bincount(indexes, weights=allowed_before, minlength=size),
+            np.bincount(indexes, weights=allowed_after, minlength=size),
+            np.bincount(indexes, weights=(allowed_before == 1) & ~allowed_after, minlength=size),
+            np.bincount(indexes, weights=(allowed_before == 0) & allowed_after, minlength=size),
+        ]
+        counters = [[int(column[index]) for column in columns] for index in range(size)]
+    else:
+        for key, index, allowed_before in rows:
+            position = bisect_right(starts, key) - 1
+            allowed_after = position >= 0 and key < ends[position]
+            counter = counters[index]
+            counter[0] += 1
+            counter[1] += allowed_before
+            counter[2] += allowed_after
+            counter[3] += allowed_before and not allowed_after
+            counter[4] += allowed_after and not allowed_before
+
+    return {pair: counters[index] for index, pair in enumerate(pairs) if counters[index][0]}
+
+
+def describe_day_schedule(cursor, employee_id, laboratory_id, moment):
+    """Текст с интервалами доступа на день момента для сообщения терминала"""
+    entry = load_day_schedules(cursor, moment.date())['pairs'].get((employee_id, laboratory_id))
+    windows = list(zip(entry[0], entry[1])) if entry else []
+    if not windows:
+        return "Сегодня доступ не разрешён"
+    if len(windows) == 1:
+        return f"Доступ разрешён с {format_minute(windows[0][0])} до {format_minute(windows[0][1] - 1)}"
+    return "Доступ разрешён: " + ', '.join(
+        f"{format_minute(start)}–{format_minute(end - 1)}" for start, end in windows
+    )
 
-    return render_template('admin_reports.html', reports=reports)
 
+def format_minute(minute):
+    """Минуты от начала суток в строку ЧЧ:ММ"""
+    return f"{minute // 60:02d}:{minute % 60:02d}"
 
-@app.route('/admin/access_rights')
-@login_required
-@admin_required
-def admin_access_rights():
-    """Страница управления правами доступа"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
 
-    # Получаем всех сотрудников с количеством доступных лабораторий
-    cursor.execute('''
-        SELECT e.*, 
-               COUNT(DISTINCT a.id) as accessible_labs_count
-        FROM employees e
-        LEFT JOIN access_schedules a ON e.id = a.employee_id
-        GROUP BY e.id
-        ORDER BY e.full_name
-    ''')
+def parse_days_of_week(value):
+    """Дни недели из строки '0,1,2' или списка в список чисел"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [int(str(day).strip()) for day in value if str(day).strip().isdigit()]
 
-    employees = [dict(row) for row in cursor.fetchall()]
 
-    # Получаем все активные лаборатории
+def parse_access_windows(data):
+    """Окна доступа из запроса: список windows или поля одного окна.
+
+    Возвращает список (days_str, time_start, time_end); при ошибке - ValueError.
+    """
+    windows = data.get('windows')
+    if windows is None:
+        for field in ('days_of_week', 'time_start', 'time_end'):
+            if field not in data:
+                raise ValueError(f'Не указано поле: {field}')
+        windows = [data]
+
+    if not isinstance(windows, list) or not windows:
+        raise ValueError('Список окон доступа пуст')
+
+    result = []
+    for window in windows:
+        days = parse_days_of_week(window.get('days_of_week'))
+        if any(day > 6 for day in days):
+            raise ValueError('Дни недели указываются числами от 0 до 6')
+        try:
+            time_start = time.fromisoformat(window['time_start'])
+            time_end = time.fromisoformat(window['time_end'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Время окна указывается в формате ЧЧ:ММ')
+        result.append((','.join(map(str, days)), time_start.strftime('%H:%M'), time_end.strftime('%H:%M')))
+    return result
+
+
+def save_access_windows(cursor, employee_id, laboratory_id, windows):
+    """Запись окон доступа: первое - в access_schedules, остальные - в дочернюю таблицу"""
+    days_str, time_start, time_end = windows[0]
     cursor.execute('''
-        SELECT id, name, code 
-        FROM laboratories 
-        WHERE is_active = TRUE
-        ORDER BY name
-    ''')
+        SELECT id FROM access_schedules
+        WHERE employee_id = ? AND laboratory_id = ?
+    ''', (employee_id, laboratory_id))
+    existing = cursor.fetchone()
 
-    laboratories = [dict(row) for row in cursor.fetchall()]
+    if existing:
+        schedule_id = existing[0]
+        cursor.execute('''
+            UPDATE access_schedules
+            SET days_of_week = ?, time_start = ?, time_end = ?
+            WHERE id = ?
+        ''', (days_str, time_start, time_end, schedule_id))
+    else:
+        cursor.execute('''
+            INSERT INTO access_schedules (employee_id, laboratory_id, days_of_week, time_start, time_end)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (employee_id, laboratory_id, days_str, time_start, time_end))
+        schedule_id = cursor.lastrowid
+
+    cursor.execute("DELETE FROM access_schedule_windows WHERE schedule_id = ?", (schedule_id,))
+    cursor.executemany('''
+        INSERT INTO access_schedule_windows (schedule_id, days_of_week, time_start, time_end)
+        VALUES (?, ?, ?, ?)
+    ''', [(schedule_id, *window) for window in windows[1:]])
+
+    return schedule_id
+
+
+def save_template_windows(cursor, template_id, windows):
+    """Замена окон шаблона расписания"""
+    cursor.execute("DELETE FROM schedule_template_windows WHERE template_id = ?", (template_id,))
+    cursor.executemany('''
+        INSERT INTO schedule_template_windows (template_id, days_of_week, time_start, time_end)
+        VALUES (?, ?, ?, ?)
+    ''', [(template_id, *window) for window in windows])
+
+
+def attach_access_windows(cursor, rules):
+    """Добавление к правилам (словарям со строкой access_schedules) полного списка окон"""
+    if not rules:
+        return rules
+
+    ids = [rule['id'] for rule in rules]
+    placeholders = ','.join('?' * len(ids))
+    cursor.execute(f'''
+        SELECT schedule_id, days_of_week, time_start, time_end
+        FROM access_schedule_windows
+        WHERE schedule_id IN ({placeholders})
+        ORDER BY id
+    ''', ids)
+
+    extra = {}
+    for row in cursor.fetchall():
+        extra.setdefault(row[0], []).append({
+            'days_of_week': parse_days_of_week(row[1]),
+            'time_start': row[2],
+            'time_end': row[3]
+        })
 
-    conn.close()
+    for rule in rules:
+        rule['windows'] = [{
+            'days_of_week': parse_days_of_week(rule['days_of_week']),
+            'time_start': rule['time_start'],
+            'time_end': rule['time_end']
+        }] + extra.get(rule['id'], [])
+    return rules
 
-    return render_template('admin_access_rights.html',
-                           employees=employees,
-                           laboratories=laboratories)
 
+# Реестр присутствия в памяти - основной источник для чтения; таблица current_presence
+# обновляется в той же транзакции, что и событие, а реестр - сразу после её фиксации.
+# 'employees': {employee_id: запись}, 'laboratories': {laboratory_id: {employee_id: запись}}
+# в порядке входа, 'directory': {laboratory_id: данные лаборатории} или None до загрузки,
+# 'locations': {(корпус, этаж): [laboratory_id, ...]} - индекс для поэтажной переклички
+presence_registry = {'loaded': False, 'employees': {}, 'laboratories': {}, 'directory': None, 'locations': {}}
+presence_lock = threading.Lock()
 
-@app.route('/admin/import_export')
-@login_required
-@admin_required
-def admin_import_export():
-    """Страница импорта/экспорта данных"""
-    return render_template('admin_import_export.html')
+# Перекличка при эвакуации: 'accounted': {employee_id: (время отметки, кто отметил)}
+roll_call = {'started_at': None, 'accounted': {}}
 
 
-@app.route('/admin/statistics')
-@login_required
-@admin_required
-def admin_statistics():
-    """Страница статистики с графиками"""
-    return render_template('admin_statistics.html')
+def presence_record(row):
+    """Запись реестра присутствия из строки current_presence с данными сотрудника"""
+    return {
+        'employee_id': row['employee_id'],
+        'laboratory_id': row['laboratory_id'],
+        'entry_time': row['entry_time'],
+        'expected_exit_time': row['expected_exit_time'],
+        'full_name': row['full_name'],
+        'department': row['department'],
+        'position': row['position']
+    }
 
 
-# API маршруты
-@app.route('/api/verify_access', methods=['POST'])
-def api_verify_access():
-    """API для проверки доступа через терминал"""
-    try:
-        data = request.get_json()
+def parse_location(location):
+    """Корпус и этаж из laboratories.location ('Корпус А, этаж 3, комн. 301')"""
+    parts = [part.strip() for part in (location or '').split(',') if part.strip()]
+    building = parts[0] if parts else 'Корпус не указан'
+    floor = next((part for part in parts[1:] if 'этаж' in part.lower()), 'Этаж не указан')
+    return building, floor
 
-        # Поддержка разных методов аутентификации
-        if 'pin_code' in data:
-            # Аутентификация по PIN-коду
-            pin_code = str(data.get('pin_code', '')).strip()
-            laboratory_id = int(data.get('laboratory_id', 1))
 
-            conn = get_db_connection()
-            cursor = conn.cursor()
+def load_laboratory_directory(cursor):
+    """Справочник лабораторий и индекс (корпус, этаж) -> лаборатории"""
+    cursor.execute("SELECT id, name, code, location, description, capacity, is_active FROM laboratories")
+    directory = {row['id']: dict(row) for row in cursor.fetchall()}
+    locations = {}
+    for laboratory in sorted(directory.values(), key=lambda laboratory: laboratory['name']):
+        locations.setdefault(parse_location(laboratory['location']), []).append(laboratory['id'])
+    return directory, locations
 
-            cursor.execute(
-                "SELECT id FROM employees WHERE pin_code = ? AND is_active = TRUE",
-                (pin_code,)
-            )
 
-            employee = cursor.fetchone()
-            conn.close()
+def load_presence_registry(cursor):
+    """Загрузка реестра присутствия и справочника лабораторий из базы"""
+    cursor.execute('''
+        SELECT cp.employee_id, cp.laboratory_id, cp.entry_time, cp.expected_exit_time,
+               e.full_name, e.department, e.position
+        FROM current_presence cp
+        JOIN employees e ON cp.employee_id = e.id
+        ORDER BY cp.entry_time, cp.id
+    ''')
+    employees = {}
+    laboratories = {}
+    for row in cursor.fetchall():
+        record = presence_record(row)
+        employees[record['employee_id']] = record
+        laboratories.setdefault(record['laboratory_id'], {})[record['employee_id']] = record
 
-            if not employee:
-                return jsonify({
-                    'success': False,
-                    'message': 'Неверный PIN-код'
-                })
+    directory, locations = load_laboratory_directory(cursor)
 
-            employee_id = employee['id']
-            success, message = verify_access(employee_id, laboratory_id, 'pin')
+    with presence_lock:
+        presence_registry.update(loaded=True, employees=employees, laboratories=laboratories,
+                                 directory=directory, locations=locations)
+    reset_overstay_timers(employees.values())
 
-        elif 'login' in data and 'password' in data:
-            # Аутентификация по логину/паролю
-            login = data.get('login', '').strip()
-            password = data.get('password', '').strip()
-            laboratory_id = int(data.get('laboratory_id', 1))
 
-            user = validate_credentials(login, password)
+def ensure_presence_registry():
+    """Ленивая загрузка реестра (например, при запуске через WSGI без __main__)"""
+    if presence_registry['loaded'] and presence_registry['directory'] is not None:
+        return
+    conn = get_db_connection()
+    try:
+        if not presence_registry['loaded']:
+            load_presence_registry(conn.cursor())
+            start_overstay_monitor()
+            start_invalidation_listener()
+        else:
+            directory, locations = load_laboratory_directory(conn.cursor())
+            with presence_lock:
+                presence_registry.update(directory=directory, locations=locations)
+    finally:
+        conn.close()
 
-            if not user:
-                return jsonify({
-                    'success': False,
-                    'message': 'Неверный логин или пароль'
-                })
 
-            success, message = verify_access(user['id'], laboratory_id, 'login')
-        else:
-            return jsonify({
-                'success': False,
-                'message': 'Неверный формат запроса'
-            })
+def invalidate_laboratory_directory():
+    """Сброс справочника лабораторий после их изменения"""
+    presence_registry['directory'] = None
 
-        return jsonify({
-            'success': success,
-            'message': message
-        })
 
-    except Exception as e:
-        print(f"Ошибка API: {e}")
-        return jsonify({
-            'success': False,
-            'message': 'Внутренняя ошибка сервера'
-        }), 500
+def registry_enter(record):
+    """Вход в реестре (после фиксации транзакции)"""
+    with presence_lock:
+        previous = registry_exit_locked(record['employee_id'])
+        presence_registry['employees'][record['employee_id']] = record
+        presence_registry['laboratories'].setdefault(record['laboratory_id'], {})[record['employee_id']] = record
+    schedule_overstay(record)
+    if previous and previous['laboratory_id'] != record['laboratory_id']:
+        notify_terminals(previous['laboratory_id'])
+    notify_terminals(record['laboratory_id'])
 
 
-@app.route('/api/admin/export/pdf/pdfkit', methods=['POST'])
-@login_required
-@admin_required
-def api_export_pdf_pdfkit():
-    """Экспорт в PDF с использованием pdfkit и wkhtmltopdf"""
-    try:
+def registry_exit(employee_id, entry_time=None):
+    """Выход в реестре (после фиксации транзакции).
+
+    С entry_time запись удаляется, только если это то же пребывание.
+    """
+    with presence_lock:
+        record = presence_registry['employees'].get(employee_id)
+        if entry_time is not None and (not record or record['entry_time'] != entry_time):
+            return
+        record = registry_exit_locked(employee_id)
+    cancel_overstay(employee_id)
+    if record:
+        notify_terminals(record['laboratory_id'])
+
+
+def registry_exit_locked(employee_id):
+    """Удаление сотрудника из реестра с возвратом его записи; вызывается под presence_lock"""
+    record = presence_registry['employees'].pop(employee_id, None)
+    if record:
+        presence_registry['laboratories'].get(record['laboratory_id'], {}).pop(employee_id, None)
+    return record
+
+
+def registry_update_employee(employee_id, full_name, department, position):
+    """Обновление данных сотрудника, находящегося в лаборатории"""
+    with presence_lock:
+        record = presence_registry['employees'].get(employee_id)
+        if record:
+            record.update(full_name=full_name, department=department, position=position)
+
+
+def get_presence(laboratory_id=None):
+    """Присутствующие (копии записей) в порядке входа, с данными лаборатории"""
+    ensure_presence_registry()
+    with presence_lock:
+        if laboratory_id is None:
+            records = sorted(presence_registry['employees'].values(), key=lambda record: record['entry_time'])
+        else:
+            records = list(presence_registry['laboratories'].get(laboratory_id, {}).values())
+        directory = presence_registry['directory'] or {}
+
+    people = []
+    for record in records:
+        laboratory = directory.get(record['laboratory_id'], {})
+        people.append(dict(record, laboratory_name=laboratory.get('name'),
+                           laboratory_code=laboratory.get('code'), location=laboratory.get('location')))
+    return people
+
+
+def get_presence_counts():
+    """Число присутствующих по лабораториям"""
+    ensure_presence_registry()
+    with presence_lock:
+        return {laboratory_id: len(people) for laboratory_id, people in presence_registry['laboratories'].items()}
+
+
+def get_laboratory_directory():
+    """Справочник лабораторий из памяти"""
+    ensure_presence_registry()
+    return presence_registry['directory']
+
+
+def get_roll_call():
+    """Перекличка: присутствующие по корпусам и этажам, только из памяти"""
+    ensure_presence_registry()
+    with presence_lock:
+        laboratories = presence_registry['laboratories']
+        directory = presence_registry['directory'] or {}
+        accounted = roll_call['accounted']
+        groups = list(presence_registry['locations'].items())
+        # Лаборатории, которых нет в справочнике (например, удалённые), идут отдельной группой
+        unknown = [laboratory_id for laboratory_id in laboratories if laboratory_id not in directory]
+        if unknown:
+            groups.append((('Корпус не указан', 'Этаж не указан'), unknown))
+
+        buildings = {}
+        total = accounted_count = 0
+        for (building, floor), laboratory_ids in sorted(groups):
+            people = []
+            for laboratory_id in laboratory_ids:
+                laboratory = directory.get(laboratory_id, {})
+                for record in laboratories.get(laboratory_id, {}).values():
+                    mark = accounted.get(record['employee_id'])
+                    people.append({
+                        'employee_id': record['employee_id'],
+                        'full_name': record['full_name'],
+                        'department': record['department'],
+                        'laboratory_code': laboratory.get('code'),
+                        'location': laboratory.get('location'),
+                        'entry_time': record['entry_time'],
+                        'accounted': mark is not None,
+                        'accounted_at': mark[0] if mark else None
+                    })
+                    accounted_count += mark is not None
+            if people:
+                total += len(people)
+                buildings.setdefault(building, []).append({'floor': floor, 'count': len(people), 'people': people})
+        started_at = roll_call['started_at']
+
+    return {
+        'started_at': started_at,
+        'total': total,
+        'accounted': accounted_count,
+        'missing': total - accounted_count,
+        'buildings': [
+            {'building': building, 'count': sum(floor['count'] for floor in floors), 'floors': floors}
+            for building, floors in buildings.items()
+        ]
+    }
+
+
+def start_roll_call():
+    """Начало новой переклички: отметки сбрасываются"""
+    with presence_lock:
+        roll_call.update(started_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'), accounted={})
+        return roll_call['started_at']
+
+
+def mark_accounted(employee_id, accounted=True, marked_by=None):
+    """Отметка сотрудника на перекличке; False, если его нет в лабораториях"""
+    with presence_lock:
+        if employee_id not in presence_registry['employees']:
+            return False
+        if accounted:
+            roll_call['accounted'][employee_id] = (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), marked_by)
+        else:
+            roll_call['accounted'].pop(employee_id, None)
+        return True
+
+
+# Контроль превышения времени пребывания. Таймеры - куча (срок, employee_id, entry_time),
+# отменённые таймеры удаляются из кучи лениво. Фоновый поток спит до ближайшего срока,
+# поэтому ожидающие таймеры не расходуют процессорное время.
+OVERSTAY_AUTO_EXIT = False  # при True просроченное пребывание закрывается событием выхода
+OVERSTAY_BATCH_SIZE = 500
+OVERSTAY_REASON = 'Превышено время доступа'
+OVERSTAY_MAX_SLEEP_SECONDS = 3600
+
+# 'heap': куча таймеров, 'due': {employee_id: (срок, entry_time)} для действующих таймеров,
+# 'fired': {employee_id: срок} для сработавших и ещё не вышедших сотрудников
+overstay_timers = {'heap': [], 'due': {}, 'fired': {}, 'thread': None}
+overstay_condition = threading.Condition()
+
+
+def init_overstays(cursor):
+    """Создание таблицы событий превышения времени пребывания"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS overstay_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            employee_id INTEGER NOT NULL,
+            laboratory_id INTEGER NOT NULL,
+            entry_time TIMESTAMP NOT NULL,
+            expected_exit_time TIMESTAMP NOT NULL,
+            detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            auto_exit BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY (employee_id) REFERENCES employees (id),
+            FOREIGN KEY (laboratory_id) REFERENCES laboratories (id),
+            UNIQUE(employee_id, entry_time)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_overstay_events_detected ON overstay_events(detected_at)")
+
+
+def push_overstay_locked(employee_id, entry_time, expected_exit_time):
+    """Постановка таймера; вызывается под overstay_condition"""
+    due = parse_event_time(expected_exit_time)
+    overstay_timers['due'][employee_id] = (due, entry_time)
+    heap = overstay_timers['heap']
+    heapq.heappush(heap, (due, employee_id, entry_time))
+    return heap[0][0] == due
+
+
+def reset_overstay_timers(records):
+    """Пересоздание таймеров по записям реестра присутствия"""
+    now = datetime.now()
+    with overstay_condition:
+        overstay_timers.update(heap=[], due={}, fired={})
+        for record in records:
+            if record['expected_exit_time']:
+                push_overstay_locked(record['employee_id'], record['entry_time'], record['expected_exit_time'])
+        overstay_condition.notify()
+
+
+def schedule_overstay(record):
+    """Таймер для нового пребывания в лаборатории"""
+    if not record['expected_exit_time']:
+        return
+    with overstay_condition:
+        overstay_timers['fired'].pop(record['employee_id'], None)
+        # Будим поток, только если срок нового таймера ближайший
+        if push_overstay_locked(record['employee_id'], record['entry_time'], record['expected_exit_time']):
+            overstay_condition.notify()
+
+
+def cancel_overstay(employee_id):
+    """Отмена таймера при выходе сотрудника"""
+    with overstay_condition:
+        overstay_timers['due'].pop(employee_id, None)
+        overstay_timers['fired'].pop(employee_id, None)
+        # Чистим кучу от отменённых таймеров, когда их становится больше действующих
+        heap = overstay_timers['heap']
+        if len(heap) > 2 * len(overstay_timers['due']) + 64:
+            overstay_timers['heap'] = [
+                (due, timer_employee_id, entry_time)
+                for timer_employee_id, (due, entry_time) in overstay_timers['due'].items()
+            ]
+            heapq.heapify(overstay_timers['heap'])
+
+
+def pop_due_overstays(now):
+    """Извлечение до OVERSTAY_BATCH_SIZE наступивших таймеров; вызывается под overstay_condition"""
+    heap = overstay_timers['heap']
+    due_timers = overstay_timers['due']
+    batch = []
+    while heap and heap[0][0] <= now and len(batch) < OVERSTAY_BATCH_SIZE:
+        due, employee_id, entry_time = heapq.heappop(heap)
+        if due_timers.get(employee_id) != (due, entry_time):
+            continue  # таймер отменён или заменён
+        del due_timers[employee_id]
+        overstay_timers['fired'][employee_id] = due
+        batch.append((employee_id, entry_time, due))
+    return batch
+
+
+@write_command('overstays', sync=True)
+def write_overstays(cursor, batch, auto_exit):
+    """Команда записи: события превышения и выходы; возвращает [[employee_id, entry_time]] вышедших"""
+    exited = []
+    for employee_id, entry_time, due in batch:
+        cursor.execute(
+            "SELECT laboratory_id FROM current_presence WHERE employee_id = ? AND entry_time = ?",
+            (employee_id, entry_time)
+        )
+        row = cursor.fetchone()
+        if not row:
+            continue
+
+        cursor.execute('''
+            INSERT OR IGNORE INTO overstay_events (employee_id, laboratory_id, entry_time, expected_exit_time, auto_exit)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (employee_id, row['laboratory_id'], entry_time, due, auto_exit))
+        if cursor.rowcount == 0 or not auto_exit:
+            continue
+
+        cursor.execute("DELETE FROM current_presence WHERE employee_id = ?", (employee_id,))
+        cursor.execute(
+            "INSERT INTO access_events (employee_id, laboratory_id, event_type, success, reason, method) VALUES (?, ?, 'exit', TRUE, ?, 'auto')",
+            (employee_id, row['laboratory_id'], OVERSTAY_REASON)
+        )
+        exited.append([employee_id, entry_time])
+        publish_invalidation(cursor, 'presence', employee_id)
+    return exited
+
+
+def fire_overstays(batch):
+    """Запись событий превышения (и выходов при OVERSTAY_AUTO_EXIT) одной транзакцией.
+
+    Уникальность (employee_id, entry_time) не даёт записать событие дважды,
+    если таймеры работают в нескольких процессах.
+    """
+    exited = submit_write(
+        'overstays',
+        batch=[[employee_id, entry_time, due.strftime('%Y-%m-%d %H:%M:%S')] for employee_id, entry_time, due in batch],
+        auto_exit=OVERSTAY_AUTO_EXIT
+    )
+
+    for employee_id, entry_time in exited:
+        registry_exit(employee_id, entry_time)
+    return len(exited)
+
+
+def run_overstay_monitor():
+    """Цикл фонового потока: ждёт ближайший срок и обрабатывает наступившие таймеры пачками"""
+    while True:
+        with overstay_condition:
+            now = datetime.now()
+            batch = pop_due_overstays(now)
+            if not batch:
+                heap = overstay_timers['heap']
+                timeout = (heap[0][0] - now).total_seconds() if heap else OVERSTAY_MAX_SLEEP_SECONDS
+                overstay_condition.wait(min(timeout, OVERSTAY_MAX_SLEEP_SECONDS))
+                continue
+        try:
+            fire_overstays(batch)
+        except Exception as e:
+            print(f"Ошибка при обработке превышения времени пребывания: {e}")
+
+
+def start_overstay_monitor():
+    """Запуск фонового потока контроля превышения (один раз на процесс)"""
+    with overstay_condition:
+        if overstay_timers['thread'] is not None:
+            return
+        thread = threading.Thread(target=run_overstay_monitor, name='overstay-monitor', daemon=True)
+        overstay_timers['thread'] = thread
+    thread.start()
+
+
+def get_overstays():
+    """Сотрудники, находящиеся в лаборатории дольше разрешённого (из памяти)"""
+    with overstay_condition:
+        fired = dict(overstay_timers['fired'])
+    people = [person for person in get_presence() if person['employee_id'] in fired]
+    now = datetime.now()
+    for person in people:
+        person['overstay_minutes'] = int((now - fired[person['employee_id']]).total_seconds() // 60)
+    return people
+
+
+# Причины в событиях проверки доступа (/api/check_access)
+CHECK_ALLOWED_REASON = 'По расписанию'
+CHECK_DENIED_REASON = 'Нет доступа в это время'
+
+# Подписи типов событий в отчётах и экспорте
+EVENT_TYPE_LABELS = {'entry': 'Вход', 'entry_denied': 'Вход', 'exit': 'Выход', 'check': 'Проверка'}
+
+
+def migrate_check_events(cursor):
+    """Перевод проверок доступа, записанных раньше как 'entry'/'entry_denied', в тип 'check'.
+
+    Успешная проверка открывала визит, который никогда не закрывался. Проходы через
+    терминал причину входа не пишут, поэтому проверки отличаются по причине.
+    Возвращает True, если такие события были.
+    """
+    cursor.execute('''
+        UPDATE access_events SET event_type = 'check'
+        WHERE method = 'pin'
+            AND ((event_type = 'entry' AND success = TRUE AND reason = ?)
+                 OR (event_type = 'entry_denied' AND reason = ?))
+    ''', (CHECK_ALLOWED_REASON, CHECK_DENIED_REASON))
+    return cursor.rowcount > 0
+
+
+def toggle_presence(cursor, employee_id, laboratory_id, expected_exit):
+    """Вход или выход сотрудника в открытой транзакции записи; возвращает 'entry' или 'exit'.
+
+    Реестр в памяти обновляется вызывающим после фиксации транзакции.
+    """
+    if HAS_RETURNING:
+        cursor.execute("DELETE FROM current_presence WHERE employee_id = ? RETURNING id", (employee_id,))
+        exited = cursor.fetchone() is not None
+    else:
+        cursor.execute("DELETE FROM current_presence WHERE employee_id = ?", (employee_id,))
+        exited = cursor.rowcount > 0
+
+    if exited:
+        return 'exit'
+
+    cursor.execute('''
+        INSERT INTO current_presence (employee_id, laboratory_id, expected_exit_time) VALUES (?, ?, ?)
+        ON CONFLICT(employee_id) DO NOTHING
+    ''', (employee_id, laboratory_id, expected_exit))
+    return 'entry'
+
+
+@write_command('deny')
+def write_denied_swipe(cursor, employee_id, laboratory_id, reason, method):
+    """Команда записи: отказ в доступе"""
+    cursor.execute(
+        "INSERT INTO access_events (employee_id, laboratory_id, event_type, success, reason, method) VALUES (?, ?, 'entry', FALSE, ?, ?)",
+        (employee_id, laboratory_id, reason, method)
+    )
+
+
+@write_command('check')
+def write_access_check(cursor, employee_id, laboratory_id, has_access):
+    """Команда записи: событие проверки PIN-кода через /api/check_access.
+
+    Проверка не проход: событие 'check' не меняет присутствие и не открывает визит.
+    """
+    cursor.execute('''
+        INSERT INTO access_events (employee_id, laboratory_id, event_type, success, reason, method)
+        VALUES (?, ?, 'check', ?, ?, 'pin')
+    ''', (
+        employee_id,
+        laboratory_id,
+        has_access,
+        CHECK_ALLOWED_REASON if has_access else CHECK_DENIED_REASON
+    ))
+
+
+@write_command('swipe', sync=True)
+def write_swipe(cursor, employee_id, laboratory_id, method, expected_exit):
+    """Команда записи: вход или выход и событие; возвращает {'action', 'record'}.
+
+    Выполняется в транзакции записи, взятой сразу (BEGIN IMMEDIATE),
+    поэтому два терминала с одним PIN не увидят одновременно "не внутри".
+    """
+    action = toggle_presence(cursor, employee_id, laboratory_id, expected_exit)
+
+    record = None
+    if action == 'entry':
+        cursor.execute('''
+            SELECT cp.employee_id, cp.laboratory_id, cp.entry_time, cp.expected_exit_time,
+                   e.full_name, e.department, e.position
+            FROM current_presence cp
+            JOIN employees e ON cp.employee_id = e.id
+            WHERE cp.employee_id = ?
+        ''', (employee_id,))
+        record = presence_record(cursor.fetchone())
+
+    # Логируем событие
+    cursor.execute(
+        "INSERT INTO access_events (employee_id, laboratory_id, event_type, success, method) VALUES (?, ?, ?, TRUE, ?)",
+        (employee_id, laboratory_id, action, method)
+    )
+    publish_invalidation(cursor, 'presence', employee_id)
+    return {'action': action, 'record': record}
+
+
+def verify_access(employee_id, laboratory_id, method='pin'):
+    """Проверка доступа сотрудника в лабораторию: (успех, сообщение, 'entry'/'exit' или None)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    now = datetime.now()
+
+    # Проверяем расписание дня с учётом календаря исключений
+    reason, expected_exit = check_schedule(cursor, employee_id, laboratory_id, now)
+
+    if reason:
+        # Логируем отказ в доступе
+        submit_write('deny', employee_id=employee_id, laboratory_id=laboratory_id, reason=reason, method=method)
+        if reason == 'Нет расписания доступа':
+            message = "Доступ в эту лабораторию не разрешён"
+        elif reason == 'День недели не разрешен':
+            message = "Доступ в этот день недели не разрешен"
+        elif reason == EXCEPTION_CLOSED_REASON:
+            message = "Доступ закрыт по календарю исключений"
+        else:
+            message = describe_day_schedule(cursor, employee_id, laboratory_id, now)
+        conn.close()
+        return False, message, None
+
+    conn.close()
+
+    result = submit_write(
+        'swipe', employee_id=employee_id, laboratory_id=laboratory_id, method=method,
+        expected_exit=expected_exit.strftime('%Y-%m-%d %H:%M:%S') if expected_exit else None
+    )
+    action, record = result['action'], result['record']
+    message = "Выход выполнен" if action == 'exit' else "Вход разрешён"
+
+    # Реестр меняется только после успешной записи в базу
+    if record:
+        registry_enter(record)
+    else:
+        registry_exit(employee_id)
+
+    return True, message, action
+
+
+# Защита от повторных проходов: двойное нажатие Enter или повторное чтение карты в течение
+# SWIPE_DEBOUNCE_SECONDS возвращает первое решение, не записывая событие и не меняя присутствие.
+# Повтор запроса с тем же request_id (например, после обрыва связи) узнаётся SWIPE_REQUEST_ID_TTL_SECONDS.
+SWIPE_DEBOUNCE_SECONDS = 3
+SWIPE_REQUEST_ID_TTL_SECONDS = 300
+SWIPE_CACHE_SIZE = 10000
+SWIPE_LOCK_STRIPES = 64
+
+# Записи добавляются в конец в порядке времени, поэтому устаревшие всегда в начале словаря
+swipe_cache = {'swipes': OrderedDict(), 'requests': OrderedDict(), 'repeats': 0}
+swipe_cache_lock = threading.Lock()
+# Повторы одного сотрудника у одной двери обрабатываются последовательно
+swipe_locks = [threading.Lock() for _ in range(SWIPE_LOCK_STRIPES)]
+
+
+def swipe_cache_get(cache, key, ttl, now):
+    """Решение из кэша повторов с удалением устаревших записей; вызывается под swipe_cache_lock"""
+    while cache:
+        stored_at = next(iter(cache.values()))[0]
+        if now - stored_at < ttl and len(cache) <= SWIPE_CACHE_SIZE:
+            break
+        cache.popitem(last=False)
+    entry = cache.get(key)
+    return entry[1] if entry else None
+
+
+def swipe_cache_put(cache, key, decision, now):
+    """Сохранение решения в конец кэша; вызывается под swipe_cache_lock"""
+    cache.pop(key, None)
+    cache[key] = (now, decision)
+
+
+def debounced_verify_access(employee_id, laboratory_id, method='pin', request_id=None):
+    """verify_access() с подавлением повторов: (успех, сообщение, действие, повтор)"""
+    key = (employee_id, laboratory_id)
+    request_key = (employee_id, laboratory_id, request_id) if request_id else None
+
+    with swipe_locks[hash(key) % SWIPE_LOCK_STRIPES]:
+        now = time_module.monotonic()
+        with swipe_cache_lock:
+            decision = None
+            if request_key:
+                decision = swipe_cache_get(swipe_cache['requests'], request_key, SWIPE_REQUEST_ID_TTL_SECONDS, now)
+            if decision is None:
+                decision = swipe_cache_get(swipe_cache['swipes'], key, SWIPE_DEBOUNCE_SECONDS, now)
+            if decision is not None:
+                swipe_cache['repeats'] += 1
+                return decision + (True,)
+
+        decision = verify_access(employee_id, laboratory_id, method)
+
+        now = time_module.monotonic()
+        with swipe_cache_lock:
+            swipe_cache_put(swipe_cache['swipes'], key, decision, now)
+            if request_key:
+                swipe_cache_put(swipe_cache['requests'], request_key, decision, now)
+        return decision + (False,)
+
+
+# Ограничение перебора PIN-кодов. Для каждого IP и терминала хранится кольцевой буфер
+# времён последних неудачных попыток размером с лимит: если после записи очередной неудачи
+# самая старая из них моложе окна, в окне набралось лимит неудач и ключ блокируется на
+# PIN_LOCKOUT_SECONDS. Отклонённые PIN-коды кэшируются,
+# чтобы повторный перебор тех же значений не обращался к базе. Терминал - это id
+# зарегистрированного терминала из его токена: значение из тела запроса (например,
+# laboratory_id) ключом не служит, иначе любой клиент мог бы заблокировать чужую дверь.
+# Запросы без токена терминала ограничиваются только по IP.
+PIN_LIMIT_WINDOW_SECONDS = 60
+PIN_LIMIT_MAX_FAILURES_IP = 10
+PIN_LIMIT_MAX_FAILURES_TERMINAL = 20
+PIN_LOCKOUT_SECONDS = 300
+PIN_REJECTED_CACHE_SECONDS = 60
+PIN_LIMIT_MAX_KEYS = 10000
+
+pin_limiter = {
+    'windows': {'ip': OrderedDict(), 'terminal': OrderedDict()},  # ключ -> [array времён, позиция]
+    'lockouts': {},  # (вид, ключ) -> момент снятия блокировки
+    'rejected_pins': OrderedDict(),  # PIN -> момент истечения
+    'metrics': {'checked': 0, 'failures': 0, 'lockouts': 0, 'rejected_locked': 0, 'rejected_cached': 0}
+}
+pin_limiter_lock = threading.Lock()
+PIN_LIMITS = {'ip': PIN_LIMIT_MAX_FAILURES_IP, 'terminal': PIN_LIMIT_MAX_FAILURES_TERMINAL}
+
+
+def pin_limiter_keys(client_ip, terminal):
+    """Ключи ограничителя: IP и, для зарегистрированного терминала, его id"""
+    keys = [('ip', client_ip)]
+    if terminal is not None:
+        keys.append(('terminal', terminal))
+    return keys
+
+
+def pin_limiter_check(client_ip, terminal, pin_code=None):
+    """Проверка до обращения к базе: 'locked', 'rejected' или None (pin_code - HMAC PIN-кода)"""
+    now = time_module.monotonic()
+    with pin_limiter_lock:
+        metrics = pin_limiter['metrics']
+        metrics['checked'] += 1
+        lockouts = pin_limiter['lockouts']
+        for lock_key in pin_limiter_keys(client_ip, terminal):
+            until = lockouts.get(lock_key)
+            if until is None:
+                continue
+            if until > now:
+                metrics['rejected_locked'] += 1
+                return 'locked'
+            del lockouts[lock_key]
+
+        if pin_code is not None:
+            rejected = pin_limiter['rejected_pins']
+            while rejected and next(iter(rejected.values())) <= now:
+                rejected.popitem(last=False)
+            if pin_code in rejected:
+                metrics['rejected_cached'] += 1
+                return 'rejected'
+    return None
+
+
+def pin_limiter_failure(client_ip, terminal, pin_code=None):
+    """Учёт неудачной попытки; True, если IP или терминал заблокированы"""
+    now = time_module.monotonic()
+    locked = False
+    with pin_limiter_lock:
+        pin_limiter['metrics']['failures'] += 1
+        if pin_code is not None:
+            rejected = pin_limiter['rejected_pins']
+            rejected.pop(pin_code, None)
+            rejected[pin_code] = now + PIN_REJECTED_CACHE_SECONDS
+            if len(rejected) > PIN_LIMIT_MAX_KEYS:
+                rejected.popitem(last=False)
+
+        for kind, key in pin_limiter_keys(client_ip, terminal):
+            windows = pin_limiter['windows'][kind]
+            window = windows.pop(key, None)
+            if window is None:
+                window = [array('d', [float('-inf')] * PIN_LIMITS[kind]), 0]
+            windows[key] = window
+            if len(windows) > PIN_LIMIT_MAX_KEYS:
+                windows.popitem(last=False)
+
+            times, position = window
+            times[position] = now
+            window[1] = (position + 1) % len(times)
+            # Следующая позиция - самая старая из последних PIN_LIMITS[kind] неудач, включая эту
+            if now - times[window[1]] < PIN_LIMIT_WINDOW_SECONDS:
+                pin_limiter['lockouts'][(kind, key)] = now + PIN_LOCKOUT_SECONDS
+                pin_limiter['metrics']['lockouts'] += 1
+                window[0] = array('d', [float('-inf')] * len(times))
+                locked = True
+    return locked
+
+
+def clear_rejected_pins():
+    """Сброс кэша отклонённых PIN-кодов после изменения сотрудников"""
+    with pin_limiter_lock:
+        pin_limiter['rejected_pins'].clear()
+
+
+def get_pin_limiter_metrics():
+    """Счётчики ограничителя и действующие блокировки"""
+    now = time_module.monotonic()
+    with pin_limiter_lock:
+        lockouts = [
+            {'kind': kind, 'key': key, 'seconds_left': int(until - now)}
+            for (kind, key), until in pin_limiter['lockouts'].items() if until > now
+        ]
+        return dict(
+            pin_limiter['metrics'],
+            tracked_ips=len(pin_limiter['windows']['ip']),
+            tracked_terminals=len(pin_limiter['windows']['terminal']),
+            rejected_pins_cached=len(pin_limiter['rejected_pins']),
+            active_lockouts=lockouts
+        )
+
+
+def get_statistics():
+    """Получение статистики для дашборда"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    # Счётчики поддерживаются триггерами, поэтому таблицы не сканируются
+    counters = read_counters(cursor)
+
+    # Событий сегодня
+    today = datetime.now().strftime('%Y-%m-%d')
+    cursor.execute("SELECT events FROM daily_event_counters WHERE day = ?", (today,))
+    row = cursor.fetchone()
+    today_events = row[0] if row else 0
+
+    conn.close()
+
+    return {
+        'employees_count': counters['employees_active'],
+        'labs_count': counters['laboratories_active'],
+        'active_count': counters['current_presence_total'],
+        'today_events': today_events
+    }
+
+
+def next_day(date_str):
+    """Дата следующего дня в формате YYYY-MM-DD"""
+    return (datetime.strptime(date_str, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def aggregate_access_events(cursor, date_from, date_to, prev_date_from=None, prev_date_to=None):
+    """Однопроходная агрегация событий доступа для графиков статистики.
+
+    Все ряды (итоги, посещаемость по дням, лаборатории, часы, отказы и итоги
+    периода сравнения) собираются из ОДНОГО запроса к access_events: таблица
+    сканируется по индексу idx_access_events_time в диапазоне, покрывающем
+    оба периода, и сворачивается в группы (день, час, лаборатория, тип,
+    успех, причина). Дальнейшая раскладка по рядам делается в Python по
+    небольшому сгруппированному результату.
+
+    Граница на запрос: 1 проход по access_events + чтение справочника laboratories.
+    """
+    scan_from = min(date_from, prev_date_from) if prev_date_from else date_from
+    scan_to = max(date_to, prev_date_to) if prev_date_to else date_to
+
+    cursor.execute('''
+        SELECT
+            DATE(event_time) as day,
+            strftime('%H', event_time) as hour,
+            laboratory_id,
+            event_type,
+            success,
+            reason,
+            COUNT(*) as count
+        FROM access_events
+        WHERE event_time >= ? AND event_time < ?
+        GROUP BY day, hour, laboratory_id, event_type, success, reason
+    ''', (scan_from, next_day(scan_to)))
+
+    current = {
+        'total_events': 0,
+        'successful_entries': 0,
+        'denials': 0,
+        'by_day': {},
+        'hourly': [0] * 24,
+        'labs': {},
+        'denial_reasons': {}
+    }
+    previous = {
+        'total_events': 0,
+        'successful_entries': 0,
+        'denials': 0
+    }
+
+    for row in cursor.fetchall():
+        day = row['day']
+        count = row['count']
+        is_entry = row['event_type'] == 'entry' and row['success']
+        is_exit = row['event_type'] == 'exit' and row['success']
+        is_denial = not row['success']
+
+        if prev_date_from and prev_date_from <= day <= prev_date_to:
+            previous['total_events'] += count
+            if is_entry:
+                previous['successful_entries'] += count
+            if is_denial:
+                previous['denials'] += count
+
+        if not (date_from <= day <= date_to):
+            continue
+
+        current['total_events'] += count
+        current['hourly'][int(row['hour'])] += count
+
+        day_counts = current['by_day'].setdefault(day, [0, 0, 0])
+        if is_entry:
+            current['successful_entries'] += count
+            day_counts[0] += count
+            lab_id = row['laboratory_id']
+            current['labs'][lab_id] = current['labs'].get(lab_id, 0) + count
+        elif is_exit:
+            day_counts[1] += count
+        if is_denial:
+            current['denials'] += count
+            day_counts[2] += count
+            reason = row['reason']
+            current['denial_reasons'][reason] = current['denial_reasons'].get(reason, 0) + count
+
+    cursor.execute("SELECT id, name FROM laboratories")
+    current['lab_names'] = {row['id']: row['name'] for row in cursor.fetchall()}
+
+    return {'current': current, 'previous': previous}
+
+
+def group_daily_counts(by_day, group_by='day'):
+    """Группировка дневных счётчиков (входы, выходы) по дням, неделям или месяцам"""
+    grouped = {}
+    for day in sorted(by_day):
+        if group_by == 'week':
+            key = datetime.strptime(day, '%Y-%m-%d').strftime('%Y-%W')
+        elif group_by == 'month':
+            key = day[:7]
+        else:
+            key = day
+        counts = grouped.setdefault(key, [0, 0])
+        counts[0] += by_day[day][0]
+        counts[1] += by_day[day][1]
+
+    return [(key, counts[0], counts[1]) for key, counts in grouped.items()]
+
+
+def top_laboratories(aggregate, limit):
+    """Лаборатории с наибольшим числом успешных входов из агрегата"""
+    labs = [
+        (aggregate['lab_names'][lab_id], count)
+        for lab_id, count in aggregate['labs'].items()
+        if lab_id in aggregate['lab_names']
+    ]
+    labs.sort(key=lambda item: item[1], reverse=True)
+    return labs[:limit]
+
+
+def top_denial_reasons(aggregate, limit, skip_unknown=False):
+    """Самые частые причины отказов из агрегата"""
+    reasons = {}
+    for reason, count in aggregate['denial_reasons'].items():
+        if reason is None:
+            if skip_unknown:
+                continue
+            reason = 'Не указана'
+        reasons[reason] = reasons.get(reason, 0) + count
+
+    return sorted(reasons.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+def get_engine_state(cursor, name, default=0):
+    """Чтение служебного значения (например, последнего обработанного события)"""
+    cursor.execute("SELECT value FROM engine_state WHERE name = ?", (name,))
+    row = cursor.fetchone()
+    return row[0] if row else default
+
+
+def set_engine_state(cursor, name, value):
+    """Сохранение служебного значения"""
+    cursor.execute('''
+        INSERT INTO engine_state (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = excluded.value
+    ''', (name, value))
+
+
+def parse_event_time(value):
+    """Преобразование времени события из строки SQLite в datetime"""
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+def utc_now():
+    """Текущий момент в базе времени событий и визитов (UTC, как CURRENT_TIMESTAMP)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def utc_event_time(moment):
+    """Момент в базе времени событий (UTC); время без смещения считается местным временем сервера"""
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def init_visits(cursor):
+    """Создание таблицы визитов (пар вход/выход) и её индексов"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS visits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            employee_id INTEGER NOT NULL,
+            laboratory_id INTEGER NOT NULL,
+            entry_event_id INTEGER NOT NULL,
+            exit_event_id INTEGER,
+            entered_at TIMESTAMP NOT NULL,
+            exited_at TIMESTAMP,
+            duration_seconds INTEGER,
+            status TEXT NOT NULL DEFAULT 'open',
+            FOREIGN KEY (employee_id) REFERENCES employees (id),
+            FOREIGN KEY (laboratory_id) REFERENCES laboratories (id)
+        )
+    ''')
+    # status: 'open' - сотрудник внутри, 'closed' - есть выход,
+    # 'unpaired' - следующий вход пришёл раньше выхода
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_visits_entered ON visits(entered_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_visits_lab_entered ON visits(laboratory_id, entered_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_visits_employee_entered ON visits(employee_id, entered_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_visits_lab_exited ON visits(laboratory_id, exited_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_visits_employee_exited ON visits(employee_id, exited_at)")
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_visits_open
+        ON visits(employee_id) WHERE status = 'open'
+    ''')
+
+
+def sync_visits(cursor):
+    """Инкрементальное сопоставление событий входа и выхода в визиты.
+
+    Обрабатываются только события с id больше последнего обработанного,
+    поэтому вызов после каждого прохода через терминал стоит O(новых событий).
+    Возвращает количество обработанных событий.
+    """
+    last_event_id = get_engine_state(cursor, 'visits_last_event_id')
+
+    cursor.execute('''
+        SELECT id, employee_id, laboratory_id, event_type, event_time
+        FROM access_events
+        WHERE id > ? AND success = TRUE AND event_type IN ('entry', 'exit')
+        ORDER BY id
+    ''', (last_event_id,))
+    events = cursor.fetchall()
+    pair_visit_events(cursor, events)
+
+    cursor.execute("SELECT MAX(id) FROM access_events")
+    max_event_id = cursor.fetchone()[0] or 0
+    if max_event_id > last_event_id:
+        set_engine_state(cursor, 'visits_last_event_id', max_event_id)
+
+    return len(events)
+
+
+def pair_visit_events(cursor, events):
+    """Сопоставление событий (id, сотрудник, лаборатория, тип, время) с открытыми визитами"""
+    for event in events:
+        event_id, employee_id, laboratory_id, event_type, event_time = tuple(event)
+
+        cursor.execute('''
+            SELECT id, entered_at FROM visits
+            WHERE employee_id = ? AND status = 'open'
+        ''', (employee_id,))
+        open_visit = cursor.fetchone()
+
+        if event_type == 'entry':
+            if open_visit:
+                # Выход не был зарегистрирован - визит без пары
+                cursor.execute("UPDATE visits SET status = 'unpaired' WHERE id = ?", (open_visit[0],))
+            cursor.execute('''
+                INSERT INTO visits (employee_id, laboratory_id, entry_event_id, entered_at, status)
+                VALUES (?, ?, ?, ?, 'open')
+            ''', (employee_id, laboratory_id, event_id, event_time))
+        elif open_visit:
+            duration = (parse_event_time(event_time) - parse_event_time(open_visit[1])).total_seconds()
+            cursor.execute('''
+                UPDATE visits
+                SET exit_event_id = ?, exited_at = ?, duration_seconds = ?, status = 'closed'
+                WHERE id = ?
+            ''', (event_id, event_time, max(int(duration), 0), open_visit[0]))
+
+
+def rebuild_visits(cursor):
+    """Полное перестроение визитов по всей истории событий"""
+    cursor.execute("DELETE FROM visits")
+    set_engine_state(cursor, 'visits_last_event_id', 0)
+    return sync_visits(cursor)
+
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по отсортированному списку (линейная интерполяция)"""
+    if not sorted_values:
+        return 0
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def get_dwell_time_stats(cursor, date_from, date_to, laboratory_id=None):
+    """Статистика времени пребывания по закрытым визитам за период"""
+    query = '''
+        SELECT duration_seconds FROM visits
+        WHERE entered_at >= ? AND entered_at < ? AND status = 'closed'
+    '''
+    params = [date_from, next_day(date_to)]
+    if laboratory_id:
+        query += " AND laboratory_id = ?"
+        params.append(laboratory_id)
+
+    cursor.execute(query + " ORDER BY duration_seconds", params)
+    durations = [row[0] / 3600.0 for row in cursor.fetchall()]
+
+    return {
+        'visits': len(durations),
+        'avg_hours': round(sum(durations) / len(durations), 2) if durations else 0,
+        'median_hours': round(percentile(durations, 0.5), 2),
+        'p90_hours': round(percentile(durations, 0.9), 2),
+        'max_hours': round(durations[-1], 2) if durations else 0
+    }
+
+
+def get_lab_utilisation(cursor, date_from, date_to):
+    """Загрузка лабораторий: человеко-часы визитов относительно вместимости за период"""
+    cursor.execute('''
+        SELECT
+            l.id,
+            l.name,
+            l.capacity,
+            COUNT(v.id) as visits,
+            COALESCE(SUM(v.duration_seconds), 0) / 3600.0 as person_hours
+        FROM laboratories l
+        LEFT JOIN visits v ON v.laboratory_id = l.id
+            AND v.entered_at >= ? AND v.entered_at < ? AND v.status = 'closed'
+        WHERE l.is_active = TRUE
+        GROUP BY l.id
+        ORDER BY person_hours DESC
+    ''', (date_from, next_day(date_to)))
+
+    period_hours = ((datetime.strptime(date_to, '%Y-%m-%d') - datetime.strptime(date_from, '%Y-%m-%d')).days + 1) * 24
+
+    labs = []
+    for row in cursor.fetchall():
+        lab = dict(row)
+        lab['avg_hours'] = round(lab['person_hours'] / lab['visits'], 2) if lab['visits'] else 0
+        lab['utilisation_percent'] = round(
+            lab['person_hours'] / (lab['capacity'] * period_hours) * 100, 1
+        ) if lab['capacity'] else 0
+        lab['person_hours'] = round(lab['person_hours'], 2)
+        labs.append(lab)
+
+    return labs
+
+
+def load_visit_intervals(cursor, where, params, range_start, range_end):
+    """Визиты, пересекающие [range_start, range_end), в виде интервалов
+    (id визита, сотрудник, лаборатория, начало, конец); where ограничивает выборку"""
+    now = utc_now()
+    start = range_start.strftime('%Y-%m-%d %H:%M:%S')
+    end = range_end.strftime('%Y-%m-%d %H:%M:%S')
+    # Закрытые визиты ищутся по времени выхода, открытые - по частичному индексу
+    # idx_visits_open (их немного): по entered_at пришлось бы пройти всю историю
+    cursor.execute(f'''
+        SELECT id, employee_id, laboratory_id, entered_at, exited_at
+        FROM visits
+        WHERE status = 'closed' AND exited_at > ? AND entered_at < ? AND {where}
+        UNION ALL
+        SELECT id, employee_id, laboratory_id, entered_at, exited_at
+        FROM visits INDEXED BY idx_visits_open
+        WHERE status = 'open' AND entered_at < ? AND {where}
+    ''', (start, end, *params, end, *params))
+
+    intervals = []
+    for visit_id, employee_id, laboratory_id, entered_at, exited_at in cursor.fetchall():
+        # Открытый визит длится до текущего момента
+        end = parse_event_time(exited_at) if exited_at else now
+        intervals.append((visit_id, employee_id, laboratory_id, parse_event_time(entered_at), end))
+    return intervals
+
+
+def sweep_overlaps(targets, others):
+    """Пересечения интервалов двух наборов методом сортировки и заметания.
+
+    Оба набора - интервалы одной лаборатории. Возвращает генератор пар
+    (интервал из targets, интервал из others, начало и конец пересечения).
+    """
+    points = sorted(
+        [(interval[3], 0, interval) for interval in targets] +
+        [(interval[3], 1, interval) for interval in others],
+        key=lambda point: (point[0], point[1])
+    )
+    active = ([], [])
+
+    for start, kind, interval in points:
+        opposite = active[1 - kind]
+        # Удаляем интервалы, закончившиеся до начала текущего
+        opposite[:] = [item for item in opposite if item[4] > start]
+        for item in opposite:
+            target, other = (interval, item) if kind == 0 else (item, interval)
+            overlap_end = min(target[4], other[4])
+            if overlap_end > start:
+                yield target, other, start, overlap_end
+        active[kind].append(interval)
+
+
+def find_contacts(cursor, employee_id, date_from, date_to):
+    """Все пересечения визитов сотрудника с визитами других сотрудников в тех же лабораториях"""
+    window_start = datetime.strptime(date_from, '%Y-%m-%d')
+    window_end = datetime.strptime(next_day(date_to), '%Y-%m-%d')
+
+    targets = [
+        interval for interval in load_visit_intervals(
+            cursor, "employee_id = ?", (employee_id,), window_start, window_end
+        )
+        if interval[4] > window_start
+    ]
+
+    by_lab = {}
+    for interval in targets:
+        # Пересечения считаем только внутри окна расследования
+        clipped = interval[:3] + (max(interval[3], window_start), min(interval[4], window_end))
+        by_lab.setdefault(interval[2], []).append(clipped)
+
+    for laboratory_id, lab_targets in by_lab.items():
+        range_start = min(interval[3] for interval in lab_targets)
+        range_end = max(interval[4] for interval in lab_targets)
+        others = load_visit_intervals(
+            cursor, "laboratory_id = ? AND employee_id != ?", (laboratory_id, employee_id), range_start, range_end
+        )
+        others = [interval for interval in others if interval[4] > range_start]
+
+        for target, other, overlap_start, overlap_end in sweep_overlaps(lab_targets, others):
+            yield {
+                'laboratory_id': laboratory_id,
+                'employee_visit_id': target[0],
+                'contact_employee_id': other[1],
+                'contact_visit_id': other[0],
+                'contact_entered_at': other[3].strftime('%Y-%m-%d %H:%M:%S'),
+                'contact_exited_at': other[4].strftime('%Y-%m-%d %H:%M:%S'),
+                'overlap_start': overlap_start.strftime('%Y-%m-%d %H:%M:%S'),
+                'overlap_end': overlap_end.strftime('%Y-%m-%d %H:%M:%S'),
+                'overlap_seconds': int((overlap_end - overlap_start).total_seconds())
+            }
+
+
+def init_timesheets(cursor):
+    """Создание таблицы табеля: отработанное время по сотруднику, лаборатории и дню"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS timesheet_days (
+            day DATE NOT NULL,
+            employee_id INTEGER NOT NULL,
+            laboratory_id INTEGER NOT NULL,
+            worked_seconds INTEGER NOT NULL DEFAULT 0,
+            visits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, employee_id, laboratory_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_visits_exit_event ON visits(exit_event_id)")
+
+
+def split_visit_by_days(entered_at, exited_at):
+    """Разбиение интервала визита на части по календарным дням: [(день, секунды), ...].
+
+    Время визита хранится в UTC, а дни табеля - местные, как и расписания:
+    интервал переводится в местное время и делится в местную полночь.
+    """
+    parts = []
+    start = entered_at.replace(tzinfo=timezone.utc).astimezone()
+    finish = exited_at.replace(tzinfo=timezone.utc).astimezone()
+    while start < finish:
+        midnight = datetime.combine(start.date() + timedelta(days=1), time.min).astimezone()
+        end = min(midnight, finish)
+        parts.append((start.strftime('%Y-%m-%d'), int((end - start).total_seconds())))
+        start = end.astimezone()
+    return parts
+
+
+def sync_timesheets(cursor):
+    """Инкрементальное пополнение табеля закрытыми визитами.
+
+    Визит попадает в табель в момент закрытия, поэтому водяной знак ведётся
+    по id события выхода. Визит через полночь делится между днями.
+    """
+    last_exit_event_id = get_engine_state(cursor, 'timesheets_last_exit_event_id')
+
+    cursor.execute('''
+        SELECT employee_id, laboratory_id, entered_at, exited_at, exit_event_id
+        FROM visits
+        WHERE status = 'closed' AND exit_event_id > ?
+        ORDER BY exit_event_id
+    ''', (last_exit_event_id,))
+    visits = cursor.fetchall()
+
+    for visit in visits:
+        employee_id, laboratory_id, entered_at, exited_at, exit_event_id = tuple(visit)
+        parts = split_visit_by_days(parse_event_time(entered_at), parse_event_time(exited_at))
+        for index, (day, seconds) in enumerate(parts):
+            cursor.execute('''
+                INSERT INTO timesheet_days (day, employee_id, laboratory_id, worked_seconds, visits)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(day, employee_id, laboratory_id) DO UPDATE SET
+                    worked_seconds = worked_seconds + excluded.worked_seconds,
+                    visits = visits + excluded.visits
+            ''', (day, employee_id, laboratory_id, seconds, 1 if index == 0 else 0))
+
+    if visits:
+        set_engine_state(cursor, 'timesheets_last_exit_event_id', visits[-1][4])
+
+    return len(visits)
+
+
+def rebuild_timesheets(cursor):
+    """Полное перестроение табеля по закрытым визитам"""
+    cursor.execute("DELETE FROM timesheet_days")
+    set_engine_state(cursor, 'timesheets_last_exit_event_id', 0)
+    return sync_timesheets(cursor)
+
+
+# Интервал между контрольными точками присутствия (по времени событий)
+PRESENCE_CHECKPOINT_MINUTES = 15
+
+
+def init_presence_checkpoints(cursor):
+    """Создание таблицы контрольных точек присутствия"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS presence_checkpoints (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            last_event_id INTEGER NOT NULL,
+            last_event_time TIMESTAMP NOT NULL,
+            employees_count INTEGER NOT NULL,
+            snapshot TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_presence_checkpoints_time
+        ON presence_checkpoints(last_event_time)
+    ''')
+
+
+def apply_presence_event(state, employee_id, laboratory_id, event_type, event_time):
+    """Применение события к состоянию присутствия {employee_id: [laboratory_id, entry_time]}"""
+    if event_type == 'entry':
+        state[str(employee_id)] = [laboratory_id, event_time]
+    else:
+        state.pop(str(employee_id), None)
+
+
+def sync_presence_checkpoints(cursor):
+    """Создание контрольных точек присутствия по новым событиям.
+
+    Состояние воспроизводится от последней точки в порядке (время события, id),
+    новая точка сохраняется каждый раз, когда время события уходит на
+    PRESENCE_CHECKPOINT_MINUTES дальше предыдущей. Если новых точек не требуется,
+    стоит один поиск по индексу.
+    """
+    cursor.execute('''
+        SELECT last_event_id, last_event_time, snapshot
+        FROM presence_checkpoints
+        ORDER BY last_event_time DESC, last_event_id DESC
+        LIMIT 1
+    ''')
+    checkpoint = cursor.fetchone()
+    interval = timedelta(minutes=PRESENCE_CHECKPOINT_MINUTES)
+
+    if checkpoint:
+        last_event_id, last_event_time, snapshot = tuple(checkpoint)
+        checkpoint_time = parse_event_time(last_event_time)
+        cursor.execute("SELECT MAX(event_time) FROM access_events")
+        newest = cursor.fetchone()[0]
+        if not newest or parse_event_time(newest) < checkpoint_time + interval:
+            return 0
+        state = json.loads(snapshot)
+    else:
+        last_event_id, last_event_time, checkpoint_time, state = 0, '', None, {}
+
+    cursor.execute('''
+        SELECT id, employee_id, laboratory_id, event_type, event_time
+        FROM access_events
+        WHERE (event_time > ? OR (event_time = ? AND id > ?))
+            AND success = TRUE AND event_type IN ('entry', 'exit')
+        ORDER BY event_time, id
+    ''', (last_event_time, last_event_time, last_event_id))
+
+    created = 0
+    for event_id, employee_id, laboratory_id, event_type, event_time in cursor.fetchall():
+        apply_presence_event(state, employee_id, laboratory_id, event_type, event_time)
+        moment = parse_event_time(event_time)
+        if checkpoint_time is None or moment >= checkpoint_time + interval:
+            cursor.execute('''
+                INSERT INTO presence_checkpoints (last_event_id, last_event_time, employees_count, snapshot)
+                VALUES (?, ?, ?, ?)
+            ''', (event_id, event_time, len(state), json.dumps(state, separators=(',', ':'))))
+            checkpoint_time = moment
+            created += 1
+
+    return created
+
+
+def get_presence_at(cursor, at, laboratory_id=None):
+    """Кто находился в лабораториях в момент at: ближайшая точка + события после неё"""
+    cursor.execute('''
+        SELECT last_event_id, last_event_time, snapshot FROM presence_checkpoints
+        WHERE last_event_time <= ?
+        ORDER BY last_event_time DESC, last_event_id DESC
+        LIMIT 1
+    ''', (at,))
+    checkpoint = cursor.fetchone()
+    if checkpoint:
+        last_event_id, last_event_time, state = checkpoint[0], checkpoint[1], json.loads(checkpoint[2])
+    else:
+        last_event_id, last_event_time, state = 0, '', {}
+
+    cursor.execute('''
+        SELECT employee_id, laboratory_id, event_type, event_time
+        FROM access_events
+        WHERE (event_time > ? OR (event_time = ? AND id > ?)) AND event_time <= ?
+            AND success = TRUE AND event_type IN ('entry', 'exit')
+        ORDER BY event_time, id
+    ''', (last_event_time, last_event_time, last_event_id, at))
+    replayed = 0
+    for employee_id, lab_id, event_type, event_time in cursor.fetchall():
+        apply_presence_event(state, employee_id, lab_id, event_type, event_time)
+        replayed += 1
+
+    presence = [
+        {'employee_id': int(employee_id), 'laboratory_id': lab_id, 'entry_time': entry_time}
+        for employee_id, (lab_id, entry_time) in state.items()
+        if not laboratory_id or lab_id == laboratory_id
+    ]
+    presence.sort(key=lambda item: item['entry_time'])
+    return presence, replayed
+
+
+def sync_event_views(cursor):
+    """Обновление всех производных от access_events таблиц (визиты, табель, точки присутствия)"""
+    sync_visits(cursor)
+    sync_timesheets(cursor)
+    sync_presence_checkpoints(cursor)
+
+
+def reprocess_late_events(cursor, employee_ids, since):
+    """Пересчёт производных таблиц после событий, записанных задним числом.
+
+    Автономный терминал присылает события с большими id, но ранним временем, а
+    инкрементальные синхронизации идут по id. Поэтому визиты сотрудников заново
+    сопоставляются в порядке (время, id), начиная с последнего визита до since,
+    их табель пересчитывается по дням, а точки присутствия и кэш заполненности
+    после since удаляются.
+    """
+    sync_event_views(cursor)
+    earliest = since
+
+    for employee_id in employee_ids:
+        # Визит, начатый до since, мог закрыться (или остаться без пары) из-за поздних событий
+        cursor.execute(
+            "SELECT MAX(entered_at) FROM visits WHERE employee_id = ? AND entered_at < ?",
+            (employee_id, since)
+        )
+        start = cursor.fetchone()[0] or since
+        earliest = min(earliest, start)
+
+        cursor.execute("DELETE FROM visits WHERE employee_id = ? AND entered_at >= ?", (employee_id, start))
+        cursor.execute('''
+            SELECT id, employee_id, laboratory_id, event_type, event_time
+            FROM access_events
+            WHERE employee_id = ? AND event_time >= ? AND success = TRUE AND event_type IN ('entry', 'exit')
+            ORDER BY event_time, id
+        ''', (employee_id, start))
+        pair_visit_events(cursor, cursor.fetchall())
+
+        # Дни табеля местные: пересчёт с местного дня начала, визиты - с его полуночи по UTC
+        first_day = local_event_time(start).strftime('%Y-%m-%d')
+        first_day_start = utc_event_time(datetime.strptime(first_day, '%Y-%m-%d')).strftime('%Y-%m-%d %H:%M:%S')
+        cursor.execute("DELETE FROM timesheet_days WHERE employee_id = ? AND day >= ?", (employee_id, first_day))
+        cursor.execute('''
+            SELECT laboratory_id, entered_at, exited_at FROM visits
+            WHERE employee_id = ? AND status = 'closed' AND exited_at > ?
+        ''', (employee_id, first_day_start))
+        for laboratory_id, entered_at, exited_at in cursor.fetchall():
+            parts = split_visit_by_days(parse_event_time(entered_at), parse_event_time(exited_at))
+            for index, (day, seconds) in enumerate(parts):
+                if day < first_day:
+                    continue
+                cursor.execute('''
+                    INSERT INTO timesheet_days (day, employee_id, laboratory_id, worked_seconds, visits)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(day, employee_id, laboratory_id) DO UPDATE SET
+                        worked_seconds = worked_seconds + excluded.worked_seconds,
+                        visits = visits + excluded.visits
+                ''', (day, employee_id, laboratory_id, seconds, 1 if index == 0 else 0))
+
+    # Все закрытые визиты уже учтены в табеле
+    cursor.execute("SELECT MAX(id) FROM access_events")
+    set_engine_state(cursor, 'timesheets_last_exit_event_id', cursor.fetchone()[0] or 0)
+
+    cursor.execute("DELETE FROM presence_checkpoints WHERE last_event_time >= ?", (earliest,))
+    sync_presence_checkpoints(cursor)
+    cursor.execute("DELETE FROM occupancy_days WHERE day >= ?", (local_event_time(earliest).strftime('%Y-%m-%d'),))
+
+
+# Параметры расчёта заполненности лабораторий
+OCCUPANCY_SLOT_MINUTES = 15
+OCCUPANCY_SLOTS_PER_DAY = 24 * 60 // OCCUPANCY_SLOT_MINUTES
+
+
+def init_occupancy(cursor):
+    """Создание кэша заполненности лабораторий по закрытым дням"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS occupancy_days (
+            day DATE NOT NULL,
+            laboratory_id INTEGER NOT NULL,
+            peak BLOB NOT NULL,
+            average BLOB NOT NULL,
+            PRIMARY KEY (day, laboratory_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def sweep_occupancy(intervals, days):
+    """Заполненность по слотам методом заметающей прямой.
+
+    intervals - список (начало, конец) в секундах от начала диапазона. Возвращает
+    два списка длиной days * OCCUPANCY_SLOTS_PER_DAY: пиковое число людей в
+    слоте и среднее по времени.
+    """
+    slot_seconds = OCCUPANCY_SLOT_MINUTES * 60
+    total_slots = days * OCCUPANCY_SLOTS_PER_DAY
+    range_end = total_slots * slot_seconds
+
+    deltas = []
+    for start, end in intervals:
+        start = max(start, 0)
+        end = min(end, range_end)
+        if start < end:
+            deltas.append((start, 1))
+            deltas.append((end, -1))
+    # При совпадении времени выход обрабатывается раньше входа
+    deltas.sort()
+
+    peak = [0] * total_slots
+    area = [0] * total_slots
+    level = 0
+    position = 0
+
+    def advance(until):
+        nonlocal position
+        while position < until:
+            slot = position // slot_seconds
+            step_end = min(until, (slot + 1) * slot_seconds)
+            if level:
+                area[slot] += level * (step_end - position)
+                if level > peak[slot]:
+                    peak[slot] = level
+            position = step_end
+
+    for moment, delta in deltas:
+        advance(moment)
+        level += delta
+        if moment < range_end and level > peak[moment // slot_seconds]:
+            peak[moment // slot_seconds] = level
+    advance(range_end)
+
+    average = [round(value / slot_seconds, 2) for value in area]
+    return peak, average
+
+
+def compute_occupancy(cursor, laboratory_ids, date_from, date_to):
+    """Расчёт заполненности по дням для лабораторий одним проходом по визитам диапазона.
+
+    Границы дней - местная полночь, визиты ищутся по её времени в UTC и
+    раскладываются по слотам в местном времени.
+    """
+    range_start = datetime.strptime(date_from, '%Y-%m-%d')
+    range_end = datetime.strptime(next_day(date_to), '%Y-%m-%d')
+    days = (range_end - range_start).days
+
+    # Смещение местного времени меняется только на границе часа: перевод по часу, а не по визиту
+    offsets = {}
+
+    def local_seconds(moment):
+        """Секунды от начала диапазона по местным часам для момента в UTC"""
+        hour = moment.replace(minute=0, second=0, microsecond=0)
+        offset = offsets.get(hour)
+        if offset is None:
+            offset = offsets[hour] = local_event_time(hour) - hour
+        return int((moment + offset - range_start).total_seconds())
+
+    # Визиты любой длины, пересекающие диапазон; открытый визит длится до текущего момента
+    intervals = {lab_id: [] for lab_id in laboratory_ids}
+    placeholders = ','.join('?' * len(laboratory_ids))
+    for _, _, laboratory_id, entered_at, exited_at in load_visit_intervals(
+        cursor, f"laboratory_id IN ({placeholders})", laboratory_ids,
+        utc_event_time(range_start), utc_event_time(range_end)
+    ):
+        intervals[laboratory_id].append((local_seconds(entered_at), local_seconds(exited_at)))
+
+    result = {}
+    for lab_id, lab_intervals in intervals.items():
+        peak, average = sweep_occupancy(lab_intervals, days)
+        for day_index in range(days):
+            day = (range_start + timedelta(days=day_index)).strftime('%Y-%m-%d')
+            start = day_index * OCCUPANCY_SLOTS_PER_DAY
+            end = start + OCCUPANCY_SLOTS_PER_DAY
+            result[(lab_id, day)] = (peak[start:end], average[start:end])
+
+    return result
+
+
+def get_occupancy(cursor, laboratory_ids, date_from, date_to):
+    """Заполненность по дням: закрытые дни читаются из кэша, остальные рассчитываются.
+
+    Дни и слоты - местные, как в расписаниях и табеле; визиты хранятся в UTC.
+    """
+    today = datetime.now().strftime('%Y-%m-%d')
+    placeholders = ','.join('?' * len(laboratory_ids))
+
+    cursor.execute(f'''
+        SELECT day, laboratory_id, peak, average
+        FROM occupancy_days
+        WHERE day >= ? AND day <= ? AND laboratory_id IN ({placeholders})
+    ''', (date_from, date_to, *laboratory_ids))
+
+    result = {}
+    for day, lab_id, peak, average in cursor.fetchall():
+        result[(lab_id, day)] = (
+            array('H', peak).tolist(),
+            [value / 100 for value in array('H', average)]
+        )
+
+    missing = []
+    day = date_from
+    while day <= date_to:
+        for lab_id in laboratory_ids:
+            if (lab_id, day) not in result:
+                missing.append((lab_id, day))
+        day = next_day(day)
+
+    if missing:
+        missing_labs = sorted({lab_id for lab_id, _ in missing})
+        missing_days = [day for _, day in missing]
+        computed = compute_occupancy(cursor, missing_labs, min(missing_days), max(missing_days))
+
+        for key in missing:
+            result[key] = computed[key]
+            lab_id, day = key
+            if day < today:
+                peak, average = computed[key]
+                cursor.execute('''
+                    INSERT OR REPLACE INTO occupancy_days (day, laboratory_id, peak, average)
+                    VALUES (?, ?, ?, ?)
+                ''', (day, lab_id, array('H', peak).tobytes(),
+                      array('H', [round(value * 100) for value in average]).tobytes()))
+
+    return result
+
+
+@app.cli.command('rebuild-timesheets')
+def rebuild_timesheets_command():
+    """Перестроить табель по всей истории визитов"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    processed = rebuild_timesheets(cursor)
+    conn.commit()
+    conn.close()
+    print(f"✅ Табель перестроен, обработано визитов: {processed}")
+
+
+@app.cli.command('rebuild-presence-checkpoints')
+def rebuild_presence_checkpoints_command():
+    """Пересоздать контрольные точки присутствия по всей истории событий"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM presence_checkpoints")
+    created = sync_presence_checkpoints(cursor)
+    conn.commit()
+    conn.close()
+    print(f"✅ Контрольные точки присутствия пересозданы: {created}")
+
+
+@app.cli.command('backfill-visits')
+def backfill_visits_command():
+    """Перестроить визиты по всей истории событий доступа"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    processed = rebuild_visits(cursor)
+    rebuild_timesheets(cursor)
+    cursor.execute("DELETE FROM occupancy_days")
+    conn.commit()
+    conn.close()
+    print(f"✅ Визиты перестроены, обработано событий: {processed}")
+
+
+def migrate_old_data():
+    """Миграция старых данных из старого формата в новый"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    try:
+        # Проверяем, существует ли столбец day_of_week
+        cursor.execute("PRAGMA table_info(access_schedules)")
+        columns = [col[1] for col in cursor.fetchall()]
+
+        if 'day_of_week' in columns and 'days_of_week' not in columns:
+            print("🔄 Обнаружена старая структура данных, начинаю миграцию...")
+
+            # Создаем временную таблицу для группировки данных
+            cursor.execute('''
+                SELECT employee_id, laboratory_id, 
+                       GROUP_CONCAT(day_of_week) as days_of_week,
+                       time_start, time_end
+                FROM access_schedules
+                GROUP BY employee_id, laboratory_id, time_start, time_end
+            ''')
+
+            grouped_data = cursor.fetchall()
+
+            # Создаем новую таблицу
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS access_schedules_new (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    employee_id INTEGER,
+                    laboratory_id INTEGER,
+                    days_of_week TEXT,
+                    time_start TIME,
+                    time_end TIME,
+                    FOREIGN KEY (employee_id) REFERENCES employees (id),
+                    FOREIGN KEY (laboratory_id) REFERENCES laboratories (id),
+                    UNIQUE(employee_id, laboratory_id)
+                )
+            ''')
+
+            # Вставляем новые данные
+            for row in grouped_data:
+                cursor.execute('''
+                    INSERT INTO access_schedules_new 
+                    (employee_id, laboratory_id, days_of_week, time_start, time_end)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (row[0], row[1], row[2], row[3], row[4]))
+
+            # Триггеры движка расписаний ссылаются на access_schedules и мешают переименованию
+            for name in SCHEDULE_TRIGGERS:
+                cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+            # Удаляем старую таблицу и переименовываем новую
+            cursor.execute("DROP TABLE access_schedules")
+            cursor.execute("ALTER TABLE access_schedules_new RENAME TO access_schedules")
+
+            # Триггеры старой таблицы удалены вместе с ней
+            init_counters(cursor)
+            reconcile_counters(cursor)
+            init_schedule_engine(cursor)
+
+            conn.commit()
+            print("✅ Миграция данных завершена успешно")
+        else:
+            print("✅ Структура данных уже обновлена")
+
+    except Exception as e:
+        print(f"❌ Ошибка миграции данных: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+# Маршруты приложения
+@app.route('/')
+def index():
+    return render_template('index.html',
+                           MIN_PIN_LENGTH=MIN_PIN_LENGTH,
+                           MAX_PIN_LENGTH=MAX_PIN_LENGTH)
+
+
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    if request.method == 'POST':
+        login = request.form.get('username', '').strip()
+        password = request.form.get('password', '').strip()
+
+        user = validate_credentials(login, password)
+
+        if user:
+            session['user_id'] = user['id']
+            session['user_name'] = user['full_name']
+            session['user_type'] = user['user_type']
+
+            if user['user_type'] == 'admin':
+                return redirect(url_for('admin_dashboard'))
+            else:
+                return redirect(url_for('employee_dashboard'))
+        else:
+            flash('Неверный логин или пароль', 'danger')
+
+    return render_template('login.html')
+
+
+@app.route('/logout')
+def logout():
+    session.clear()
+    return redirect(url_for('index'))
+
+
+@app.route('/terminal')
+def terminal():
+    return render_template('terminal.html',
+                           min_pin_length=MIN_PIN_LENGTH,
+                           max_pin_length=MAX_PIN_LENGTH)
+
+
+@app.route('/employee/dashboard')
+@login_required
+def employee_dashboard():
+    if session.get('user_type') == 'admin':
+        return redirect(url_for('admin_dashboard'))
+
+    conn = get_db_connection()
+
+    # Получаем информацию о сотруднике
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM employees WHERE id = ?", (session['user_id'],))
+    employee = employee_public_dict(cursor.fetchone())
+
+    # Получаем последние события сотрудника
+    cursor.execute('''
+        SELECT ae.event_time, l.name, ae.event_type, ae.success
+        FROM access_events ae
+        JOIN laboratories l ON ae.laboratory_id = l.id
+        WHERE ae.employee_id = ?
+        ORDER BY ae.event_time DESC
+        LIMIT 10
+    ''', (session['user_id'],))
+
+    recent_events = [dict(row) for row in cursor.fetchall()]
+
+    # Получаем доступные лаборатории
+    cursor.execute('''
+        SELECT DISTINCT l.* 
+        FROM access_schedules a
+        JOIN laboratories l ON a.laboratory_id = l.id
+        WHERE a.employee_id = ? AND l.is_active = TRUE
+    ''', (session['user_id'],))
+
+    accessible_labs = [dict(row) for row in cursor.fetchall()]
+
+    conn.close()
+
+    return render_template('employee_dashboard.html',
+                           employee=employee,
+                           recent_events=recent_events,
+                           accessible_labs=accessible_labs)
+
+
+# Админ-маршруты
+@app.route('/admin')
+@login_required
+@admin_required
+def admin_dashboard():
+    stats = get_statistics()
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    # Получаем последние события
+    cursor.execute('''
+        SELECT ae.event_time, e.full_name, l.name, ae.event_type, ae.success, ae.reason
+        FROM access_events ae
+        JOIN employees e ON ae.employee_id = e.id
+        JOIN laboratories l ON ae.laboratory_id = l.id
+        ORDER BY ae.event_time DESC
+        LIMIT 20
+    ''')
+
+    recent_events = [dict(row) for row in cursor.fetchall()]
+
+    # Получаем сотрудников в лабораториях
+    cursor.execute('''
+        SELECT cp.entry_time, e.full_name, l.name, l.location
+        FROM current_presence cp
+        JOIN employees e ON cp.employee_id = e.id
+        JOIN laboratories l ON cp.laboratory_id = l.id
+        ORDER BY cp.entry_time DESC
+    ''')
+
+    current_presence = [dict(row) for row in cursor.fetchall()]
+
+    conn.close()
+
+    return render_template('admin_dashboard.html',
+                           stats=stats,
+                           recent_events=recent_events,
+                           current_presence=current_presence,
+                           now=datetime.now())
+
+
+@app.route('/admin/employees')
+@login_required
+@admin_required
+def admin_employees():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    # Получаем сотрудников
+    cursor.execute('''
+        SELECT e.*, 
+               GROUP_CONCAT(DISTINCT l.name) as accessible_labs
+        FROM employees e
+        LEFT JOIN access_schedules a ON e.id = a.employee_id
+        LEFT JOIN laboratories l ON a.laboratory_id = l.id
+        GROUP BY e.id
+        ORDER BY e.created_at DESC
+    ''')
+
+    employees = [employee_public_dict(row) for row in cursor.fetchall()]
+
+    # Получаем список лабораторий для выпадающего списка
+    cursor.execute('''
+        SELECT id, name, code 
+        FROM laboratories 
+        WHERE is_active = TRUE
+        ORDER BY name
+    ''')
+
+    laboratories = [dict(row) for row in cursor.fetchall()]
+
+    conn.close()
+
+    # Дни недели для отображения
+    days_of_week = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
+
+    return render_template('admin_employees.html',
+                           employees=employees,
+                           laboratories=laboratories,
+                           days_of_week=days_of_week,
+                           min_pin_length=MIN_PIN_LENGTH,
+                           max_pin_length=MAX_PIN_LENGTH)
+
+
+@app.route('/admin/laboratories')
+@login_required
+@admin_required
+def admin_laboratories():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT l.*, 
+               COUNT(DISTINCT a.employee_id) as employee_count,
+               COUNT(DISTINCT cp.employee_id) as current_count
+        FROM laboratories l
+        LEFT JOIN access_schedules a ON l.id = a.laboratory_id
+        LEFT JOIN current_presence cp ON l.id = cp.laboratory_id
+        GROUP BY l.id
+        ORDER BY l.name
+    ''')
+
+    laboratories = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+
+    return render_template('admin_laboratories.html', laboratories=laboratories)
+
+
+@app.route('/admin/reports')
+@login_required
+@admin_required
+def admin_reports():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    # Получаем доступные отчеты
+    cursor.execute('''
+        SELECT r.*, e.full_name as created_by_name
+        FROM reports r
+        LEFT JOIN employees e ON r.created_by = e.id
+        ORDER BY r.generated_at DESC
+    ''')
+
+    reports = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+
+    return render_template('admin_reports.html', reports=reports)
+
+
+@app.route('/admin/access_rights')
+@login_required
+@admin_required
+def admin_access_rights():
+    """Страница управления правами доступа"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    # Получаем всех сотрудников с количеством доступных лабораторий
+    cursor.execute('''
+        SELECT e.*, 
+               COUNT(DISTINCT a.id) as accessible_labs_count
+        FROM employees e
+        LEFT JOIN access_schedules a ON e.id = a.employee_id
+        GROUP BY e.id
+        ORDER BY e.full_name
+    ''')
+
+    employees = [employee_public_dict(row) for row in cursor.fetchall()]
+
+    # Получаем все активные лаборатории
+    cursor.execute('''
+        SELECT id, name, code 
+        FROM laboratories 
+        WHERE is_active = TRUE
+        ORDER BY name
+    ''')
+
+    laboratories = [dict(row) for row in cursor.fetchall()]
+
+    conn.close()
+
+    return render_template('admin_access_rights.html',
+                           employees=employees,
+                           laboratories=laboratories)
+
+
+@app.route('/admin/import_export')
+@login_required
+@admin_required
+def admin_import_export():
+    """Страница импорта/экспорта данных"""
+    return render_template('admin_import_export.html')
+
+
+@app.route('/admin/statistics')
+@login_required
+@admin_required
+def admin_statistics():
+    """Страница статистики с графиками"""
+    return render_template('admin_statistics.html')
+
+
+# API маршруты
+def pin_lockout_payload():
+    """Сообщение терминалу при блокировке из-за перебора"""
+    return {
+        'success': False,
+        'message': f'Слишком много неудачных попыток. Повторите через {PIN_LOCKOUT_SECONDS // 60} мин.'
+    }
+
+
+def pin_lockout_response():
+    """Ответ терминалу при блокировке из-за перебора"""
+    return jsonify(pin_lockout_payload()), 429
+
+
+# Реестр терминалов. Каждый физический терминал регистрирует администратор: терминал
+# привязывается к лаборатории и получает собственный токен (в базе хранится только SHA-256).
+# По токену в заголовке X-Terminal-Token сервер знает, какая дверь прислала запрос, и ведёт
+# для неё гистограммы задержек: 'server' - время обработки на сервере, 'client' - полное время
+# ответа, которое терминал измеряет сам и присылает в heartbeat. Если медленный только клиент,
+# виновата дверь (сеть, железо), если и сервер - сервер.
+TERMINAL_LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+TERMINAL_SLOW_MS = 500
+TERMINAL_HEARTBEAT_SECONDS = 30
+TERMINAL_HEARTBEAT_MAX_SAMPLES = 1000
+
+terminal_registry = {'loaded': False, 'by_digest': {}}
+terminal_stats = {}  # terminal_id -> счётчики и гистограммы
+terminal_auth_sets = {}  # laboratory_id -> (версия журнала, {pin_digest: employee_id})
+terminal_registry_lock = threading.Lock()
+
+
+def init_terminals(cursor):
+    """Таблица зарегистрированных терминалов"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS terminals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            laboratory_id INTEGER NOT NULL,
+            token_digest TEXT NOT NULL UNIQUE,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (laboratory_id) REFERENCES laboratories (id)
+        )
+    ''')
+
+
+def terminal_token_digest(token):
+    """SHA-256 токена зарегистрированного терминала"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def load_terminal_registry(cursor):
+    """Загрузка активных терминалов в память"""
+    cursor.execute("SELECT id, name, laboratory_id, token_digest FROM terminals WHERE is_active = TRUE")
+    by_digest = {
+        row['token_digest']: {'id': row['id'], 'name': row['name'], 'laboratory_id': row['laboratory_id']}
+        for row in cursor.fetchall()
+    }
+    with terminal_registry_lock:
+        terminal_registry.update(loaded=True, by_digest=by_digest)
+
+
+def resolve_terminal(token):
+    """Зарегистрированный активный терминал по токену или None"""
+    if not token:
+        return None
+    if not terminal_registry['loaded']:
+        conn = get_db_connection()
+        try:
+            load_terminal_registry(conn.cursor())
+        finally:
+            conn.close()
+    with terminal_registry_lock:
+        return terminal_registry['by_digest'].get(terminal_token_digest(token))
+
+
+def terminal_stats_locked(terminal_id):
+    """Счётчики терминала (создаются при первом обращении)"""
+    stats = terminal_stats.get(terminal_id)
+    if stats is None:
+        buckets = len(TERMINAL_LATENCY_BUCKETS_MS) + 1
+        stats = terminal_stats[terminal_id] = {
+            'requests': 0, 'denied': 0, 'errors': 0, 'network_errors': 0, 'heartbeats': 0,
+            'server': [0] * buckets, 'server_max_ms': 0.0,
+            'client': [0] * buckets, 'client_max_ms': 0.0,
+            'last_seen': None, 'last_error': None
+        }
+    return stats
+
+
+def observe_latency_locked(stats, kind, elapsed_ms):
+    """Учёт одного замера задержки в гистограмме"""
+    stats[kind][bisect_right(TERMINAL_LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+    stats[f'{kind}_max_ms'] = max(stats[f'{kind}_max_ms'], elapsed_ms)
+
+
+def record_terminal_request(terminal_id, elapsed_ms, payload, status):
+    """Учёт запроса терминала: задержка сервера, отказы и ошибки"""
+    with terminal_registry_lock:
+        stats = terminal_stats_locked(terminal_id)
+        stats['requests'] += 1
+        stats['last_seen'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        observe_latency_locked(stats, 'server', elapsed_ms)
+        if status >= 400:
+            stats['errors'] += 1
+            stats['last_error'] = payload.get('message')
+        elif not payload.get('success'):
+            stats['denied'] += 1
+
+
+def latency_percentile(histogram, max_ms, fraction):
+    """Верхняя граница интервала гистограммы, в который попадает перцентиль (мс)"""
+    total = sum(histogram)
+    if not total:
+        return None
+    threshold = total * fraction
+    seen = 0
+    for index, count in enumerate(histogram):
+        seen += count
+        if seen >= threshold:
+            return TERMINAL_LATENCY_BUCKETS_MS[index] if index < len(TERMINAL_LATENCY_BUCKETS_MS) else round(max_ms)
+    return round(max_ms)
+
+
+def prefetch_terminal_auth(laboratory_id):
+    """Загрузка допуска лаборатории (HMAC PIN -> сотрудник); возвращает (записей, версия).
+
+    Допуск перечитывается, только если версия журнала terminal_changes ушла вперёд
+    с прошлой загрузки, поэтому heartbeat без изменений стоит одного чтения версии.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # Версия и данные читаются в одной транзакции
+    cursor.execute("BEGIN")
+    version = terminal_sync_version(cursor)
+    with terminal_registry_lock:
+        cached = terminal_auth_sets.get(laboratory_id)
+    if not cached or cached[0] != version:
+        cursor.execute('''
+            SELECT DISTINCT e.id, e.pin_digest
+            FROM effective_windows w
+            JOIN employees e ON e.id = w.employee_id
+            WHERE w.laboratory_id = ? AND e.is_active = TRUE
+        ''', (laboratory_id,))
+        cached = (version, {row['pin_digest']: row['id'] for row in cursor.fetchall()})
+        with terminal_registry_lock:
+            terminal_auth_sets[laboratory_id] = cached
+    conn.commit()
+    conn.close()
+    return len(cached[1]), cached[0]
+
+
+def terminal_auth_lookup(laboratory_id, digest):
+    """Сотрудник по HMAC PIN из предзагруженного допуска или None, если его там нет"""
+    with terminal_registry_lock:
+        cached = terminal_auth_sets.get(laboratory_id)
+        return cached[1].get(digest) if cached else None
+
+
+def invalidate_terminal_prefetch():
+    """Сброс предзагруженного допуска после смены PIN, блокировки или удаления сотрудника"""
+    with terminal_registry_lock:
+        terminal_auth_sets.clear()
+
+
+def terminal_heartbeat(terminal, report):
+    """Heartbeat терминала: задержки, измеренные терминалом, и обновление предзагрузки допуска"""
+    samples = report.get('latency_ms') or []
+    if not isinstance(samples, list):
+        samples = []
+
+    with terminal_registry_lock:
+        stats = terminal_stats_locked(terminal['id'])
+        stats['heartbeats'] += 1
+        stats['last_seen'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        for sample in samples[:TERMINAL_HEARTBEAT_MAX_SAMPLES]:
+            if isinstance(sample, (int, float)) and sample >= 0:
+                observe_latency_locked(stats, 'client', float(sample))
+        network_errors = report.get('network_errors')
+        if isinstance(network_errors, int) and network_errors > 0:
+            stats['network_errors'] += network_errors
+
+    # Первый heartbeat загружает допуск лаборатории, следующие - только если он изменился
+    prefetched, version = prefetch_terminal_auth(terminal['laboratory_id'])
+    return {
+        'success': True,
+        'terminal_id': terminal['id'],
+        'laboratory_id': terminal['laboratory_id'],
+        'prefetched': prefetched,
+        'version': version,
+        'heartbeat_seconds': TERMINAL_HEARTBEAT_SECONDS
+    }
+
+
+def get_terminal_metrics():
+    """Телеметрия терминалов: перцентили задержек, счётчики и диагноз медленной двери"""
+    with terminal_registry_lock:
+        names = {terminal['id']: terminal for terminal in terminal_registry['by_digest'].values()}
+        snapshot = {terminal_id: dict(stats, server=list(stats['server']), client=list(stats['client']))
+                    for terminal_id, stats in terminal_stats.items()}
+
+    terminals = []
+    for terminal_id, stats in sorted(snapshot.items()):
+        server_p95 = latency_percentile(stats['server'], stats['server_max_ms'], 0.95)
+        client_p95 = latency_percentile(stats['client'], stats['client_max_ms'], 0.95)
+        if server_p95 is not None and server_p95 > TERMINAL_SLOW_MS:
+            slow = 'server'
+        elif client_p95 is not None and client_p95 > TERMINAL_SLOW_MS:
+            slow = 'door'
+        else:
+            slow = None
+        terminal = names.get(terminal_id, {})
+        terminals.append({
+            'terminal_id': terminal_id,
+            'name': terminal.get('name'),
+            'laboratory_id': terminal.get('laboratory_id'),
+            'requests': stats['requests'],
+            'denied': stats['denied'],
+            'errors': stats['errors'],
+            'network_errors': stats['network_errors'],
+            'heartbeats': stats['heartbeats'],
+            'last_seen': stats['last_seen'],
+            'last_error': stats['last_error'],
+            'server_p50_ms': latency_percentile(stats['server'], stats['server_max_ms'], 0.5),
+            'server_p95_ms': server_p95,
+            'client_p50_ms': latency_percentile(stats['client'], stats['client_max_ms'], 0.5),
+            'client_p95_ms': client_p95,
+            'histogram_buckets_ms': list(TERMINAL_LATENCY_BUCKETS_MS),
+            'server_histogram': stats['server'],
+            'client_histogram': stats['client'],
+            'slow': slow
+        })
+
+    return {
+        'slow_threshold_ms': TERMINAL_SLOW_MS,
+        'terminals': terminals,
+        'slow_terminals': [item['terminal_id'] for item in terminals if item['slow']]
+    }
+
+
+def request_laboratory_id(data, terminal):
+    """Лаборатория прохода: от зарегистрированного терминала или явно из запроса, иначе None"""
+    if terminal:
+        return terminal['laboratory_id']
+    try:
+        return int(data['laboratory_id'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def decide_pin_swipe(client_ip, terminal_id, laboratory_id, pin_code, request_id=None):
+    """Решение по PIN-коду для HTTP и WebSocket терминалов: (ответ, HTTP-статус).
+
+    terminal_id - id зарегистрированного терминала или None.
+    """
+    # Перебор отсекается до обращения к базе; в памяти и в базе только HMAC
+    digest = pin_digest(pin_code)
+    verdict = pin_limiter_check(client_ip, terminal_id, digest)
+    if verdict == 'locked':
+        return pin_lockout_payload(), 429
+
+    employee_id = None
+    if verdict is None:
+        # Сначала допуск, предзагруженный по heartbeat терминала, затем база
+        employee_id = terminal_auth_lookup(laboratory_id, digest)
+
+    if verdict is None and employee_id is None:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        cursor.execute(
+            "SELECT id FROM employees WHERE pin_digest = ? AND is_active = TRUE",
+            (digest,)
+        )
+
+        employee = cursor.fetchone()
+        conn.close()
+        employee_id = employee['id'] if employee else None
+
+    if employee_id is None:
+        if pin_limiter_failure(client_ip, terminal_id, digest):
+            return pin_lockout_payload(), 429
+        return {'success': False, 'message': 'Неверный PIN-код'}, 200
+
+    success, message, action, repeated = debounced_verify_access(employee_id, laboratory_id, 'pin', request_id)
+    return {'success': success, 'message': message, 'action': action, 'repeated': repeated}, 200
+
+
+def verify_access_request(data, terminal):
+    """Проход через терминал по PIN-коду или логину/паролю: (ответ, HTTP-статус)"""
+    # Необязательный идентификатор запроса терминала для безопасных повторов
+    request_id = str(data.get('request_id') or request.headers.get('X-Request-Id') or '').strip() or None
+
+    laboratory_id = request_laboratory_id(data, terminal)
+    if laboratory_id is None:
+        return {'success': False, 'message': 'Не указана лаборатория'}, 400
+    if terminal and data.get('laboratory_id') not in (None, terminal['laboratory_id']):
+        return {'success': False, 'message': 'Терминал привязан к другой лаборатории'}, 403
+
+    terminal_id = terminal['id'] if terminal else None
+
+    # Поддержка разных методов аутентификации
+    if 'pin_code' in data:
+        # Аутентификация по PIN-коду
+        pin_code = str(data.get('pin_code', '')).strip()
+        return decide_pin_swipe(request.remote_addr, terminal_id, laboratory_id, pin_code, request_id)
+
+    elif 'login' in data and 'password' in data:
+        # Аутентификация по логину/паролю
+        login = data.get('login', '').strip()
+        password = data.get('password', '').strip()
+
+        if pin_limiter_check(request.remote_addr, terminal_id) == 'locked':
+            return pin_lockout_payload(), 429
+
+        user = validate_credentials(login, password)
+
+        if not user:
+            if pin_limiter_failure(request.remote_addr, terminal_id):
+                return pin_lockout_payload(), 429
+            return {
+                'success': False,
+                'message': 'Неверный логин или пароль'
+            }, 200
+
+        success, message, action, repeated = debounced_verify_access(user['id'], laboratory_id, 'login', request_id)
+    else:
+        return {
+            'success': False,
+            'message': 'Неверный формат запроса'
+        }, 200
+
+    return {
+        'success': success,
+        'message': message,
+        'action': action,
+        'repeated': repeated
+    }, 200
+
+
+@app.route('/api/verify_access', methods=['POST'])
+def api_verify_access():
+    """API для проверки доступа через терминал"""
+    started = time_module.monotonic()
+    # Зарегистрированный терминал определяет лабораторию, ключ ограничителя перебора
+    # и получает свою телеметрию; без токена лаборатория берётся из laboratory_id
+    terminal = resolve_terminal(request.headers.get('X-Terminal-Token', '').strip())
+    try:
+        data = request.get_json()
+        payload, status = verify_access_request(data, terminal)
+
+    except Exception as e:
+        print(f"Ошибка API: {e}")
+        payload, status = {
+            'success': False,
+            'message': 'Внутренняя ошибка сервера'
+        }, 500
+
+    if terminal:
+        record_terminal_request(terminal['id'], (time_module.monotonic() - started) * 1000, payload, status)
+    return jsonify(payload), status
+
+
+@app.route('/api/terminal/heartbeat', methods=['POST'])
+def api_terminal_heartbeat():
+    """Heartbeat зарегистрированного терминала"""
+    terminal = resolve_terminal(request.headers.get('X-Terminal-Token', '').strip())
+    if not terminal:
+        return jsonify({'success': False, 'message': 'Терминал не зарегистрирован'}), 403
+
+    return jsonify(terminal_heartbeat(terminal, request.get_json(silent=True) or {}))
+
+
+# Канал терминалов по WebSocket (/ws/terminal, нужен пакет flask-sock).
+# Зарегистрированный терминал один раз представляется сообщением
+#   {"type": "hello", "token": "..."}
+# и дальше отправляет проходы {"type": "swipe", "pin_code": "1234", "request_id": "..."},
+# получая {"type": "decision", ...}. При любом изменении присутствия в его лаборатории
+# сервер сам присылает {"type": "presence", ...}, поэтому опрос HTTP не нужен.
+# Токен идёт только в приветствии: в адресе соединения он попал бы в журналы доступа.
+# Все исходящие сообщения соединения отправляет один поток, ждущий очередь, поэтому
+# рассылка уходит сразу, а приём не опрашивается по таймауту.
+TERMINAL_HELLO_TIMEOUT_SECONDS = 10
+
+terminal_channels = {}  # laboratory_id -> множество очередей исходящих сообщений
+terminal_channels_lock = threading.Lock()
+
+
+def terminal_presence_message(laboratory_id):
+    """Сообщение о присутствии в лаборатории для терминала"""
+    people = [
+        {'full_name': person['full_name'], 'entry_time': person['entry_time']}
+        for person in get_presence(laboratory_id)
+    ]
+    return {'type': 'presence', 'laboratory_id': laboratory_id, 'count': len(people), 'people': people}
+
+
+def notify_terminals(laboratory_id):
+    """Рассылка присутствия подключённым терминалам лаборатории"""
+    with terminal_channels_lock:
+        outboxes = list(terminal_channels.get(laboratory_id, ()))
+    if not outboxes:
+        return
+    message = json.dumps(terminal_presence_message(laboratory_id), ensure_ascii=False)
+    for outbox in outboxes:
+        outbox.put(message)
+
+
+def handle_terminal_message(laboratory_id, message, client_ip, terminal=None):
+    """Ответ на сообщение терминала после приветствия"""
+    message_type = message.get('type')
+
+    if message_type == 'swipe':
+        pin_code = str(message.get('pin_code', '')).strip()
+        if not pin_code:
+            return {'type': 'error', 'message': 'Не указан PIN-код'}
+        request_id = str(message.get('request_id') or '').strip() or None
+        started = time_module.monotonic()
+        payload, status = decide_pin_swipe(
+            client_ip, terminal['id'] if terminal else None, laboratory_id, pin_code, request_id
+        )
+        if terminal:
+            record_terminal_request(terminal['id'], (time_module.monotonic() - started) * 1000, payload, status)
+        return dict(payload, type='decision', request_id=request_id)
+
+    if message_type == 'heartbeat' and terminal:
+        return dict(terminal_heartbeat(terminal, message), type='heartbeat')
+
+    if message_type == 'ping':
+        return {'type': 'pong'}
+
+    return {'type': 'error', 'message': 'Неизвестный тип сообщения'}
+
+
+def terminal_reply(laboratory_id, message, client_ip, terminal):
+    """Ответ на сообщение терминала; ошибка обработки не разрывает соединение"""
+    if not message:
+        return {'type': 'error', 'message': 'Неверный формат сообщения'}
+    try:
+        return handle_terminal_message(laboratory_id, message, client_ip, terminal)
+    except Exception as e:
+        print(f"Ошибка обработки сообщения терминала: {e}")
+        return {
+            'type': 'error',
+            'message': 'Внутренняя ошибка сервера',
+            'request_id': str(message.get('request_id') or '').strip() or None
+        }
+
+
+def send_terminal_outbox(ws, outbox):
+    """Поток отправки: сообщения из очереди уходят в соединение, None завершает поток"""
+    while True:
+        raw = outbox.get()
+        if raw is None:
+            return
+        try:
+            ws.send(raw)
+        except ConnectionClosed:
+            return
+
+
+def parse_terminal_message(raw):
+    """JSON-объект из сообщения терминала или None"""
+    try:
+        message = json.loads(raw) if raw else None
+    except ValueError:
+        return None
+    return message if isinstance(message, dict) else None
+
+
+if HAS_SOCK:
+    @sock.route('/ws/terminal')
+    def terminal_socket(ws):
+        """Постоянное соединение терминала: проходы и рассылка присутствия"""
+        client_ip = request.remote_addr
+        hello = parse_terminal_message(ws.receive(timeout=TERMINAL_HELLO_TIMEOUT_SECONDS)) or {}
+        terminal = resolve_terminal(str(hello.get('token', '')))
+        laboratory_id = terminal['laboratory_id'] if terminal else None
+
+        laboratory = (get_laboratory_directory() or {}).get(laboratory_id)
+        if (hello.get('type') != 'hello' or not laboratory or not laboratory['is_active']
+                or hello.get('laboratory_id') not in (None, laboratory_id)):
+            ws.send(json.dumps({'type': 'error', 'message': 'Терминал не авторизован'}, ensure_ascii=False))
+            ws.close()
+            return
+
+        outbox = queue.Queue()
+        with terminal_channels_lock:
+            terminal_channels.setdefault(laboratory_id, set()).add(outbox)
+
+        sender = threading.Thread(
+            target=send_terminal_outbox, args=(ws, outbox), name='terminal-sender', daemon=True
+        )
+        sender.start()
+        try:
+            outbox.put(json.dumps({
+                'type': 'welcome',
+                'terminal_id': terminal['id'],
+                'heartbeat_seconds': TERMINAL_HEARTBEAT_SECONDS,
+                'laboratory': {key: laboratory[key] for key in ('id', 'name', 'code', 'location', 'capacity')},
+                'presence': terminal_presence_message(laboratory_id)
+            }, ensure_ascii=False))
+
+            while True:
+                message = parse_terminal_message(ws.receive())
+                outbox.put(json.dumps(terminal_reply(laboratory_id, message, client_ip, terminal), ensure_ascii=False))
+        except ConnectionClosed:
+            pass
+        finally:
+            with terminal_channels_lock:
+                terminal_channels.get(laboratory_id, set()).discard(outbox)
+            outbox.put(None)
+            sender.join(timeout=TERMINAL_HELLO_TIMEOUT_SECONDS)
+
+
+@write_command('register_terminal')
+def write_register_terminal(cursor, name, laboratory_id, token_digest):
+    """Команда записи: регистрация терминала; возвращает его id"""
+    cursor.execute(
+        "INSERT INTO terminals (name, laboratory_id, token_digest) VALUES (?, ?, ?)",
+        (name, laboratory_id, token_digest)
+    )
+    terminal_id = cursor.lastrowid
+    publish_invalidation(cursor, 'terminals')
+    return terminal_id
+
+
+@write_command('revoke_terminal')
+def write_revoke_terminal(cursor, terminal_id):
+    """Команда записи: отзыв токена терминала; возвращает число отключённых"""
+    cursor.execute("UPDATE terminals SET is_active = FALSE WHERE id = ? AND is_active = TRUE", (terminal_id,))
+    revoked = cursor.rowcount
+    publish_invalidation(cursor, 'terminals')
+    return revoked
+
+
+@app.route('/api/admin/terminals', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def api_admin_terminals():
+    """Список зарегистрированных терминалов или регистрация нового (админ)"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        if request.method == 'GET':
+            cursor.execute('''
+                SELECT t.id, t.name, t.laboratory_id, l.name as laboratory_name, t.is_active, t.created_at
+                FROM terminals t
+                LEFT JOIN laboratories l ON t.laboratory_id = l.id
+                ORDER BY t.id
+            ''')
+            terminals = [dict(row) for row in cursor.fetchall()]
+            conn.close()
+
+            metrics = {item['terminal_id']: item for item in get_terminal_metrics()['terminals']}
+            for terminal in terminals:
+                terminal['telemetry'] = metrics.get(terminal['id'])
+
+            return jsonify({'success': True, 'terminals': terminals})
+
+        data = request.get_json() or {}
+        name = str(data.get('name', '')).strip()
+        laboratory_id = request_laboratory_id(data, None)
+        if not name:
+            conn.close()
+            return jsonify({'success': False, 'message': 'Укажите название терминала'}), 400
+        if laboratory_id not in (get_laboratory_directory() or {}):
+            conn.close()
+            return jsonify({'success': False, 'message': 'Лаборатория не найдена'}), 404
+
+        # Токен показывается один раз, в базе остаётся только его SHA-256
+        token = secrets.token_urlsafe(32)
+        terminal_id = submit_write(
+            'register_terminal', name=name, laboratory_id=laboratory_id, token_digest=terminal_token_digest(token)
+        )
+        load_terminal_registry(cursor)
+        conn.close()
+
+        return jsonify({
+            'success': True,
+            'terminal_id': terminal_id,
+            'laboratory_id': laboratory_id,
+            'token': token,
+            'heartbeat_seconds': TERMINAL_HEARTBEAT_SECONDS,
+            # Токен во фрагменте ссылки не отправляется серверу и не попадает в журналы
+            'terminal_url': f"{url_for('terminal', laboratory_id=laboratory_id)}#terminal_token={token}"
+        })
+
+    except Exception as e:
+        print(f"Ошибка при работе с терминалами: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@app.route('/api/admin/terminals/<int:terminal_id>', methods=['DELETE'])
+@login_required
+@admin_required
+def api_admin_terminal_detail(terminal_id):
+    """Отзыв токена терминала (админ)"""
+    revoked = submit_write('revoke_terminal', terminal_id=terminal_id)
+    conn = get_db_connection()
+    load_terminal_registry(conn.cursor())
+    conn.close()
+
+    if not revoked:
+        return jsonify({'success': False, 'message': 'Терминал не найден'}), 404
+
+    with terminal_registry_lock:
+        terminal_stats.pop(terminal_id, None)
+    return jsonify({'success': True, 'message': 'Терминал отключён'})
+
+
+# Автономная работа терминалов. Зарегистрированный терминал скачивает снимок допуска своей
+# лаборатории (terminal_digest -> окна день недели/минуты) и принимает решения сам, пока сервер
+# недоступен. HMAC введённого PIN терминал считает ключом ASKUD_TERMINAL_PIN_KEY, который
+# устанавливается на терминал при монтаже и по API не передаётся; серверный ключ PIN-кодов
+# на терминалы не попадает. Изменения после снимка берутся из журнала
+# terminal_changes, который ведут триггеры: kind = 'employee' - сотрудник (laboratory_id NULL -
+# во всех лабораториях), kind = 'exceptions' - календарь исключений лаборатории (NULL - всех).
+# Время автономных событий передаётся в ISO 8601, желательно со смещением; время без смещения
+# считается местным временем сервера и, как и со смещением, хранится в UTC.
+TERMINAL_CHANGES_RETENTION_DAYS = 30
+TERMINAL_CHANGES_PRUNE_EVERY = 500
+TERMINAL_UPLOAD_MAX_EVENTS = 5000
+TERMINAL_CLOCK_SKEW_SECONDS = 300
+
+TERMINAL_SYNC_TRIGGERS = {
+    'trg_terminal_effective_insert': '''
+        AFTER INSERT ON effective_windows BEGIN
+            INSERT INTO terminal_changes (kind, employee_id, laboratory_id)
+            VALUES ('employee', NEW.employee_id, NEW.laboratory_id);
+        END
+    ''',
+    'trg_terminal_effective_delete': '''
+        AFTER DELETE ON effective_windows BEGIN
+            INSERT INTO terminal_changes (kind, employee_id, laboratory_id)
+            VALUES ('employee', OLD.employee_id, OLD.laboratory_id);
+        END
+    ''',
+    'trg_terminal_employees_update': '''
+        AFTER UPDATE OF terminal_digest, is_active ON employees BEGIN
+            INSERT INTO terminal_changes (kind, employee_id, laboratory_id) VALUES ('employee', NEW.id, NULL);
+        END
+    ''',
+    'trg_terminal_employees_delete': '''
+        AFTER DELETE ON employees BEGIN
+            INSERT INTO terminal_changes (kind, employee_id, laboratory_id) VALUES ('employee', OLD.id, NULL);
+        END
+    ''',
+    'trg_terminal_exceptions_insert': '''
+        AFTER INSERT ON access_exceptions BEGIN
+            INSERT INTO terminal_changes (kind, laboratory_id) VALUES ('exceptions', NEW.laboratory_id);
+        END
+    ''',
+    'trg_terminal_exceptions_update': '''
+        AFTER UPDATE ON access_exceptions BEGIN
+            INSERT INTO terminal_changes (kind, laboratory_id) VALUES ('exceptions', OLD.laboratory_id);
+            INSERT INTO terminal_changes (kind, laboratory_id) VALUES ('exceptions', NEW.laboratory_id);
+        END
+    ''',
+    'trg_terminal_exceptions_delete': '''
+        AFTER DELETE ON access_exceptions BEGIN
+            INSERT INTO terminal_changes (kind, laboratory_id) VALUES ('exceptions', OLD.laboratory_id);
+        END
+    ''',
+    # Изредка при записи удаляем старые записи: терминал, отставший сильнее, получит полный снимок
+    'trg_terminal_changes_prune': f'''
+        AFTER INSERT ON terminal_changes WHEN NEW.version % {TERMINAL_CHANGES_PRUNE_EVERY} = 0 BEGIN
+            DELETE FROM terminal_changes WHERE changed_at < datetime('now', '-{TERMINAL_CHANGES_RETENTION_DAYS} days');
+        END
+    ''',
+}
+
+# Снимки в памяти: {laboratory_id: (версия, снимок)}
+terminal_snapshots = {}
+
+
+def init_terminal_sync(cursor):
+    """Журнал изменений для терминалов, его триггеры и квитанции загруженных событий"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS terminal_changes (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            employee_id INTEGER,
+            laboratory_id INTEGER,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS terminal_offline_receipts (
+            laboratory_id INTEGER NOT NULL,
+            offline_id TEXT NOT NULL,
+            event_id INTEGER,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (laboratory_id, offline_id)
+        ) WITHOUT ROWID
+    ''')
+
+    for name, body in TERMINAL_SYNC_TRIGGERS.items():
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute(f"CREATE TRIGGER {name} {body}")
+
+    # Журнал чистит и триггер при записи; при запуске - на случай долгого простоя
+    cursor.execute(
+        "DELETE FROM terminal_changes WHERE changed_at < datetime('now', ?)",
+        (f'-{TERMINAL_CHANGES_RETENTION_DAYS} days',)
+    )
+
+
+def terminal_sync_version(cursor):
+    """Текущая версия журнала изменений (сохраняется и после очистки журнала)"""
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'terminal_changes'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def terminal_access_entries(cursor, laboratory_id, employee_ids=None):
+    """Записи снимка {employee_id: {'employee_id', 'terminal_digest', 'windows'}} для активных сотрудников"""
+    query = '''
+        SELECT e.id, e.terminal_digest, w.day_mask, w.start_minute, w.end_minute
+        FROM effective_windows w
+        JOIN employees e ON e.id = w.employee_id
+        WHERE w.laboratory_id = ? AND e.is_active = TRUE AND e.terminal_digest IS NOT NULL
+    '''
+    params = [laboratory_id]
+    if employee_ids is not None:
+        query += f" AND e.id IN ({','.join('?' * len(employee_ids))})"
+        params.extend(employee_ids)
+    cursor.execute(query + " ORDER BY e.id, w.start_minute", params)
+
+    entries = {}
+    for employee_id, digest, day_mask, start_minute, end_minute in cursor.fetchall():
+        entry = entries.setdefault(employee_id, {'employee_id': employee_id, 'terminal_digest': digest, 'windows': []})
+        entry['windows'].append([day_mask, start_minute, end_minute])
+    return entries
+
+
+def terminal_exceptions(cursor, laboratory_id):
+    """Действующие и будущие исключения календаря для лаборатории"""
+    cursor.execute('''
+        SELECT id, kind, date_from, date_to, employee_id, time_start, time_end
+        FROM access_exceptions
+        WHERE (laboratory_id = ? OR laboratory_id IS NULL) AND date_to >= DATE('now', 'localtime')
+        ORDER BY date_from, id
+    ''', (laboratory_id,))
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def build_terminal_snapshot(cursor, laboratory_id):
+    """Полный снимок допуска лаборатории; повторно используется, пока версия не изменилась"""
+    version = terminal_sync_version(cursor)
+    cached = terminal_snapshots.get(laboratory_id)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    snapshot = {
+        'laboratory_id': laboratory_id,
+        'version': version,
+        'full': True,
+        'employees': list(terminal_access_entries(cursor, laboratory_id).values()),
+        'exceptions': terminal_exceptions(cursor, laboratory_id)
+    }
+    terminal_snapshots[laboratory_id] = (version, snapshot)
+    return snapshot
+
+
+def build_terminal_delta(cursor, laboratory_id, since):
+    """Изменения для лаборатории после версии since или полный снимок, если журнал уже очищен"""
+    version = terminal_sync_version(cursor)
+    cursor.execute("SELECT MIN(version) FROM terminal_changes")
+    oldest = cursor.fetchone()[0]
+    if since <= 0 or since > version or (since < version and (oldest is None or oldest > since + 1)):
+        return build_terminal_snapshot(cursor, laboratory_id)
+
+    cursor.execute('''
+        SELECT DISTINCT kind, employee_id FROM terminal_changes
+        WHERE version > ? AND version <= ? AND (laboratory_id = ? OR laboratory_id IS NULL)
+    ''', (since, version, laboratory_id))
+    changes = cursor.fetchall()
+    employee_ids = sorted({row['employee_id'] for row in changes if row['kind'] == 'employee'})
+
+    delta = {'laboratory_id': laboratory_id, 'version': version, 'full': False, 'employees': [], 'removed': []}
+    if employee_ids:
+        entries = terminal_access_entries(cursor, laboratory_id, employee_ids)
+        delta['employees'] = [entries[employee_id] for employee_id in employee_ids if employee_id in entries]
+        delta['removed'] = [employee_id for employee_id in employee_ids if employee_id not in entries]
+    if any(row['kind'] == 'exceptions' for row in changes):
+        delta['exceptions'] = terminal_exceptions(cursor, laboratory_id)
+    return delta
+
+
+def offline_event_time(value):
+    """Время автономного события в базе access_events (UTC, как CURRENT_TIMESTAMP).
+
+    Время со смещением переводится в UTC, время без смещения считается местным
+    временем сервера. События из будущего (часы терминала ушли вперёд) отклоняются.
+    """
+    moment = utc_event_time(parse_event_time(str(value)))
+    if moment > utc_now() + timedelta(seconds=TERMINAL_CLOCK_SKEW_SECONDS):
+        raise ValueError(value)
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def local_event_time(event_time):
+    """Местное время сервера для времени события в UTC (для проверки расписания)"""
+    return parse_event_time(event_time).replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+
+def reconcile_offline_presence(cursor, employee_id, uploaded_ids):
+    """Приведение current_presence к последнему по времени событию сотрудника.
+
+    Присутствие меняется, только если последним оказалось загруженное событие:
+    более позднее событие сервера уже отражено в current_presence. Возвращает True,
+    если присутствие изменилось.
+    """
+    cursor.execute('''
+        SELECT id, laboratory_id, event_type, event_time FROM access_events
+        WHERE employee_id = ? AND success = TRUE AND event_type IN ('entry', 'exit')
+        ORDER BY event_time DESC, id DESC
+        LIMIT 1
+    ''', (employee_id,))
+    latest = cursor.fetchone()
+    if not latest or latest['id'] not in uploaded_ids:
+        return False
+
+    if latest['event_type'] == 'exit':
+        cursor.execute("DELETE FROM current_presence WHERE employee_id = ?", (employee_id,))
+        return cursor.rowcount > 0
+
+    cursor.execute(
+        "SELECT 1 FROM current_presence WHERE employee_id = ? AND laboratory_id = ? AND entry_time = ?",
+        (employee_id, latest['laboratory_id'], latest['event_time'])
+    )
+    if cursor.fetchone():
+        return False
+    # Срок выхода считается по расписанию на момент входа, как при проходе через сервер
+    _, expected_exit = check_schedule(
+        cursor, employee_id, latest['laboratory_id'], local_event_time(latest['event_time'])
+    )
+    cursor.execute("DELETE FROM current_presence WHERE employee_id = ?", (employee_id,))
+    cursor.execute(
+        "INSERT INTO current_presence (employee_id, laboratory_id, entry_time, expected_exit_time) VALUES (?, ?, ?, ?)",
+        (employee_id, latest['laboratory_id'], latest['event_time'], expected_exit)
+    )
+    return True
+
+
+def apply_offline_events(cursor, laboratory_id, events):
+    """Запись событий, принятых терминалом автономно; возвращает (принято, повторов, ошибок, сотрудники).
+
+    Время событий приводится к UTC. Визиты, табель и точки присутствия затронутых
+    сотрудников пересчитываются с самого раннего загруженного события, присутствие
+    приводится к последнему по времени событию.
+    """
+    accepted = duplicates = rejected = 0
+    uploaded = {}  # employee_id -> id успешных событий загрузки
+    since = None
+
+    prepared = []
+    for event in events:
+        try:
+            event_time = offline_event_time(event['event_time'])
+            event_type = event['event_type']
+            if event_type not in ('entry', 'exit'):
+                raise ValueError(event_type)
+        except (KeyError, TypeError, ValueError):
+            rejected += 1
+            continue
+        prepared.append((event_time, event_type, event))
+
+    for event_time, event_type, event in sorted(prepared, key=lambda item: item[0]):
+        if event.get('employee_id') is not None:
+            cursor.execute("SELECT id FROM employees WHERE id = ?", (event['employee_id'],))
+        else:
+            cursor.execute("SELECT id FROM employees WHERE terminal_digest = ?", (str(event.get('terminal_digest', '')),))
+        employee = cursor.fetchone()
+        if not employee:
+            rejected += 1
+            continue
+        employee_id = employee['id']
+
+        offline_id = str(event.get('offline_id') or '').strip()
+        if offline_id:
+            cursor.execute(
+                "INSERT OR IGNORE INTO terminal_offline_receipts (laboratory_id, offline_id) VALUES (?, ?)",
+                (laboratory_id, offline_id)
+            )
+            if cursor.rowcount == 0:
+                duplicates += 1
+                continue
+
+        success = bool(event.get('success', True))
+        cursor.execute('''
+            INSERT INTO access_events (employee_id, laboratory_id, event_type, event_time, success, reason, method)
+            VALUES (?, ?, ?, ?, ?, ?, 'offline')
+        ''', (employee_id, laboratory_id, event_type, event_time, success, event.get('reason')))
+        event_id = cursor.lastrowid
+        if offline_id:
+            cursor.execute(
+                "UPDATE terminal_offline_receipts SET event_id = ? WHERE laboratory_id = ? AND offline_id = ?",
+                (event_id, laboratory_id, offline_id)
+            )
+        accepted += 1
+
+        if success:
+            uploaded.setdefault(employee_id, set()).add(event_id)
+            since = min(since or event_time, event_time)
+
+    touched = set()
+    if uploaded:
+        reprocess_late_events(cursor, sorted(uploaded), since)
+        for employee_id, event_ids in uploaded.items():
+            if reconcile_offline_presence(cursor, employee_id, event_ids):
+                touched.add(employee_id)
+
+    return accepted, duplicates, rejected, touched
+
+
+@write_command('offline_events', sync=True)
+def write_offline_events(cursor, laboratory_id, events):
+    """Команда записи: автономные события терминала и присутствие затронутых сотрудников"""
+    accepted, duplicates, rejected, touched = apply_offline_events(cursor, laboratory_id, events)
+
+    records = {}
+    if touched:
+        cursor.execute(f'''
+            SELECT cp.employee_id, cp.laboratory_id, cp.entry_time, cp.expected_exit_time,
+                   e.full_name, e.department, e.position
+            FROM current_presence cp
+            JOIN employees e ON cp.employee_id = e.id
+            WHERE cp.employee_id IN ({','.join('?' * len(touched))})
+        ''', list(touched))
+        records = {row['employee_id']: presence_record(row) for row in cursor.fetchall()}
+    for employee_id in touched:
+        publish_invalidation(cursor, 'presence', employee_id)
+
+    return {
+        'accepted': accepted,
+        'duplicates': duplicates,
+        'rejected': rejected,
+        'presence': [[employee_id, records.get(employee_id)] for employee_id in sorted(touched)]
+    }
+
+
+def terminal_request_laboratory():
+    """Лаборатория зарегистрированного терминала по токену (X-Terminal-Token) или None"""
+    terminal = resolve_terminal(request.headers.get('X-Terminal-Token', '').strip())
+    return terminal['laboratory_id'] if terminal else None
+
+
+@app.route('/api/terminal/snapshot')
+def api_terminal_snapshot():
+    """Полный снимок допуска лаборатории для автономной работы терминала"""
+    laboratory_id = terminal_request_laboratory()
+    if laboratory_id is None:
+        return jsonify({'success': False, 'message': 'Терминал не авторизован'}), 403
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # Снимок читается в одной транзакции, чтобы версия соответствовала данным
+    cursor.execute("BEGIN")
+    snapshot = build_terminal_snapshot(cursor, laboratory_id)
+    conn.commit()
+    conn.close()
+
+    return jsonify(dict(snapshot, success=True))
+
+
+@app.route('/api/terminal/sync')
+def api_terminal_sync():
+    """Изменения допуска после версии since (или полный снимок, если терминал сильно отстал)"""
+    laboratory_id = terminal_request_laboratory()
+    if laboratory_id is None:
+        return jsonify({'success': False, 'message': 'Терминал не авторизован'}), 403
+
+    since = request.args.get('since', 0, type=int)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("BEGIN")
+    delta = build_terminal_delta(cursor, laboratory_id, since)
+    conn.commit()
+    conn.close()
+
+    return jsonify(dict(delta, success=True))
+
+
+@app.route('/api/terminal/events', methods=['POST'])
+def api_terminal_events():
+    """Загрузка событий, записанных терминалом без связи с сервером"""
+    laboratory_id = terminal_request_laboratory()
+    if laboratory_id is None:
+        return jsonify({'success': False, 'message': 'Терминал не авторизован'}), 403
+
+    events = (request.get_json(silent=True) or {}).get('events')
+    if not isinstance(events, list) or len(events) > TERMINAL_UPLOAD_MAX_EVENTS:
+        return jsonify({
+            'success': False,
+            'message': f'Ожидается список events (не более {TERMINAL_UPLOAD_MAX_EVENTS} событий)'
+        }), 400
+
+    try:
+        result = submit_write(
+            'offline_events', laboratory_id=laboratory_id,
+            events=[event for event in events if isinstance(event, dict)]
+        )
+        rejected = result['rejected'] + sum(1 for event in events if not isinstance(event, dict))
+
+        # Реестр присутствия догоняет базу после фиксации
+        for employee_id, record in result['presence']:
+            if record:
+                registry_enter(record)
+            else:
+                registry_exit(employee_id)
+
+        return jsonify({
+            'success': True, 'accepted': result['accepted'], 'duplicates': result['duplicates'], 'rejected': rejected
+        })
+
+    except Exception as e:
+        print(f"Ошибка при загрузке событий терминала: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@app.route('/api/admin/export/pdf/pdfkit', methods=['POST'])
+@login_required
+@admin_required
+def api_export_pdf_pdfkit():
+    """Экспорт в PDF с использованием pdfkit и wkhtmltopdf"""
+    try:
         import pdfkit
         import tempfile
         import os
     except ImportError:
         return jsonify({
             'success': False,
-            'message': 'Для экспорта в PDF требуется установить библиотеку pdfkit: pip install pdfkit'
+            'message': 'Для экспорта в PDF требуется установить библиотеку pdfkit: pip install pdfkit'
+        }), 500
+
+    # Проверяем наличие wkhtmltopdf
+    try:
+        # Пробуем найти wkhtmltopdf в системе
+        wkhtmltopdf_path = None
+        possible_paths = [
+            '/usr/bin/wkhtmltopdf',
+            '/usr/local/bin/wkhtmltopdf',
+            'C:/Program Files/wkhtmltopdf/bin/wkhtmltopdf.exe',
+            'wkhtmltopdf'  # Если в PATH
+        ]
+
+        for path in possible_paths:
+            if os.path.exists(path):
+                wkhtmltopdf_path = path
+                break
+
+        if not wkhtmltopdf_path:
+            return jsonify({
+                'success': False,
+                'message': 'Не найден wkhtmltopdf. Установите его с https://wkhtmltopdf.org/'
+            }), 500
+    except:
+        return jsonify({
+            'success': False,
+            'message': 'Не удалось найти wkhtmltopdf. Установите его с https://wkhtmltopdf.org/'
+        }), 500
+
+    data = request.get_json()
+    report_type = data.get('type', 'daily')
+    report_name = data.get('name', 'Отчет АСКУД')
+    date_start = data.get('period_start')
+    date_end = data.get('period_end')
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    # Определяем период
+    if report_type == 'daily':
+        date_start = date_end = datetime.now().strftime('%Y-%m-%d')
+    elif report_type == 'weekly':
+        date_end = datetime.now().strftime('%Y-%m-%d')
+        date_start = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
+    elif report_type == 'monthly':
+        date_end = datetime.now().strftime('%Y-%m-%d')
+        date_start = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+
+    # Получаем данные
+    query = '''
+        SELECT 
+            ae.event_time,
+            e.full_name,
+            e.department,
+            l.name as laboratory,
+            ae.event_type,
+            ae.success,
+            ae.reason
+        FROM access_events ae
+        JOIN employees e ON ae.employee_id = e.id
+        JOIN laboratories l ON ae.laboratory_id = l.id
+        WHERE DATE(ae.event_time) BETWEEN ? AND ?
+        ORDER BY ae.event_time DESC
+        LIMIT 200
+    '''
+
+    cursor.execute(query, (date_start, date_end))
+    events = [dict(row) for row in cursor.fetchall()]
+
+    conn.close()
+
+    # Создаем HTML
+    html_content = f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="UTF-8">
+        <title>{report_name}</title>
+        <style>
+            body {{ font-family: Arial, sans-serif; padding: 20px; }}
+            h1 {{ text-align: center; color: #333; }}
+            .header {{ text-align: center; margin-bottom: 30px; color: #666; }}
+            .stats {{ background: #f5f5f5; padding: 15px; border-radius: 5px; margin-bottom: 20px; }}
+            table {{ width: 100%; border-collapse: collapse; margin-top: 20px; }}
+            th {{ background-color: #4a6fa5; color: white; padding: 12px; text-align: left; }}
+            td {{ padding: 10px; border-bottom: 1px solid #ddd; }}
+            tr:nth-child(even) {{ background-color: #f9f9f9; }}
+            .success {{ color: green; }}
+            .failure {{ color: red; }}
+            .footer {{ margin-top: 40px; text-align: center; color: #888; font-style: italic; }}
+        </style>
+    </head>
+    <body>
+        <h1>{report_name}</h1>
+        <div class="header">
+            <p>Период: {date_start} - {date_end}</p>
+            <p>Дата генерации: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
+        </div>
+
+        <h3>События доступа:</h3>
+    """
+
+    if events:
+        html_content += """
+        <table>
+            <tr>
+                <th>Дата/Время</th>
+                <th>Сотрудник</th>
+                <th>Лаборатория</th>
+                <th>Тип</th>
+                <th>Статус</th>
+                <th>Причина</th>
+            </tr>
+        """
+
+        for event in events:
+            event_time = event['event_time'][:16]
+            full_name = event['full_name']
+            laboratory = event['laboratory']
+            event_type = EVENT_TYPE_LABELS.get(event['event_type'], event['event_type'])
+            status_class = 'success' if event['success'] else 'failure'
+            status_text = '✓ Успех' if event['success'] else '✗ Отказ'
+            reason = event['reason'] or ''
+
+            html_content += f"""
+            <tr>
+                <td>{event_time}</td>
+                <td>{full_name}</td>
+                <td>{laboratory}</td>
+                <td>{event_type}</td>
+                <td class="{status_class}">{status_text}</td>
+                <td>{reason[:50]}{'...' if len(reason) > 50 else ''}</td>
+            </tr>
+            """
+
+        html_content += """
+        </table>
+        """
+    else:
+        html_content += "<p>Нет данных за указанный период</p>"
+
+    html_content += f"""
+        <div class="footer">
+            <p>Сгенерировано системой контроля доступа АСКУД</p>
+            <p>Всего записей: {len(events)}</p>
+        </div>
+    </body>
+    </html>
+    """
+
+    # Конвертируем HTML в PDF
+    try:
+        options = {
+            'page-size': 'A4',
+            'margin-top': '0.75in',
+            'margin-right': '0.75in',
+            'margin-bottom': '0.75in',
+            'margin-left': '0.75in',
+            'encoding': "UTF-8",
+            'no-outline': None,
+            'quiet': ''
+        }
+
+        # Создаем временный файл для PDF
+        pdf_buffer = io.BytesIO()
+
+        # Используем pdfkit с путем к wkhtmltopdf
+        config = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf_path)
+        pdf = pdfkit.from_string(html_content, False, options=options, configuration=config)
+
+        pdf_buffer.write(pdf)
+        pdf_buffer.seek(0)
+
+        return send_file(
+            pdf_buffer,
+            mimetype='application/pdf',
+            as_attachment=True,
+            download_name=f'{report_name}_{datetime.now().strftime("%Y%m%d")}.pdf'
+        )
+
+    except Exception as e:
+        print(f"Ошибка при создании PDF с pdfkit: {e}")
+        return jsonify({
+            'success': False,
+            'message': f'Ошибка при создании PDF: {str(e)}'
+        }), 500
+
+@app.route('/api/admin/statistics/charts')
+@login_required
+@admin_required
+def api_statistics_charts():
+    """API для получения данных для графиков статистики"""
+    try:
+        period = int(request.args.get('period', 30))
+        group_by = request.args.get('group_by', 'day')
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        # Определяем дату начала периода
+        date_from = (datetime.now() - timedelta(days=period)).strftime('%Y-%m-%d')
+        date_to = datetime.now().strftime('%Y-%m-%d')
+
+        # Период для сравнения
+        prev_date_from = (datetime.strptime(date_from, '%Y-%m-%d') - timedelta(days=period)).strftime('%Y-%m-%d')
+        prev_date_to = date_from
+
+        # Все ряды собираются за один проход по access_events
+        aggregate = aggregate_access_events(cursor, date_from, date_to, prev_date_from, prev_date_to)
+        total_stats = aggregate['current']
+        prev_stats = aggregate['previous']
+
+        # 1. Быстрая статистика
+        success_rate = 0
+        if total_stats['total_events'] > 0:
+            success_rate = round(total_stats['successful_entries'] / total_stats['total_events'] * 100)
+
+        # Находим пиковый час
+        hourly_values = total_stats['hourly']
+        peak_hour = "-"
+        if total_stats['total_events'] > 0:
+            peak_hour = f"{str(hourly_values.index(max(hourly_values))).zfill(2)}:00"
+
+        # 2. Данные для графика посещаемости
+        attendance_data = group_daily_counts(total_stats['by_day'], group_by)
+        if group_by == 'day':
+            labels = [key for key, _, _ in attendance_data]
+        elif group_by == 'week':
+            labels = [f"Неделя {key.split('-')[1]}" for key, _, _ in attendance_data]
+        else:  # month
+            month_names = ['Янв', 'Фев', 'Мар', 'Апр', 'Май', 'Июн', 'Июл', 'Авг', 'Сен', 'Окт', 'Ноя', 'Дек']
+            labels = []
+            for key, _, _ in attendance_data:
+                year, month = key.split('-')
+                labels.append(f"{month_names[int(month) - 1]} {year}")
+        entries = [row[1] for row in attendance_data]
+        exits = [row[2] for row in attendance_data]
+
+        # 3. Данные по лабораториям (для круговой диаграммы)
+        labs_data = top_laboratories(total_stats, 8)
+        labs_labels = [name[:20] + ('...' if len(name) > 20 else '') for name, _ in labs_data]
+        labs_values = [count for _, count in labs_data]
+
+        # 4. Данные по часам
+        hourly_labels = [f"{str(i).zfill(2)}:00" for i in range(24)]
+
+        # 5. Данные об отказах
+        denials_data = top_denial_reasons(total_stats, 10)
+        denials_labels = [reason for reason, _ in denials_data]
+        denials_values = [count for _, count in denials_data]
+
+        # 6. Среднее время в лаборатории (по закрытым визитам)
+        dwell = get_dwell_time_stats(cursor, date_from, date_to)
+        prev_dwell = get_dwell_time_stats(cursor, prev_date_from, prev_date_to)
+        avg_time_in_lab = round(dwell['avg_hours'], 1)
+
+        # Вычисляем изменения в процентах
+        def calculate_change(current, previous):
+            if previous and previous > 0:
+                return round(((current - previous) / previous) * 100, 1)
+            return 0
+
+        conn.close()
+
+        stats = get_statistics()
+
+        # Формируем ответ
+        return jsonify({
+            'success': True,
+            'quick_stats': {
+                'total_events': total_stats['total_events'],
+                'success_rate': success_rate,
+                'avg_time': f"{avg_time_in_lab}ч",
+                'peak_hour': peak_hour
+            },
+            'attendance_data': {
+                'labels': labels,
+                'entries': entries,
+                'exits': exits
+            },
+            'labs_data': {
+                'labels': labs_labels,
+                'values': labs_values
+            },
+            'hourly_data': {
+                'labels': hourly_labels,
+                'values': hourly_values
+            },
+            'denials_data': {
+                'labels': denials_labels,
+                'values': denials_values
+            },
+            'detailed_stats': {
+                'total_events': total_stats['total_events'],
+                'successful_entries': total_stats['successful_entries'],
+                'denials': total_stats['denials'],
+                'total_employees': stats['employees_count'],
+                'active_labs': stats['labs_count'],
+                'avg_time_in_lab': f"{avg_time_in_lab} часов",
+                'events_change': calculate_change(total_stats['total_events'], prev_stats['total_events']),
+                'entries_change': calculate_change(total_stats['successful_entries'],
+                                                   prev_stats['successful_entries']),
+                'denials_change': calculate_change(total_stats['denials'], prev_stats['denials']),
+                'time_change': calculate_change(dwell['avg_hours'], prev_dwell['avg_hours']),
+                'events_trend': 'up' if total_stats['total_events'] > prev_stats['total_events'] else 'down',
+                'time_trend': 'up' if dwell['avg_hours'] >= prev_dwell['avg_hours'] else 'down'
+            }
+        })
+
+    except Exception as e:
+        print(f"Ошибка при получении статистики для графиков: {e}")
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/admin/statistics/dwell_time')
+@login_required
+@admin_required
+def api_statistics_dwell_time():
+    """API времени пребывания: среднее, перцентили и загрузка лабораторий"""
+    try:
+        period = int(request.args.get('period', 30))
+        laboratory_id = request.args.get('laboratory_id', type=int)
+
+        date_from = (datetime.now() - timedelta(days=period)).strftime('%Y-%m-%d')
+        date_to = datetime.now().strftime('%Y-%m-%d')
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        dwell = get_dwell_time_stats(cursor, date_from, date_to, laboratory_id)
+        laboratories = get_lab_utilisation(cursor, date_from, date_to)
+
+        conn.close()
+
+        if laboratory_id:
+            laboratories = [lab for lab in laboratories if lab['id'] == laboratory_id]
+
+        return jsonify({
+            'success': True,
+            'period': {'from': date_from, 'to': date_to},
+            'dwell_time': dwell,
+            'laboratories': laboratories
+        })
+
+    except Exception as e:
+        print(f"Ошибка при расчёте времени пребывания: {e}")
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/admin/statistics/occupancy')
+@login_required
+@admin_required
+def api_statistics_occupancy():
+    """API заполненности лабораторий по 15-минутным слотам (пик и среднее)"""
+    try:
+        today = datetime.now().strftime('%Y-%m-%d')
+        date_from = request.args.get('date_from', today)
+        date_to = request.args.get('date_to', date_from)
+        laboratory_id = request.args.get('laboratory_id', type=int)
+
+        try:
+            days = (datetime.strptime(date_to, '%Y-%m-%d') - datetime.strptime(date_from, '%Y-%m-%d')).days + 1
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Даты указываются в формате YYYY-MM-DD'}), 400
+
+        if days < 1 or days > 366:
+            return jsonify({'success': False, 'message': 'Период должен быть от 1 до 366 дней'}), 400
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        if laboratory_id:
+            cursor.execute("SELECT id, name, capacity FROM laboratories WHERE id = ?", (laboratory_id,))
+        else:
+            cursor.execute("SELECT id, name, capacity FROM laboratories WHERE is_active = TRUE ORDER BY name")
+        laboratories = [dict(row) for row in cursor.fetchall()]
+
+        if not laboratories:
+            conn.close()
+            return jsonify({'success': False, 'message': 'Лаборатория не найдена'}), 404
+
+        occupancy = get_occupancy(cursor, [lab['id'] for lab in laboratories], date_from, date_to)
+        conn.commit()
+        conn.close()
+
+        slot_labels = [
+            f"{str(slot * OCCUPANCY_SLOT_MINUTES // 60).zfill(2)}:{str(slot * OCCUPANCY_SLOT_MINUTES % 60).zfill(2)}"
+            for slot in range(OCCUPANCY_SLOTS_PER_DAY)
+        ]
+
+        result = []
+        for lab in laboratories:
+            lab_days = []
+            profile_peak = [0] * OCCUPANCY_SLOTS_PER_DAY
+            profile_average = [0] * OCCUPANCY_SLOTS_PER_DAY
+
+            day = date_from
+            while day <= date_to:
+                peak, average = occupancy[(lab['id'], day)]
+                lab_days.append({
+                    'date': day,
+                    'peak': peak,
+                    'average': average,
+                    'max_peak': max(peak)
+                })
+                for slot in range(OCCUPANCY_SLOTS_PER_DAY):
+                    profile_peak[slot] = max(profile_peak[slot], peak[slot])
+                    profile_average[slot] += average[slot] / days
+                day = next_day(day)
+
+            max_peak = max(profile_peak)
+            lab['days'] = lab_days
+            lab['profile'] = {
+                'peak': profile_peak,
+                'average': [round(value, 2) for value in profile_average]
+            }
+            lab['max_peak'] = max_peak
+            lab['peak_slot'] = slot_labels[profile_peak.index(max_peak)] if max_peak else None
+            lab['peak_percent'] = round(max_peak / lab['capacity'] * 100) if lab['capacity'] else 0
+            result.append(lab)
+
+        return jsonify({
+            'success': True,
+            'slot_minutes': OCCUPANCY_SLOT_MINUTES,
+            'slots': slot_labels,
+            'laboratories': result
+        })
+
+    except Exception as e:
+        print(f"Ошибка при расчёте заполненности: {e}")
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@app.route('/api/employee/schedule')
+@login_required
+def api_employee_schedule():
+    """API для получения расписания текущего сотрудника"""
+    try:
+        employee_id = session['user_id']
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        # Получаем расписание сотрудника
+        cursor.execute('''
+            SELECT 
+                a.id,
+                l.name as laboratory_name,
+                l.code as laboratory_code,
+                a.days_of_week,
+                a.time_start,
+                a.time_end
+            FROM access_schedules a
+            JOIN laboratories l ON a.laboratory_id = l.id
+            WHERE a.employee_id = ?
+            ORDER BY l.name
+        ''', (employee_id,))
+
+        schedule_data = []
+        for row in cursor.fetchall():
+            item = dict(row)
+
+            # Преобразуем строку дней в список названий
+            days_list = []
+            if item['days_of_week']:
+                try:
+                    # Парсим строку типа "0,1,2,3,4"
+                    day_numbers = [int(d.strip()) for d in item['days_of_week'].split(',') if d.strip().isdigit()]
+                    day_names = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
+                    days_list = [day_names[day_num] for day_num in day_numbers if 0 <= day_num < 7]
+                except Exception as e:
+                    print(f"Ошибка парсинга дней недели: {e}")
+                    days_list = []
+
+            item['days_list'] = days_list
+            item['days_text'] = ', '.join(days_list) if days_list else 'Не указаны'
+            schedule_data.append(item)
+
+        conn.close()
+
+        return jsonify({
+            'success': True,
+            'schedule': schedule_data
+        })
+
+    except Exception as e:
+        print(f"Ошибка при получении расписания сотрудника: {e}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
         }), 500
+@app.route('/api/current_presence')
+def api_current_presence():
+    # Читаем из реестра присутствия в памяти, без обращения к SQLite
+    presence = [
+        {'full_name': person['full_name'], 'name': person['laboratory_name'], 'entry_time': person['entry_time']}
+        for person in get_presence()
+    ]
+
+    return jsonify({
+        'count': len(presence),
+        'people': presence
+    })
+
+
+@app.route('/api/admin/presence_at')
+@login_required
+@admin_required
+def api_presence_at():
+    """Кто находился в лабораториях в указанный момент времени"""
+    try:
+        at = request.args.get('at', '').strip()
+        laboratory_id = request.args.get('laboratory_id', type=int)
+
+        # Момент задаётся местным временем, события и точки присутствия хранятся в UTC
+        try:
+            at = parse_event_time(at)
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Укажите момент времени в формате YYYY-MM-DD HH:MM'}), 400
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        presence, replayed = get_presence_at(cursor, utc_event_time(at).strftime('%Y-%m-%d %H:%M:%S'), laboratory_id)
+        for item in presence:
+            item['entry_time'] = local_event_time(item['entry_time']).strftime('%Y-%m-%d %H:%M:%S')
+
+        if presence:
+            employee_ids = [item['employee_id'] for item in presence]
+            cursor.execute(f'''
+                SELECT id, full_name, department, position FROM employees
+                WHERE id IN ({','.join('?' * len(employee_ids))})
+            ''', employee_ids)
+            employees = {row['id']: dict(row) for row in cursor.fetchall()}
+
+            cursor.execute("SELECT id, name, code, location FROM laboratories")
+            laboratories = {row['id']: dict(row) for row in cursor.fetchall()}
+
+            for item in presence:
+                employee = employees.get(item['employee_id'], {})
+                laboratory = laboratories.get(item['laboratory_id'], {})
+                item['full_name'] = employee.get('full_name')
+                item['department'] = employee.get('department')
+                item['position'] = employee.get('position')
+                item['laboratory_name'] = laboratory.get('name')
+                item['laboratory_code'] = laboratory.get('code')
+                item['location'] = laboratory.get('location')
+
+        conn.close()
+
+        return jsonify({
+            'success': True,
+            'at': at.strftime('%Y-%m-%d %H:%M:%S'),
+            'count': len(presence),
+            'people': presence,
+            'replayed_events': replayed
+        })
+
+    except Exception as e:
+        print(f"Ошибка при получении присутствия на момент времени: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@app.route('/api/admin/overstays')
+@login_required
+@admin_required
+def api_overstays():
+    """Сотрудники, превысившие разрешённое время пребывания, и последние такие события"""
+    try:
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+
+        # Текущие нарушители берутся из памяти, история - из overstay_events
+        current = get_overstays()
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT o.employee_id, e.full_name, o.laboratory_id, l.name as laboratory_name,
+                   o.entry_time, o.expected_exit_time, o.detected_at, o.auto_exit
+            FROM overstay_events o
+            JOIN employees e ON o.employee_id = e.id
+            JOIN laboratories l ON o.laboratory_id = l.id
+            ORDER BY o.detected_at DESC, o.id DESC
+            LIMIT ?
+        ''', (limit,))
+        recent = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+
+        with overstay_condition:
+            pending = len(overstay_timers['due'])
+
+        return jsonify({
+            'success': True,
+            'count': len(current),
+            'current': current,
+            'recent': recent,
+            'pending_timers': pending,
+            'auto_exit': OVERSTAY_AUTO_EXIT
+        })
+
+    except Exception as e:
+        print(f"Ошибка при получении превышений времени пребывания: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@app.route('/api/admin/roll_call')
+@login_required
+@admin_required
+def api_roll_call():
+    """Перекличка при эвакуации по корпусам и этажам (JSON или CSV для печати), без чтения базы"""
+    try:
+        data = get_roll_call()
+
+        if request.args.get('format') == 'csv':
+            output = io.StringIO()
+            writer = csv.writer(output)
+            writer.writerow([f"Перекличка на {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+                             f"Всего: {data['total']}", f"Отмечено: {data['accounted']}",
+                             f"Не отмечено: {data['missing']}"])
+            writer.writerow(['Корпус', 'Этаж', 'Лаборатория', 'Размещение', 'Сотрудник', 'Отдел', 'Вход', 'Отмечен'])
+            for building in data['buildings']:
+                for floor in building['floors']:
+                    for person in floor['people']:
+                        writer.writerow([
+                            building['building'],
+                            floor['floor'],
+                            person['laboratory_code'] or '',
+                            person['location'] or '',
+                            person['full_name'],
+                            person['department'] or '',
+                            person['entry_time'],
+                            person['accounted_at'] or ''
+                        ])
+
+            return send_file(
+                io.BytesIO(output.getvalue().encode('utf-8-sig')),
+                mimetype='text/csv',
+                as_attachment=True,
+                download_name=f"roll_call_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+            )
+
+        return jsonify(dict(data, success=True))
+
+    except Exception as e:
+        print(f"Ошибка при формировании переклички: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@app.route('/api/admin/roll_call/start', methods=['POST'])
+@login_required
+@admin_required
+def api_roll_call_start():
+    """Начало новой переклички"""
+    started_at = start_roll_call()
+    return jsonify({'success': True, 'started_at': started_at})
+
+
+@app.route('/api/admin/roll_call/accounted', methods=['POST'])
+@login_required
+@admin_required
+def api_roll_call_accounted():
+    """Отметка сотрудника на перекличке (accounted: false снимает отметку)"""
+    data = request.get_json(silent=True) or {}
+    employee_id = data.get('employee_id')
+
+    if not isinstance(employee_id, int):
+        return jsonify({'success': False, 'message': 'Не указан ID сотрудника'}), 400
+
+    if not mark_accounted(employee_id, bool(data.get('accounted', True)), session.get('user_id')):
+        return jsonify({'success': False, 'message': 'Сотрудник не находится в лаборатории'}), 404
+
+    return jsonify({'success': True, 'employee_id': employee_id})
+
+
+@app.route('/api/admin/contacts')
+@login_required
+@admin_required
+def api_contacts():
+    """Сотрудники, находившиеся в одной лаборатории одновременно с указанным (потоковая выдача)"""
+    employee_id = request.args.get('employee_id', type=int)
+    date_from = request.args.get('date_from')
+    date_to = request.args.get('date_to', date_from)
+    output_format = request.args.get('format', 'json')
+
+    if not employee_id or not date_from:
+        return jsonify({'success': False, 'message': 'Требуются employee_id и date_from'}), 400
+
+    try:
+        datetime.strptime(date_from, '%Y-%m-%d')
+        datetime.strptime(date_to, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Даты указываются в формате YYYY-MM-DD'}), 400
+
+    def contact_rows():
+        """Пары пересечений с именами сотрудников и названиями лабораторий"""
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, full_name FROM employees")
+            names = {row['id']: row['full_name'] for row in cursor.fetchall()}
+            cursor.execute("SELECT id, name FROM laboratories")
+            labs = {row['id']: row['name'] for row in cursor.fetchall()}
+
+            for contact in find_contacts(cursor, employee_id, date_from, date_to):
+                contact['contact_name'] = names.get(contact['contact_employee_id'])
+                contact['laboratory_name'] = labs.get(contact['laboratory_id'])
+                yield contact
+        finally:
+            conn.close()
+
+    if output_format == 'csv':
+        columns = ['contact_name', 'contact_employee_id', 'laboratory_name', 'overlap_start', 'overlap_end',
+                   'overlap_seconds', 'contact_entered_at', 'contact_exited_at']
+
+        def generate():
+            output = io.StringIO()
+            writer = csv.writer(output)
+            writer.writerow(['Сотрудник', 'ID сотрудника', 'Лаборатория', 'Начало пересечения',
+                             'Конец пересечения', 'Длительность, сек', 'Вход', 'Выход'])
+            yield '\ufeff' + output.getvalue()
+
+            for contact in contact_rows():
+                output.seek(0)
+                output.truncate()
+                writer.writerow([contact[column] for column in columns])
+                yield output.getvalue()
+
+        return Response(
+            generate(),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename=contacts_{employee_id}_{date_from}_{date_to}.csv'}
+        )
 
-    # Проверяем наличие wkhtmltopdf
+    def generate_json():
+        yield f'{{"success": true, "employee_id": {employee_id}, "contacts": ['
+        for index, contact in enumerate(contact_rows()):
+            yield (',' if index else '') + json.dumps(contact, ensure_ascii=False)
+        yield ']}'
+
+    return Response(generate_json(), mimetype='application/json')
+
+
+@app.route('/api/admin/authorised')
+@login_required
+@admin_required
+def api_authorised():
+    """Сотрудники, допущенные в лабораторию (или сразу во все указанные) в момент времени"""
     try:
-        # Пробуем найти wkhtmltopdf в системе
-        wkhtmltopdf_path = None
-        possible_paths = [
-            '/usr/bin/wkhtmltopdf',
-            '/usr/local/bin/wkhtmltopdf',
-            'C:/Program Files/wkhtmltopdf/bin/wkhtmltopdf.exe',
-            'wkhtmltopdf'  # Если в PATH
-        ]
+        laboratory_ids = request.args.getlist('laboratory_id', type=int)
+        codes = request.args.getlist('code')
+        mode = request.args.get('mode', 'all')
+        at = request.args.get('at', '').strip()
 
-        for path in possible_paths:
-            if os.path.exists(path):
-                wkhtmltopdf_path = path
-                break
+        try:
+            moment = parse_event_time(at) if at else datetime.now()
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Укажите момент времени в формате YYYY-MM-DD HH:MM'}), 400
 
-        if not wkhtmltopdf_path:
-            return jsonify({
-                'success': False,
-                'message': 'Не найден wkhtmltopdf. Установите его с https://wkhtmltopdf.org/'
-            }), 500
-    except:
-        return jsonify({
-            'success': False,
-            'message': 'Не удалось найти wkhtmltopdf. Установите его с https://wkhtmltopdf.org/'
-        }), 500
+        conn = get_db_connection()
+        cursor = conn.cursor()
 
-    data = request.get_json()
-    report_type = data.get('type', 'daily')
-    report_name = data.get('name', 'Отчет АСКУД')
-    date_start = data.get('period_start')
-    date_end = data.get('period_end')
+        if codes:
+            cursor.execute(f"SELECT id FROM laboratories WHERE code IN ({','.join('?' * len(codes))})", codes)
+            laboratory_ids += [row['id'] for row in cursor.fetchall()]
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+        if not laboratory_ids:
+            conn.close()
+            return jsonify({'success': False, 'message': 'Укажите laboratory_id или code'}), 400
+
+        # Пересечение (mode=all) или объединение (mode=any) множеств по лабораториям
+        authorised = None
+        for laboratory_id in laboratory_ids:
+            bits = get_authorised_bitset(cursor, laboratory_id, moment)
+            if authorised is None:
+                authorised = bits
+            else:
+                authorised = authorised | bits if mode == 'any' else authorised & bits
+
+        employee_ids = bitset_members(authorised)
+        employees = []
+        if employee_ids:
+            cursor.execute(f'''
+                SELECT id, full_name, department, position FROM employees
+                WHERE is_active = TRUE AND id IN ({','.join('?' * len(employee_ids))})
+                ORDER BY full_name
+            ''', employee_ids)
+            employees = [dict(row) for row in cursor.fetchall()]
 
-    # Определяем период
-    if report_type == 'daily':
-        date_start = date_end = datetime.now().strftime('%Y-%m-%d')
-    elif report_type == 'weekly':
-        date_end = datetime.now().strftime('%Y-%m-%d')
-        date_start = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
-    elif report_type == 'monthly':
-        date_end = datetime.now().strftime('%Y-%m-%d')
-        date_start = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+        conn.close()
 
-    # Получаем данные
-    query = '''
-        SELECT 
-            ae.event_time,
-            e.full_name,
-            e.department,
-            l.name as laboratory,
-            ae.event_type,
-            ae.success,
-            ae.reason
-        FROM access_events ae
-        JOIN employees e ON ae.employee_id = e.id
-        JOIN laboratories l ON ae.laboratory_id = l.id
-        WHERE DATE(ae.event_time) BETWEEN ? AND ?
-        ORDER BY ae.event_time DESC
-        LIMIT 200
-    '''
+        return jsonify({
+            'success': True,
+            'at': moment.strftime('%Y-%m-%d %H:%M:%S'),
+            'laboratory_ids': laboratory_ids,
+            'mode': mode,
+            'count': len(employees),
+            'employees': employees
+        })
 
-    cursor.execute(query, (date_start, date_end))
-    events = [dict(row) for row in cursor.fetchall()]
+    except Exception as e:
+        print(f"Ошибка при получении списка допущенных: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
 
-    conn.close()
 
-    # Создаем HTML
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <title>{report_name}</title>
-        <style>
-            body {{ font-family: Arial, sans-serif; padding: 20px; }}
-            h1 {{ text-align: center; color: #333; }}
-            .header {{ text-align: center; margin-bottom: 30px; color: #666; }}
-            .stats {{ background: #f5f5f5; padding: 15px; border-radius: 5px; margin-bottom: 20px; }}
-            table {{ width: 100%; border-collapse: collapse; margin-top: 20px; }}
-            th {{ background-color: #4a6fa5; color: white; padding: 12px; text-align: left; }}
-            td {{ padding: 10px; border-bottom: 1px solid #ddd; }}
-            tr:nth-child(even) {{ background-color: #f9f9f9; }}
-            .success {{ color: green; }}
-            .failure {{ color: red; }}
-            .footer {{ margin-top: 40px; text-align: center; color: #888; font-style: italic; }}
-        </style>
-    </head>
-    <body>
-        <h1>{report_name}</h1>
-        <div class="header">
-            <p>Период: {date_start} - {date_end}</p>
-            <p>Дата генерации: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
-        </div>
+@write_command('save_schedule_template')
+def write_schedule_template(cursor, template_id, name, department, position, laboratory_id, windows):
+    """Команда записи: новый (template_id None) или изменённый шаблон расписания; возвращает его id.
 
-        <h3>События доступа:</h3>
+    windows None оставляет прежние окна шаблона.
     """
+    if template_id is None:
+        cursor.execute('''
+            INSERT INTO schedule_templates (name, department, position, laboratory_id)
+            VALUES (?, ?, ?, ?)
+        ''', (name, department, position, laboratory_id))
+        template_id = cursor.lastrowid
+    else:
+        cursor.execute('''
+            UPDATE schedule_templates
+            SET name = ?, department = ?, position = ?, laboratory_id = ?
+            WHERE id = ?
+        ''', (name, department, position, laboratory_id, template_id))
 
-    if events:
-        html_content += """
-        <table>
-            <tr>
-                <th>Дата/Время</th>
-                <th>Сотрудник</th>
-                <th>Лаборатория</th>
-                <th>Тип</th>
-                <th>Статус</th>
-                <th>Причина</th>
-            </tr>
-        """
-
-        for event in events:
-            event_time = event['event_time'][:16]
-            full_name = event['full_name']
-            laboratory = event['laboratory']
-            event_type = 'Вход' if event['event_type'] == 'entry' else 'Выход'
-            status_class = 'success' if event['success'] else 'failure'
-            status_text = '✓ Успех' if event['success'] else '✗ Отказ'
-            reason = event['reason'] or ''
+    # Триггеры пересчитывают действующие окна только сотрудников этого отдела/должности
+    if windows is not None:
+        save_template_windows(cursor, template_id, windows)
+    return template_id
 
-            html_content += f"""
-            <tr>
-                <td>{event_time}</td>
-                <td>{full_name}</td>
-                <td>{laboratory}</td>
-                <td>{event_type}</td>
-                <td class="{status_class}">{status_text}</td>
-                <td>{reason[:50]}{'...' if len(reason) > 50 else ''}</td>
-            </tr>
-            """
 
-        html_content += """
-        </table>
-        """
-    else:
-        html_content += "<p>Нет данных за указанный период</p>"
+@write_command('delete_schedule_template')
+def write_delete_schedule_template(cursor, template_id):
+    """Команда записи: удаление шаблона расписания"""
+    cursor.execute("DELETE FROM schedule_templates WHERE id = ?", (template_id,))
+    return cursor.rowcount
 
-    html_content += f"""
-        <div class="footer">
-            <p>Сгенерировано системой контроля доступа АСКУД</p>
-            <p>Всего записей: {len(events)}</p>
-        </div>
-    </body>
-    </html>
-    """
 
-    # Конвертируем HTML в PDF
+@app.route('/api/admin/schedule_templates', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def api_schedule_templates():
+    """Шаблоны расписаний для отделов и должностей"""
     try:
-        options = {
-            'page-size': 'A4',
-            'margin-top': '0.75in',
-            'margin-right': '0.75in',
-            'margin-bottom': '0.75in',
-            'margin-left': '0.75in',
-            'encoding': "UTF-8",
-            'no-outline': None,
-            'quiet': ''
-        }
+        conn = get_db_connection()
+        cursor = conn.cursor()
 
-        # Создаем временный файл для PDF
-        pdf_buffer = io.BytesIO()
+        if request.method == 'GET':
+            cursor.execute('''
+                SELECT t.*, l.name as laboratory_name,
+                       (SELECT COUNT(DISTINCT employee_id) FROM effective_windows ew
+                        WHERE ew.template_id = t.id) as employees_count
+                FROM schedule_templates t
+                JOIN laboratories l ON t.laboratory_id = l.id
+                ORDER BY t.name
+            ''')
+            templates = [dict(row) for row in cursor.fetchall()]
 
-        # Используем pdfkit с путем к wkhtmltopdf
-        config = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf_path)
-        pdf = pdfkit.from_string(html_content, False, options=options, configuration=config)
+            cursor.execute('''
+                SELECT template_id, days_of_week, time_start, time_end
+                FROM schedule_template_windows ORDER BY id
+            ''')
+            windows = {}
+            for row in cursor.fetchall():
+                windows.setdefault(row['template_id'], []).append({
+                    'days_of_week': parse_days_of_week(row['days_of_week']),
+                    'time_start': row['time_start'],
+                    'time_end': row['time_end']
+                })
+            for template in templates:
+                template['windows'] = windows.get(template['id'], [])
 
-        pdf_buffer.write(pdf)
-        pdf_buffer.seek(0)
+            conn.close()
+            return jsonify({'success': True, 'templates': templates})
 
-        return send_file(
-            pdf_buffer,
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name=f'{report_name}_{datetime.now().strftime("%Y%m%d")}.pdf'
+        data = request.get_json() or {}
+
+        if not data.get('name') or 'laboratory_id' not in data:
+            conn.close()
+            return jsonify({'success': False, 'message': 'Требуются name и laboratory_id'}), 400
+
+        if not data.get('department') and not data.get('position'):
+            conn.close()
+            return jsonify({'success': False, 'message': 'Укажите отдел и/или должность'}), 400
+
+        try:
+            windows = parse_access_windows(data)
+        except ValueError as e:
+            conn.close()
+            return jsonify({'success': False, 'message': str(e)}), 400
+
+        cursor.execute("SELECT id FROM laboratories WHERE id = ?", (data['laboratory_id'],))
+        if not cursor.fetchone():
+            conn.close()
+            return jsonify({'success': False, 'message': 'Лаборатория не найдена'}), 404
+
+        conn.close()
+        template_id = submit_write(
+            'save_schedule_template', template_id=None, name=data['name'], department=data.get('department') or None,
+            position=data.get('position') or None, laboratory_id=data['laboratory_id'], windows=windows
         )
 
+        return jsonify({'success': True, 'message': 'Шаблон создан', 'template_id': template_id})
+
     except Exception as e:
-        print(f"Ошибка при создании PDF с pdfkit: {e}")
-        return jsonify({
-            'success': False,
-            'message': f'Ошибка при создании PDF: {str(e)}'
-        }), 500
+        print(f"Ошибка при работе с шаблонами расписаний: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/admin/statistics/charts')
+
+@app.route('/api/admin/schedule_templates/<int:template_id>', methods=['PUT', 'DELETE'])
 @login_required
 @admin_required
-def api_statistics_charts():
-    """API для получения данных для графиков статистики"""
+def api_schedule_template_detail(template_id):
+    """Изменение или удаление шаблона расписания"""
     try:
-        period = int(request.args.get('period', 30))
-        group_by = request.args.get('group_by', 'day')
-
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        # Определяем дату начала периода
-        date_from = (datetime.now() - timedelta(days=period)).strftime('%Y-%m-%d')
-        date_to = datetime.now().strftime('%Y-%m-%d')
+        cursor.execute("SELECT * FROM schedule_templates WHERE id = ?", (template_id,))
+        template = cursor.fetchone()
+        if not template:
+            conn.close()
+            return jsonify({'success': False, 'message': 'Шаблон не найден'}), 404
 
-        # 1. Быстрая статистика
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as total_events,
-                SUM(CASE WHEN event_type = 'entry' AND success = TRUE THEN 1 ELSE 0 END) as successful_entries,
-                SUM(CASE WHEN success = FALSE THEN 1 ELSE 0 END) as denials
-            FROM access_events
-            WHERE DATE(event_time) BETWEEN ? AND ?
-        ''', (date_from, date_to))
+        if request.method == 'DELETE':
+            conn.close()
+            submit_write('delete_schedule_template', template_id=template_id)
+            return jsonify({'success': True, 'message': 'Шаблон удалён'})
 
-        total_stats = cursor.fetchone()
+        data = request.get_json() or {}
+        template = dict(template)
+        for field in ('name', 'department', 'position', 'laboratory_id'):
+            if field in data:
+                template[field] = data[field] or None
 
-        # Рассчитываем процент успешных входов
-        success_rate = 0
-        if total_stats['total_events'] and total_stats['total_events'] > 0:
-            success_rate = round((total_stats['successful_entries'] or 0) / total_stats['total_events'] * 100)
+        if not template['name'] or not template['laboratory_id']:
+            conn.close()
+            return jsonify({'success': False, 'message': 'Требуются name и laboratory_id'}), 400
 
-        # Находим пиковый час
-        cursor.execute('''
-            SELECT 
-                strftime('%H', event_time) as hour,
-                COUNT(*) as count
-            FROM access_events
-            WHERE DATE(event_time) BETWEEN ? AND ?
-            GROUP BY strftime('%H', event_time)
-            ORDER BY count DESC
-            LIMIT 1
-        ''', (date_from, date_to))
+        if not template['department'] and not template['position']:
+            conn.close()
+            return jsonify({'success': False, 'message': 'Укажите отдел и/или должность'}), 400
 
-        peak_hour_data = cursor.fetchone()
-        peak_hour = f"{peak_hour_data['hour']}:00" if peak_hour_data else "-"
+        windows = None
+        if 'windows' in data or 'days_of_week' in data:
+            try:
+                windows = parse_access_windows(data)
+            except ValueError as e:
+                conn.close()
+                return jsonify({'success': False, 'message': str(e)}), 400
 
-        # 2. Данные для графика посещаемости
-        if group_by == 'day':
-            cursor.execute('''
-                SELECT 
-                    DATE(event_time) as date,
-                    SUM(CASE WHEN event_type = 'entry' AND success = TRUE THEN 1 ELSE 0 END) as entries,
-                    SUM(CASE WHEN event_type = 'exit' AND success = TRUE THEN 1 ELSE 0 END) as exits
-                FROM access_events
-                WHERE DATE(event_time) BETWEEN ? AND ?
-                GROUP BY DATE(event_time)
-                ORDER BY date
-            ''', (date_from, date_to))
+        conn.close()
+        submit_write(
+            'save_schedule_template', template_id=template_id, name=template['name'],
+            department=template['department'], position=template['position'],
+            laboratory_id=template['laboratory_id'], windows=windows
+        )
 
-            attendance_data = cursor.fetchall()
-            labels = [row['date'] for row in attendance_data]
-            entries = [row['entries'] for row in attendance_data]
-            exits = [row['exits'] for row in attendance_data]
+        return jsonify({'success': True, 'message': 'Шаблон обновлён'})
 
-        elif group_by == 'week':
-            cursor.execute('''
-                SELECT 
-                    strftime('%Y-%W', event_time) as week,
-                    SUM(CASE WHEN event_type = 'entry' AND success = TRUE THEN 1 ELSE 0 END) as entries,
-                    SUM(CASE WHEN event_type = 'exit' AND success = TRUE THEN 1 ELSE 0 END) as exits
-                FROM access_events
-                WHERE DATE(event_time) BETWEEN ? AND ?
-                GROUP BY strftime('%Y-%W', event_time)
-                ORDER BY week
-            ''', (date_from, date_to))
+    except Exception as e:
+        print(f"Ошибка при изменении шаблона расписания: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
 
-            attendance_data = cursor.fetchall()
-            labels = [f"Неделя {row['week'].split('-')[1]}" for row in attendance_data]
-            entries = [row['entries'] for row in attendance_data]
-            exits = [row['exits'] for row in attendance_data]
 
-        else:  # month
-            cursor.execute('''
-                SELECT 
-                    strftime('%Y-%m', event_time) as month,
-                    SUM(CASE WHEN event_type = 'entry' AND success = TRUE THEN 1 ELSE 0 END) as entries,
-                    SUM(CASE WHEN event_type = 'exit' AND success = TRUE THEN 1 ELSE 0 END) as exits
-                FROM access_events
-                WHERE DATE(event_time) BETWEEN ? AND ?
-                GROUP BY strftime('%Y-%m', event_time)
-                ORDER BY month
-            ''', (date_from, date_to))
+@app.route('/api/admin/schedules/what_if', methods=['POST'])
+@login_required
+@admin_required
+def api_schedule_what_if():
+    """Сколько исторических входов было бы запрещено или разрешено при новом расписании"""
+    try:
+        data = request.get_json() or {}
+        date_to = data.get('date_to') or datetime.now().strftime('%Y-%m-%d')
+        date_from = data.get('date_from') or (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+
+        try:
+            datetime.strptime(date_from, '%Y-%m-%d')
+            datetime.strptime(date_to, '%Y-%m-%d')
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Даты указываются в формате YYYY-MM-DD'}), 400
+
+        proposals = []
+        for item in data.get('proposals') or []:
+            if 'laboratory_id' not in item:
+                return jsonify({'success': False, 'message': 'В каждом предложении нужен laboratory_id'}), 400
+            try:
+                rule = compile_proposed_windows(parse_access_windows(item))
+            except ValueError as e:
+                return jsonify({'success': False, 'message': str(e)}), 400
+            proposals.append((int(item['laboratory_id']), item.get('employee_id'), item.get('department'), rule))
+
+        if not proposals:
+            return jsonify({'success': False, 'message': 'Не указаны предлагаемые расписания (proposals)'}), 400
 
-            attendance_data = cursor.fetchall()
-            month_names = ['Янв', 'Фев', 'Мар', 'Апр', 'Май', 'Июн', 'Июл', 'Авг', 'Сен', 'Окт', 'Ноя', 'Дек']
-            labels = []
-            for row in attendance_data:
-                year, month = row['month'].split('-')
-                labels.append(f"{month_names[int(month) - 1]} {year}")
-            entries = [row['entries'] for row in attendance_data]
-            exits = [row['exits'] for row in attendance_data]
+        conn = get_db_connection()
+        cursor = conn.cursor()
 
-        # 3. Данные по лабораториям (для круговой диаграммы)
-        cursor.execute('''
-            SELECT 
-                l.name,
-                COUNT(ae.id) as count
-            FROM access_events ae
-            JOIN laboratories l ON ae.laboratory_id = l.id
-            WHERE ae.success = TRUE 
-                AND ae.event_type = 'entry'
-                AND DATE(ae.event_time) BETWEEN ? AND ?
-            GROUP BY l.id
-            ORDER BY count DESC
-            LIMIT 8
-        ''', (date_from, date_to))
+        started = datetime.now()
+        counters = replay_schedule_proposal(cursor, proposals, date_from, date_to)
+        elapsed_ms = (datetime.now() - started).total_seconds() * 1000
 
-        labs_data = cursor.fetchall()
-        labs_labels = [row['name'][:20] + ('...' if len(row['name']) > 20 else '') for row in labs_data]
-        labs_values = [row['count'] for row in labs_data]
+        cursor.execute("SELECT id, full_name FROM employees")
+        names = {row['id']: row['full_name'] for row in cursor.fetchall()}
+        cursor.execute("SELECT id, name FROM laboratories")
+        labs = {row['id']: row['name'] for row in cursor.fetchall()}
+        conn.close()
 
-        # 4. Данные по часам
-        cursor.execute('''
-            SELECT 
-                strftime('%H', event_time) as hour,
-                COUNT(*) as count
-            FROM access_events
-            WHERE DATE(event_time) BETWEEN ? AND ?
-            GROUP BY strftime('%H', event_time)
-            ORDER BY hour
-        ''', (date_from, date_to))
+        fields = ['attempts', 'allowed_before', 'allowed_after', 'newly_denied', 'newly_allowed']
+        totals = dict.fromkeys(fields, 0)
+        by_employee = {}
+        by_laboratory = {}
+        for (employee_id, laboratory_id), values in counters.items():
+            employee = by_employee.setdefault(employee_id, dict(
+                {'employee_id': employee_id, 'full_name': names.get(employee_id)}, **dict.fromkeys(fields, 0)))
+            laboratory = by_laboratory.setdefault(laboratory_id, dict(
+                {'laboratory_id': laboratory_id, 'laboratory_name': labs.get(laboratory_id)}, **dict.fromkeys(fields, 0)))
+            for field, value in zip(fields, values):
+                totals[field] += value
+                employee[field] += value
+                laboratory[field] += value
 
-        hourly_data = cursor.fetchall()
+        return jsonify({
+            'success': True,
+            'date_from': date_from,
+            'date_to': date_to,
+            'engine': 'numpy' if HAS_NUMPY else 'python',
+            'elapsed_ms': round(elapsed_ms, 1),
+            'totals': totals,
+            'by_employee': sorted(by_employee.values(), key=lambda item: item['newly_denied'], reverse=True),
+            'by_laboratory': sorted(by_laboratory.values(), key=lambda item: item['newly_denied'], reverse=True)
+        })
 
-        # Создаем полный список часов (0-23)
-        hourly_labels = []
-        hourly_values = []
-        hourly_dict = {row['hour']: row['count'] for row in hourly_data}
+    except Exception as e:
+        print(f"Ошибка при проигрывании расписания: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
 
-        for i in range(24):
-            hour_key = str(i).zfill(2)
-            hourly_labels.append(f"{hour_key}:00")
-            hourly_values.append(hourly_dict.get(hour_key, 0))
 
-        # 5. Данные об отказах
-        cursor.execute('''
-            SELECT 
-                COALESCE(reason, 'Не указана') as reason,
-                COUNT(*) as count
-            FROM access_events
-            WHERE success = FALSE 
-                AND DATE(event_time) BETWEEN ? AND ?
-            GROUP BY reason
-            ORDER BY count DESC
-            LIMIT 10
-        ''', (date_from, date_to))
+@write_command('add_access_exception')
+def write_access_exception(cursor, kind, date_from, date_to, employee_id, laboratory_id, time_start, time_end, reason):
+    """Команда записи: исключение в календаре; возвращает его id"""
+    cursor.execute('''
+        INSERT INTO access_exceptions
+        (kind, date_from, date_to, employee_id, laboratory_id, time_start, time_end, reason)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (kind, date_from, date_to, employee_id, laboratory_id, time_start, time_end, reason))
+    return cursor.lastrowid
 
-        denials_data = cursor.fetchall()
-        denials_labels = [row['reason'] for row in denials_data]
-        denials_values = [row['count'] for row in denials_data]
 
-        # 6. Среднее время в лаборатории (приблизительно)
-        cursor.execute('''
-            SELECT 
-                AVG(
-                    CAST(
-                        (strftime('%s', cp.expected_exit_time) - strftime('%s', cp.entry_time)) / 3600.0 
-                        AS REAL
-                    )
-                ) as avg_hours
-            FROM current_presence cp
-            WHERE DATE(cp.entry_time) BETWEEN ? AND ?
-        ''', (date_from, date_to))
+@write_command('delete_access_exception')
+def write_delete_access_exception(cursor, exception_id):
+    """Команда записи: удаление исключения; возвращает число удалённых"""
+    cursor.execute("DELETE FROM access_exceptions WHERE id = ?", (exception_id,))
+    return cursor.rowcount
 
-        avg_hours_result = cursor.fetchone()
-        avg_time_in_lab = round(avg_hours_result['avg_hours'] or 0, 1)
 
-        # 7. Статистика для предыдущего периода (для сравнения)
-        prev_date_from = (datetime.strptime(date_from, '%Y-%m-%d') - timedelta(days=period)).strftime('%Y-%m-%d')
-        prev_date_to = date_from
+@app.route('/api/admin/access_exceptions', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def api_access_exceptions():
+    """Календарь исключений: праздничные закрытия и разовые допуски"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
 
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as prev_events,
-                SUM(CASE WHEN event_type = 'entry' AND success = TRUE THEN 1 ELSE 0 END) as prev_entries,
-                SUM(CASE WHEN success = FALSE THEN 1 ELSE 0 END) as prev_denials
-            FROM access_events
-            WHERE DATE(event_time) BETWEEN ? AND ?
-        ''', (prev_date_from, prev_date_to))
+        if request.method == 'GET':
+            date_from = request.args.get('date_from', datetime.now().strftime('%Y-%m-%d'))
+            date_to = request.args.get('date_to', '9999-12-31')
 
-        prev_stats = cursor.fetchone()
+            cursor.execute('''
+                SELECT ex.*, e.full_name, l.name as laboratory_name
+                FROM access_exceptions ex
+                LEFT JOIN employees e ON ex.employee_id = e.id
+                LEFT JOIN laboratories l ON ex.laboratory_id = l.id
+                WHERE ex.date_to >= ? AND ex.date_from <= ?
+                ORDER BY ex.date_from, ex.id
+            ''', (date_from, date_to))
+            exceptions = [dict(row) for row in cursor.fetchall()]
 
-        # Вычисляем изменения в процентах
-        def calculate_change(current, previous):
-            if previous and previous > 0:
-                return round(((current - previous) / previous) * 100, 1)
-            return 0
+            conn.close()
+            return jsonify({'success': True, 'exceptions': exceptions})
+
+        data = request.get_json() or {}
+        kind = data.get('kind')
+        date_from = data.get('date_from')
+        date_to = data.get('date_to') or date_from
+        employee_id = data.get('employee_id') or None
+        laboratory_id = data.get('laboratory_id') or None
+        time_start = data.get('time_start') or None
+        time_end = data.get('time_end') or None
+
+        if kind not in ('closed', 'open'):
+            conn.close()
+            return jsonify({'success': False, 'message': 'kind должен быть closed или open'}), 400
+
+        try:
+            if datetime.strptime(date_from or '', '%Y-%m-%d') > datetime.strptime(date_to, '%Y-%m-%d'):
+                raise ValueError
+            if time_start:
+                time_start = time.fromisoformat(time_start).strftime('%H:%M')
+            if time_end:
+                time_end = time.fromisoformat(time_end).strftime('%H:%M')
+        except (TypeError, ValueError):
+            conn.close()
+            return jsonify({'success': False, 'message': 'Неверный период: даты YYYY-MM-DD, время ЧЧ:ММ'}), 400
+
+        if time_start and time_end and time_start > time_end:
+            conn.close()
+            return jsonify({'success': False, 'message': 'Время начала должно быть раньше окончания'}), 400
+
+        # Разовый допуск выдаётся конкретному сотруднику в конкретную лабораторию
+        if kind == 'open' and not (employee_id and laboratory_id):
+            conn.close()
+            return jsonify({'success': False, 'message': 'Для разового допуска нужны employee_id и laboratory_id'}), 400
 
         conn.close()
+        exception_id = submit_write(
+            'add_access_exception', kind=kind, date_from=date_from, date_to=date_to, employee_id=employee_id,
+            laboratory_id=laboratory_id, time_start=time_start, time_end=time_end, reason=data.get('reason')
+        )
 
-        # Формируем ответ
-        return jsonify({
-            'success': True,
-            'quick_stats': {
-                'total_events': total_stats['total_events'] or 0,
-                'success_rate': success_rate,
-                'avg_time': f"{avg_time_in_lab}ч",
-                'peak_hour': peak_hour
-            },
-            'attendance_data': {
-                'labels': labels,
-                'entries': entries,
-                'exits': exits
-            },
-            'labs_data': {
-                'labels': labs_labels,
-                'values': labs_values
-            },
-            'hourly_data': {
-                'labels': hourly_labels,
-                'values': hourly_values
-            },
-            'denials_data': {
-                'labels': denials_labels,
-                'values': denials_values
-            },
-            'detailed_stats': {
-                'total_events': total_stats['total_events'] or 0,
-                'successful_entries': total_stats['successful_entries'] or 0,
-                'denials': total_stats['denials'] or 0,
-                'total_employees': get_statistics()['employees_count'],
-                'active_labs': get_statistics()['labs_count'],
-                'avg_time_in_lab': f"{avg_time_in_lab} часов",
-                'events_change': calculate_change(total_stats['total_events'] or 0, prev_stats['prev_events'] or 0),
-                'entries_change': calculate_change(total_stats['successful_entries'] or 0,
-                                                   prev_stats['prev_entries'] or 0),
-                'denials_change': calculate_change(total_stats['denials'] or 0, prev_stats['prev_denials'] or 0),
-                'time_change': 0,  # Для простоты
-                'events_trend': 'up' if (total_stats['total_events'] or 0) > (
-                        prev_stats['prev_events'] or 0) else 'down',
-                'time_trend': 'up'
-            }
-        })
+        return jsonify({'success': True, 'message': 'Исключение добавлено', 'exception_id': exception_id})
 
     except Exception as e:
-        print(f"Ошибка при получении статистики для графиков: {e}")
-        traceback.print_exc()
-        return jsonify({
-            'success': False,
-            'message': str(e)
-        }), 500
+        print(f"Ошибка при работе с календарём исключений: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
 
 
-@app.route('/api/employee/schedule')
+@app.route('/api/admin/access_exceptions/<int:exception_id>', methods=['DELETE'])
 @login_required
-def api_employee_schedule():
-    """API для получения расписания текущего сотрудника"""
+@admin_required
+def api_delete_access_exception(exception_id):
+    """Удаление исключения из календаря"""
     try:
-        employee_id = session['user_id']
+        deleted = submit_write('delete_access_exception', exception_id=exception_id)
+
+        if not deleted:
+            return jsonify({'success': False, 'message': 'Исключение не найдено'}), 404
+
+        return jsonify({'success': True, 'message': 'Исключение удалено'})
 
+    except Exception as e:
+        print(f"Ошибка при удалении исключения: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@app.route('/api/admin/employees/<int:employee_id>/effective_access')
+@login_required
+@admin_required
+def api_employee_effective_access(employee_id):
+    """Действующие окна доступа сотрудника с учётом шаблонов и личных правил"""
+    try:
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        # Получаем расписание сотрудника
         cursor.execute('''
-            SELECT 
-                a.id,
-                l.name as laboratory_name,
-                l.code as laboratory_code,
-                a.days_of_week,
-                a.time_start,
-                a.time_end
-            FROM access_schedules a
-            JOIN laboratories l ON a.laboratory_id = l.id
-            WHERE a.employee_id = ?
-            ORDER BY l.name
+            SELECT ew.laboratory_id, l.name as laboratory_name, ew.template_id, t.name as template_name,
+                   ew.day_mask, ew.start_minute, ew.end_minute
+            FROM effective_windows ew
+            JOIN laboratories l ON ew.laboratory_id = l.id
+            LEFT JOIN schedule_templates t ON ew.template_id = t.id
+            WHERE ew.employee_id = ?
+            ORDER BY l.name, ew.start_minute
         ''', (employee_id,))
 
-        schedule_data = []
+        windows = []
         for row in cursor.fetchall():
-            item = dict(row)
-
-            # Преобразуем строку дней в список названий
-            days_list = []
-            if item['days_of_week']:
-                try:
-                    # Парсим строку типа "0,1,2,3,4"
-                    day_numbers = [int(d.strip()) for d in item['days_of_week'].split(',') if d.strip().isdigit()]
-                    day_names = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
-                    days_list = [day_names[day_num] for day_num in day_numbers if 0 <= day_num < 7]
-                except Exception as e:
-                    print(f"Ошибка парсинга дней недели: {e}")
-                    days_list = []
-
-            item['days_list'] = days_list
-            item['days_text'] = ', '.join(days_list) if days_list else 'Не указаны'
-            schedule_data.append(item)
+            windows.append({
+                'laboratory_id': row['laboratory_id'],
+                'laboratory_name': row['laboratory_name'],
+                'source': 'template' if row['template_id'] else 'personal',
+                'template_id': row['template_id'],
+                'template_name': row['template_name'],
+                'days_of_week': [day for day in range(7) if row['day_mask'] & (1 << day)],
+                'time_start': format_minute(row['start_minute']),
+                'time_end': format_minute(row['end_minute'])
+            })
 
         conn.close()
 
-        return jsonify({
-            'success': True,
-            'schedule': schedule_data
-        })
+        return jsonify({'success': True, 'employee_id': employee_id, 'windows': windows})
 
     except Exception as e:
-        print(f"Ошибка при получении расписания сотрудника: {e}")
-        return jsonify({
-            'success': False,
-            'message': str(e)
-        }), 500
-@app.route('/api/current_presence')
-def api_current_presence():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        SELECT e.full_name, l.name, cp.entry_time
-        FROM current_presence cp
-        JOIN employees e ON cp.employee_id = e.id
-        JOIN laboratories l ON cp.laboratory_id = l.id
-    ''')
-
-    presence = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-
-    return jsonify({
-        'count': len(presence),
-        'people': presence
-    })
+        print(f"Ошибка при получении действующих прав доступа: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
 
 
 @app.route('/api/laboratories')
 def api_laboratories():
     """API для получения списка лабораторий с текущей загрузкой"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT 
-                l.id,
-                l.name,
-                l.code,
-                l.location,
-                l.description,
-                l.capacity,
-                l.is_active,
-                COALESCE(cp.current_count, 0) as current_count
-            FROM laboratories l
-            LEFT JOIN (
-                SELECT laboratory_id, COUNT(DISTINCT employee_id) as current_count
-                FROM current_presence 
-                GROUP BY laboratory_id
-            ) cp ON l.id = cp.laboratory_id
-            WHERE l.is_active = TRUE
-            ORDER BY l.name
-        ''')
+        # Справочник лабораторий и загрузка берутся из реестра присутствия в памяти
+        directory = get_laboratory_directory()
+        counts = get_presence_counts()
 
         laboratories = []
-        for row in cursor.fetchall():
-            lab = dict(row)
+        for row in sorted(directory.values(), key=lambda laboratory: laboratory['name']):
+            if not row['is_active']:
+                continue
+            lab = dict(row, current_count=counts.get(row['id'], 0))
             # Рассчитываем процент заполненности
             lab['occupancy_percent'] = round((lab['current_count'] / lab['capacity']) * 100) if lab['capacity'] and lab[
                 'capacity'] > 0 else 0
             laboratories.append(lab)
 
-        conn.close()
-
         return jsonify({
             'success': True,
             'laboratories': laboratories
@@ -1406,23 +6095,15 @@ def api_laboratory_presence():
                 'message': 'Не указан ID лаборатории'
             }), 400
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT 
-                cp.entry_time,
-                e.full_name,
-                e.department,
-                e.position
-            FROM current_presence cp
-            JOIN employees e ON cp.employee_id = e.id
-            WHERE cp.laboratory_id = ?
-            ORDER BY cp.entry_time
-        ''', (lab_id,))
-
-        people = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        people = [
+            {
+                'entry_time': person['entry_time'],
+                'full_name': person['full_name'],
+                'department': person['department'],
+                'position': person['position']
+            }
+            for person in get_presence(lab_id)
+        ]
 
         return jsonify({
             'success': True,
@@ -1437,6 +6118,35 @@ def api_laboratory_presence():
         }), 500
 
 
+@write_command('save_access_rule')
+def write_access_rule(cursor, employee_id, laboratory_id, windows):
+    """Команда записи: создание или замена правила доступа со всеми окнами; возвращает id правила"""
+    schedule_id = save_access_windows(cursor, employee_id, laboratory_id, windows)
+    publish_invalidation(cursor, 'schedules')
+    return schedule_id
+
+
+@write_command('update_access_rule')
+def write_update_access_rule(cursor, rule_id, days_of_week, time_start, time_end):
+    """Команда записи: изменение основного окна правила доступа"""
+    cursor.execute('''
+        UPDATE access_schedules
+        SET days_of_week = ?, time_start = ?, time_end = ?
+        WHERE id = ?
+    ''', (days_of_week, time_start, time_end, rule_id))
+    publish_invalidation(cursor, 'schedules')
+    return cursor.rowcount
+
+
+@write_command('delete_access_rule')
+def write_delete_access_rule(cursor, rule_id):
+    """Команда записи: удаление правила доступа"""
+    cursor.execute("DELETE FROM access_schedules WHERE id = ?", (rule_id,))
+    deleted = cursor.rowcount
+    publish_invalidation(cursor, 'schedules')
+    return deleted
+
+
 # API для работы с отдельными правилами доступа
 @app.route('/api/admin/access_rule', methods=['POST'])
 @login_required
@@ -1447,10 +6157,14 @@ def api_add_access_rule():
         data = request.get_json()
 
         # Проверка обязательных полей
-        required_fields = ['laboratory_id', 'days_of_week', 'time_start', 'time_end']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({'success': False, 'message': f'Не указано поле: {field}'}), 400
+        if 'laboratory_id' not in data:
+            return jsonify({'success': False, 'message': 'Не указано поле: laboratory_id'}), 400
+
+        # Одно окно (days_of_week, time_start, time_end) или список windows
+        try:
+            windows = parse_access_windows(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
 
         # Проверяем, есть ли employee_id в данных или он должен быть в URL
         if 'employee_id' not in data:
@@ -1474,36 +6188,12 @@ def api_add_access_rule():
             conn.close()
             return jsonify({'success': False, 'message': 'Лаборатория не найдена'}), 404
 
-        # Преобразуем список дней в строку
-        days_str = ','.join(map(str, data['days_of_week']))
-
-        # Проверяем, существует ли уже запись для этого сотрудника и лаборатории
-        cursor.execute('''
-            SELECT id FROM access_schedules 
-            WHERE employee_id = ? AND laboratory_id = ?
-        ''', (employee_id, laboratory_id))
-
-        existing = cursor.fetchone()
-
-        if existing:
-            # Обновляем существующую запись
-            cursor.execute('''
-                UPDATE access_schedules 
-                SET days_of_week = ?, time_start = ?, time_end = ?
-                WHERE id = ?
-            ''', (days_str, data['time_start'], data['time_end'], existing['id']))
-        else:
-            # Добавляем новую запись
-            cursor.execute('''
-                INSERT INTO access_schedules (employee_id, laboratory_id, days_of_week, time_start, time_end)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (employee_id, laboratory_id, days_str,
-                  data['time_start'], data['time_end']))
-
-        conn.commit()
         conn.close()
+        # Создаём или заменяем правило со всеми его окнами
+        schedule_id = submit_write('save_access_rule', employee_id=employee_id, laboratory_id=laboratory_id, windows=windows)
+        invalidate_terminal_prefetch()
 
-        return jsonify({'success': True, 'message': 'Правило доступа обновлено'})
+        return jsonify({'success': True, 'message': 'Правило доступа обновлено', 'rule_id': schedule_id})
 
     except Exception as e:
         print(f"Ошибка при добавлении правила доступа: {e}")
@@ -1559,7 +6249,7 @@ def api_access_rule_detail(rule_id):
             if rule['days_of_week']:
                 days_list = [int(d) for d in rule['days_of_week'].split(',') if d.isdigit()]
 
-            rule_data = dict(rule)
+            rule_data = attach_access_windows(cursor, [dict(rule)])[0]
             rule_data['days_of_week'] = days_list
 
             conn.close()
@@ -1570,31 +6260,47 @@ def api_access_rule_detail(rule_id):
             data = request.get_json()
 
             # Проверяем существование правила
-            cursor.execute("SELECT id FROM access_schedules WHERE id = ?", (rule_id,))
-            if not cursor.fetchone():
+            cursor.execute("SELECT employee_id, laboratory_id FROM access_schedules WHERE id = ?", (rule_id,))
+            existing = cursor.fetchone()
+            if not existing:
                 conn.close()
                 return jsonify({'success': False, 'message': 'Правило не найдено'}), 404
 
+            if 'windows' in data:
+                # Полная замена списка окон правила
+                try:
+                    windows = parse_access_windows(data)
+                except ValueError as e:
+                    conn.close()
+                    return jsonify({'success': False, 'message': str(e)}), 400
+
+                conn.close()
+                submit_write(
+                    'save_access_rule', employee_id=existing['employee_id'],
+                    laboratory_id=existing['laboratory_id'], windows=windows
+                )
+                invalidate_terminal_prefetch()
+
+                return jsonify({'success': True, 'message': 'Правило обновлено'})
+
             # Преобразуем список дней в строку
             days_str = ','.join(map(str, data.get('days_of_week', [])))
 
             # Обновляем запись
-            cursor.execute('''
-                UPDATE access_schedules 
-                SET days_of_week = ?, time_start = ?, time_end = ?
-                WHERE id = ?
-            ''', (days_str, data['time_start'], data['time_end'], rule_id))
-
-            conn.commit()
             conn.close()
+            submit_write(
+                'update_access_rule', rule_id=rule_id, days_of_week=days_str,
+                time_start=data['time_start'], time_end=data['time_end']
+            )
+            invalidate_terminal_prefetch()
 
             return jsonify({'success': True, 'message': 'Правило обновлено'})
 
         elif request.method == 'DELETE':
             # Удаление правила
-            cursor.execute("DELETE FROM access_schedules WHERE id = ?", (rule_id,))
-            conn.commit()
             conn.close()
+            submit_write('delete_access_rule', rule_id=rule_id)
+            invalidate_terminal_prefetch()
 
             return jsonify({'success': True, 'message': 'Правило удалено'})
 
@@ -1636,8 +6342,8 @@ def api_employee_access_rules(employee_id):
         ''', (employee_id,))
 
         access_rules = []
-        for row in cursor.fetchall():
-            rule = dict(row)
+        rows = attach_access_windows(cursor, [dict(row) for row in cursor.fetchall()])
+        for rule in rows:
             # Преобразуем строку дней в список чисел
             if rule['days_of_week']:
                 try:
@@ -1660,6 +6366,50 @@ def api_employee_access_rules(employee_id):
     except Exception as e:
         print(f"Ошибка при получении правил доступа: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
+
+
+EMPLOYEE_UPDATE_COLUMNS = (
+    'full_name', 'department', 'position', 'phone', 'email', 'is_active', 'user_type',
+    'pin_digest', 'terminal_digest', 'password'
+)
+
+
+@write_command('add_employee')
+def write_add_employee(cursor, login, password, pin_code, full_name, department='', position='', phone='',
+                       email='', is_active=True, user_type='employee'):
+    """Команда записи: новый сотрудник (PIN сохраняется только в виде HMAC); возвращает его id"""
+    cursor.execute('''
+        INSERT INTO employees (login, password, pin_digest, terminal_digest, full_name, department, position, phone, email, is_active, user_type)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        login, password, pin_digest(pin_code), terminal_pin_digest(pin_code), full_name,
+        department, position, phone, email, is_active, user_type
+    ))
+    employee_id = cursor.lastrowid
+    publish_invalidation(cursor, 'employees')
+    return employee_id
+
+
+@write_command('update_employee')
+def write_update_employee(cursor, employee_id, fields):
+    """Команда записи: изменение полей сотрудника; возвращает его ФИО, отдел и должность"""
+    update_row(cursor, 'employees', EMPLOYEE_UPDATE_COLUMNS, employee_id, fields)
+    publish_invalidation(cursor, 'employees', employee_id)
+
+    cursor.execute("SELECT full_name, department, position FROM employees WHERE id = ?", (employee_id,))
+    return dict(cursor.fetchone())
+
+
+@write_command('delete_employee')
+def write_delete_employee(cursor, employee_id):
+    """Команда записи: удаление сотрудника вместе с его расписанием доступа"""
+    cursor.execute("DELETE FROM access_schedules WHERE employee_id = ?", (employee_id,))
+    cursor.execute("DELETE FROM employees WHERE id = ?", (employee_id,))
+    deleted = cursor.rowcount
+    publish_invalidation(cursor, 'employees', employee_id)
+    return deleted
+
+
 @app.route('/api/admin/add_employee', methods=['POST'])
 @login_required
 @admin_required
@@ -1693,31 +6443,29 @@ def api_add_employee():
             conn.close()
             return jsonify({'success': False, 'message': 'Логин уже существует'})
 
-        cursor.execute("SELECT id FROM employees WHERE pin_code = ?", (pin_code,))
+        cursor.execute("SELECT id FROM employees WHERE pin_digest = ?", (pin_digest(pin_code),))
         if cursor.fetchone():
             conn.close()
             return jsonify({'success': False, 'message': 'PIN-код уже существует'})
 
-        # Добавление сотрудника
-        cursor.execute('''
-            INSERT INTO employees (login, password, pin_code, full_name, department, position, phone, email, is_active, user_type)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            data['login'],
-            data['password'],
-            pin_code,
-            data['full_name'],
-            data.get('department', ''),
-            data.get('position', ''),
-            data.get('phone', ''),
-            data.get('email', ''),
-            data.get('is_active', True),
-            data.get('user_type', 'employee')
-        ))
-
-        conn.commit()
         conn.close()
 
+        # Добавление сотрудника
+        submit_write(
+            'add_employee',
+            login=data['login'],
+            password=data['password'],
+            pin_code=pin_code,
+            full_name=data['full_name'],
+            department=data.get('department', ''),
+            position=data.get('position', ''),
+            phone=data.get('phone', ''),
+            email=data.get('email', ''),
+            is_active=data.get('is_active', True),
+            user_type=data.get('user_type', 'employee')
+        )
+        clear_rejected_pins()
+
         return jsonify({'success': True, 'message': 'Сотрудник добавлен'})
 
     except Exception as e:
@@ -1743,35 +6491,40 @@ def api_statistics():
             if not date_from or not date_to:
                 date_from = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
                 date_to = datetime.now().strftime('%Y-%m-%d')
+            days = (datetime.strptime(date_to, '%Y-%m-%d') - datetime.strptime(date_from, '%Y-%m-%d')).days
         else:
             days = int(period)
             date_from = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
             date_to = datetime.now().strftime('%Y-%m-%d')
 
-        # 1. Данные посещаемости по дням
-        if chart_type == 'daily':
-            cursor.execute('''
-                SELECT 
-                    DATE(event_time) as date,
-                    SUM(CASE WHEN event_type = 'entry' AND success = TRUE THEN 1 ELSE 0 END) as entries,
-                    SUM(CASE WHEN event_type = 'exit' AND success = TRUE THEN 1 ELSE 0 END) as exits
-                FROM access_events
-                WHERE DATE(event_time) BETWEEN ? AND ?
-                GROUP BY DATE(event_time)
-                ORDER BY date
-            ''', (date_from, date_to))
+        # Период для сравнения
+        prev_date_from = (datetime.strptime(date_from, '%Y-%m-%d') - timedelta(days=days)).strftime('%Y-%m-%d')
+        prev_date_to = date_from
+
+        # Все ряды собираются за один проход по access_events
+        aggregate = aggregate_access_events(cursor, date_from, date_to, prev_date_from, prev_date_to)
+        total_stats = aggregate['current']
+        prev_stats = aggregate['previous']
 
-            daily_data = cursor.fetchall()
+        # Время пребывания по закрытым визитам
+        dwell = get_dwell_time_stats(cursor, date_from, date_to)
+        prev_dwell = get_dwell_time_stats(cursor, prev_date_from, prev_date_to)
+
+        conn.close()
+
+        # 1. Данные посещаемости по дням
+        if chart_type == 'daily':
+            daily_data = group_daily_counts(total_stats['by_day'], 'day')
 
             # Формируем данные для графика
             labels = []
             entries = []
             exits = []
 
-            for row in daily_data:
-                labels.append(row['date'])
-                entries.append(row['entries'])
-                exits.append(row['exits'])
+            for day, day_entries, day_exits in daily_data:
+                labels.append(day)
+                entries.append(day_entries)
+                exits.append(day_exits)
 
             visits_data = {
                 'labels': labels,
@@ -1784,114 +6537,34 @@ def api_statistics():
 
         elif chart_type == 'weekly':
             # Аналогично для недель
-            visits_data = get_weekly_data(cursor, date_from, date_to)
+            visits_data = get_weekly_data(total_stats['by_day'])
         else:  # monthly
-            visits_data = get_monthly_data(cursor, date_from, date_to)
+            visits_data = get_monthly_data(total_stats['by_day'])
 
         # 2. Данные по лабораториям
-        cursor.execute('''
-            SELECT 
-                l.name,
-                COUNT(ae.id) as visit_count
-            FROM access_events ae
-            JOIN laboratories l ON ae.laboratory_id = l.id
-            WHERE ae.success = TRUE 
-                AND ae.event_type = 'entry'
-                AND DATE(ae.event_time) BETWEEN ? AND ?
-            GROUP BY l.id
-            ORDER BY visit_count DESC
-            LIMIT 10
-        ''', (date_from, date_to))
-
-        labs_data = cursor.fetchall()
-
         labs_labels = []
         labs_values = []
 
-        for row in labs_data:
-            labs_labels.append(row['name'])
-            labs_values.append(row['visit_count'])
+        for name, visit_count in top_laboratories(total_stats, 10):
+            labs_labels.append(name)
+            labs_values.append(visit_count)
 
         # 3. Данные об отказах
-        cursor.execute('''
-            SELECT 
-                reason,
-                COUNT(*) as count
-            FROM access_events
-            WHERE success = FALSE 
-                AND DATE(event_time) BETWEEN ? AND ?
-                AND reason IS NOT NULL
-            GROUP BY reason
-            ORDER BY count DESC
-            LIMIT 5
-        ''', (date_from, date_to))
-
-        denials_data = cursor.fetchall()
-
         denial_labels = []
         denial_values = []
         denial_reasons = []
 
-        for row in denials_data:
-            reason = row['reason'] or 'Не указана'
+        for reason, count in top_denial_reasons(total_stats, 5, skip_unknown=True):
             denial_labels.append(reason)
-            denial_values.append(row['count'])
+            denial_values.append(count)
             denial_reasons.append({
                 'reason': reason,
-                'count': row['count']
+                'count': count
             })
 
         # 4. Данные по часам
-        cursor.execute('''
-            SELECT 
-                strftime('%H', event_time) as hour,
-                COUNT(*) as count
-            FROM access_events
-            WHERE DATE(event_time) BETWEEN ? AND ?
-            GROUP BY strftime('%H', event_time)
-            ORDER BY hour
-        ''', (date_from, date_to))
-
-        hourly_data = cursor.fetchall()
-
-        hourly_labels = []
-        hourly_values = []
-
-        # Создаем все часы (0-23)
-        all_hours = [f"{str(i).zfill(2)}:00" for i in range(24)]
-        hourly_counts = {row['hour']: row['count'] for row in hourly_data}
-
-        for i in range(24):
-            hour_key = str(i).zfill(2)
-            hourly_labels.append(all_hours[i])
-            hourly_values.append(hourly_counts.get(hour_key, 0))
-
-        # 5. Общая статистика
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as total_events,
-                SUM(CASE WHEN event_type = 'entry' AND success = TRUE THEN 1 ELSE 0 END) as successful_entries,
-                SUM(CASE WHEN success = FALSE THEN 1 ELSE 0 END) as denials
-            FROM access_events
-            WHERE DATE(event_time) BETWEEN ? AND ?
-        ''', (date_from, date_to))
-
-        total_stats = cursor.fetchone()
-
-        # Получаем статистику за предыдущий период для сравнения
-        prev_date_from = (datetime.strptime(date_from, '%Y-%m-%d') - timedelta(days=int(period))).strftime('%Y-%m-%d')
-        prev_date_to = date_from
-
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as prev_events,
-                SUM(CASE WHEN event_type = 'entry' AND success = TRUE THEN 1 ELSE 0 END) as prev_entries,
-                SUM(CASE WHEN success = FALSE THEN 1 ELSE 0 END) as prev_denials
-            FROM access_events
-            WHERE DATE(event_time) BETWEEN ? AND ?
-        ''', (prev_date_from, prev_date_to))
-
-        prev_stats = cursor.fetchone()
+        hourly_labels = [f"{str(i).zfill(2)}:00" for i in range(24)]
+        hourly_values = total_stats['hourly']
 
         # Вычисляем изменения в процентах
         def calculate_change(current, previous):
@@ -1899,7 +6572,7 @@ def api_statistics():
                 return round(((current - previous) / previous) * 100, 1)
             return 0
 
-        conn.close()
+        stats = get_statistics()
 
         return jsonify({
             'success': True,
@@ -1920,22 +6593,21 @@ def api_statistics():
                 'values': hourly_values
             },
             'stats': {
-                'total_events': total_stats['total_events'] or 0,
-                'successful_entries': total_stats['successful_entries'] or 0,
-                'denials': total_stats['denials'] or 0,
-                'total_employees': get_statistics()['employees_count'],
-                'active_labs': get_statistics()['labs_count'],
-                'avg_time_in_lab': 2.5,  # Заглушка - нужно реализовать расчет
-                'events_change': calculate_change(total_stats['total_events'] or 0, prev_stats['prev_events'] or 0),
-                'entries_change': calculate_change(total_stats['successful_entries'] or 0,
-                                                   prev_stats['prev_entries'] or 0),
-                'denials_change': calculate_change(total_stats['denials'] or 0, prev_stats['prev_denials'] or 0),
+                'total_events': total_stats['total_events'],
+                'successful_entries': total_stats['successful_entries'],
+                'denials': total_stats['denials'],
+                'total_employees': stats['employees_count'],
+                'active_labs': stats['labs_count'],
+                'avg_time_in_lab': round(dwell['avg_hours'], 1),
+                'events_change': calculate_change(total_stats['total_events'], prev_stats['total_events']),
+                'entries_change': calculate_change(total_stats['successful_entries'],
+                                                   prev_stats['successful_entries']),
+                'denials_change': calculate_change(total_stats['denials'], prev_stats['denials']),
                 'employees_change': 0,
                 'labs_change': 0,
-                'time_change': 0,
-                'events_trend': 'up' if (total_stats['total_events'] or 0) > (
-                        prev_stats['prev_events'] or 0) else 'down',
-                'time_trend': 'up'
+                'time_change': calculate_change(dwell['avg_hours'], prev_dwell['avg_hours']),
+                'events_trend': 'up' if total_stats['total_events'] > prev_stats['total_events'] else 'down',
+                'time_trend': 'up' if dwell['avg_hours'] >= prev_dwell['avg_hours'] else 'down'
             }
         })
 
@@ -1949,31 +6621,18 @@ def api_statistics():
 
 
 # Вспомогательные функции для обработки данных
-def get_weekly_data(cursor, date_from, date_to):
+def get_weekly_data(by_day):
     """Получение данных по неделям"""
-    cursor.execute('''
-        SELECT 
-            strftime('%Y-%W', event_time) as week,
-            SUM(CASE WHEN event_type = 'entry' AND success = TRUE THEN 1 ELSE 0 END) as entries,
-            SUM(CASE WHEN event_type = 'exit' AND success = TRUE THEN 1 ELSE 0 END) as exits
-        FROM access_events
-        WHERE DATE(event_time) BETWEEN ? AND ?
-        GROUP BY strftime('%Y-%W', event_time)
-        ORDER BY week
-    ''', (date_from, date_to))
-
-    weekly_data = cursor.fetchall()
-
     labels = []
     entries = []
     exits = []
 
-    for row in weekly_data:
+    for week_key, week_entries, week_exits in group_daily_counts(by_day, 'week'):
         # Преобразуем номер недели в читаемый формат
-        year, week = row['week'].split('-')
+        year, week = week_key.split('-')
         labels.append(f"Неделя {week}, {year}")
-        entries.append(row['entries'])
-        exits.append(row['exits'])
+        entries.append(week_entries)
+        exits.append(week_exits)
 
     return {
         'labels': labels,
@@ -1985,33 +6644,20 @@ def get_weekly_data(cursor, date_from, date_to):
     }
 
 
-def get_monthly_data(cursor, date_from, date_to):
+def get_monthly_data(by_day):
     """Получение данных по месяцам"""
-    cursor.execute('''
-        SELECT 
-            strftime('%Y-%m', event_time) as month,
-            SUM(CASE WHEN event_type = 'entry' AND success = TRUE THEN 1 ELSE 0 END) as entries,
-            SUM(CASE WHEN event_type = 'exit' AND success = TRUE THEN 1 ELSE 0 END) as exits
-        FROM access_events
-        WHERE DATE(event_time) BETWEEN ? AND ?
-        GROUP BY strftime('%Y-%m', event_time)
-        ORDER BY month
-    ''', (date_from, date_to))
-
-    monthly_data = cursor.fetchall()
-
+    month_names = ['Янв', 'Фев', 'Мар', 'Апр', 'Май', 'Июн',
+                   'Июл', 'Авг', 'Сен', 'Окт', 'Ноя', 'Дек']
     labels = []
     entries = []
     exits = []
 
-    for row in monthly_data:
+    for month_key, month_entries, month_exits in group_daily_counts(by_day, 'month'):
         # Преобразуем месяц в читаемый формат
-        year, month = row['month'].split('-')
-        month_names = ['Янв', 'Фев', 'Мар', 'Апр', 'Май', 'Июн',
-                       'Июл', 'Авг', 'Сен', 'Окт', 'Ноя', 'Дек']
+        year, month = month_key.split('-')
         labels.append(f"{month_names[int(month) - 1]} {year}")
-        entries.append(row['entries'])
-        exits.append(row['exits'])
+        entries.append(month_entries)
+        exits.append(month_exits)
 
     return {
         'labels': labels,
@@ -2023,6 +6669,44 @@ def get_monthly_data(cursor, date_from, date_to):
     }
 
 
+LABORATORY_UPDATE_COLUMNS = ('name', 'code', 'location', 'description', 'capacity', 'is_active')
+
+
+@write_command('add_laboratory')
+def write_add_laboratory(cursor, name, code, location, description, capacity, is_active):
+    """Команда записи: новая лаборатория; возвращает её id"""
+    cursor.execute('''
+        INSERT INTO laboratories (name, code, location, description, capacity, is_active)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (name, code, location, description, capacity, is_active))
+    laboratory_id = cursor.lastrowid
+    publish_invalidation(cursor, 'laboratories')
+    return laboratory_id
+
+
+@write_command('update_laboratory')
+def write_update_laboratory(cursor, laboratory_id, fields):
+    """Команда записи: изменение полей лаборатории"""
+    updated = update_row(cursor, 'laboratories', LABORATORY_UPDATE_COLUMNS, laboratory_id, fields)
+    publish_invalidation(cursor, 'laboratories')
+    return updated
+
+
+@write_command('delete_laboratory')
+def write_delete_laboratory(cursor, laboratory_id):
+    """Команда записи: удаление лаборатории; возвращает 'deactivated', если на неё есть права доступа"""
+    cursor.execute("SELECT id FROM access_schedules WHERE laboratory_id = ?", (laboratory_id,))
+    if cursor.fetchone():
+        # Вместо удаления деактивируем лабораторию
+        cursor.execute("UPDATE laboratories SET is_active = FALSE WHERE id = ?", (laboratory_id,))
+        result = 'deactivated'
+    else:
+        cursor.execute("DELETE FROM laboratories WHERE id = ?", (laboratory_id,))
+        result = 'deleted'
+    publish_invalidation(cursor, 'laboratories')
+    return result
+
+
 @app.route('/api/admin/laboratories', methods=['GET', 'POST'])
 @login_required
 @admin_required
@@ -2086,21 +6770,17 @@ def api_admin_laboratories():
                 return jsonify({'success': False, 'message': 'Лаборатория с таким кодом уже существует'}), 400
 
             # Добавляем лабораторию
-            cursor.execute('''
-                INSERT INTO laboratories (name, code, location, description, capacity, is_active)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                data['name'].strip(),
-                data['code'].strip(),
-                data['location'].strip(),
-                data.get('description', ''),
-                int(data['capacity']),
-                data.get('is_active', True)
-            ))
-
-            conn.commit()
-            lab_id = cursor.lastrowid
             conn.close()
+            lab_id = submit_write(
+                'add_laboratory',
+                name=data['name'].strip(),
+                code=data['code'].strip(),
+                location=data['location'].strip(),
+                description=data.get('description', ''),
+                capacity=int(data['capacity']),
+                is_active=data.get('is_active', True)
+            )
+            invalidate_laboratory_directory()
 
             return jsonify({
                 'success': True,
@@ -2203,30 +6883,22 @@ def api_admin_laboratory_detail(laboratory_id):
                     return jsonify({'success': False, 'message': 'Код лаборатории уже используется'}), 400
 
             # Подготавливаем поля для обновления
-            update_fields = []
-            update_values = []
-
-            allowed_fields = ['name', 'code', 'location', 'description', 'capacity', 'is_active']
-
-            for field in allowed_fields:
+            update_fields = {}
+            for field in LABORATORY_UPDATE_COLUMNS:
                 if field in data:
-                    update_fields.append(f"{field} = ?")
                     if field in ['capacity', 'is_active']:
-                        update_values.append(int(data[field]) if field == 'capacity' else bool(data[field]))
+                        update_fields[field] = int(data[field]) if field == 'capacity' else bool(data[field])
                     else:
-                        update_values.append(str(data[field]).strip())
+                        update_fields[field] = str(data[field]).strip()
 
             if not update_fields:
                 conn.close()
                 return jsonify({'success': False, 'message': 'Нет данных для обновления'}), 400
 
             # Выполняем обновление
-            update_values.append(laboratory_id)
-            update_query = f"UPDATE laboratories SET {', '.join(update_fields)} WHERE id = ?"
-
-            cursor.execute(update_query, update_values)
-            conn.commit()
             conn.close()
+            submit_write('update_laboratory', laboratory_id=laboratory_id, fields=update_fields)
+            invalidate_laboratory_directory()
 
             return jsonify({'success': True, 'message': 'Данные лаборатории обновлены'})
 
@@ -2244,29 +6916,16 @@ def api_admin_laboratory_detail(laboratory_id):
                     'message': 'Нельзя удалить лабораторию, в которой находятся сотрудники'
                 }), 400
 
-            # Проверяем, есть ли связанные права доступа
-            cursor.execute(
-                "SELECT id FROM access_schedules WHERE laboratory_id = ?",
-                (laboratory_id,)
-            )
-            if cursor.fetchone():
-                # Вместо удаления деактивируем лабораторию
-                cursor.execute(
-                    "UPDATE laboratories SET is_active = FALSE WHERE id = ?",
-                    (laboratory_id,)
-                )
-                conn.commit()
-                conn.close()
+            # Удаляем лабораторию или, если есть связанные права доступа, деактивируем
+            conn.close()
+            result = submit_write('delete_laboratory', laboratory_id=laboratory_id)
+            invalidate_laboratory_directory()
+            if result == 'deactivated':
                 return jsonify({
                     'success': True,
                     'message': 'Лаборатория деактивирована (есть связанные права доступа)'
                 })
 
-            # Удаляем лабораторию
-            cursor.execute("DELETE FROM laboratories WHERE id = ?", (laboratory_id,))
-            conn.commit()
-            conn.close()
-
             return jsonify({'success': True, 'message': 'Лаборатория удалена'})
 
     except Exception as e:
@@ -2327,7 +6986,7 @@ def api_employee_detail(employee_id):
                     schedule_item['days_of_week'] = []
                 schedule.append(schedule_item)
 
-            employee_data = dict(employee)
+            employee_data = employee_public_dict(employee)
             employee_data['access_schedule'] = schedule
 
             # Также получаем список ID лабораторий для удобства
@@ -2354,18 +7013,11 @@ def api_employee_detail(employee_id):
                 return jsonify({'success': False, 'message': 'Сотрудник не найден'}), 404
 
             # Подготавливаем поля для обновления
-            update_fields = []
-            update_values = []
-
             allowed_fields = ['full_name', 'department', 'position', 'phone', 'email', 'is_active', 'user_type']
+            update_fields = {field: data[field] for field in allowed_fields if field in data}
 
-            for field in allowed_fields:
-                if field in data:
-                    update_fields.append(f"{field} = ?")
-                    update_values.append(data[field])
-
-            # Проверяем PIN-код, если он указан
-            if 'pin_code' in data:
+            # Проверяем PIN-код, если он указан (пустое поле оставляет прежний PIN)
+            if str(data.get('pin_code') or '').strip():
                 pin_code = str(data['pin_code']).strip()
 
                 # Проверка длины PIN-кода
@@ -2382,15 +7034,15 @@ def api_employee_detail(employee_id):
 
                 # Проверка уникальности PIN-кода
                 cursor.execute(
-                    "SELECT id FROM employees WHERE pin_code = ? AND id != ?",
-                    (pin_code, employee_id)
+                    "SELECT id FROM employees WHERE pin_digest = ? AND id != ?",
+                    (pin_digest(pin_code), employee_id)
                 )
                 if cursor.fetchone():
                     conn.close()
                     return jsonify({'success': False, 'message': 'PIN-код уже используется другим сотрудником'}), 400
 
-                update_fields.append("pin_code = ?")
-                update_values.append(pin_code)
+                update_fields['pin_digest'] = pin_digest(pin_code)
+                update_fields['terminal_digest'] = terminal_pin_digest(pin_code)
 
             # Обновляем пароль, если он указан и не пустой
             if 'password' in data and data['password'].strip():
@@ -2402,20 +7054,20 @@ def api_employee_detail(employee_id):
                         'message': f'Пароль должен содержать не менее {MIN_PASSWORD_LENGTH} символов'
                     }), 400
 
-                update_fields.append("password = ?")
-                update_values.append(password)
+                update_fields['password'] = password
 
             if not update_fields:
                 conn.close()
                 return jsonify({'success': False, 'message': 'Нет данных для обновления'}), 400
 
             # Выполняем обновление
-            update_values.append(employee_id)
-            update_query = f"UPDATE employees SET {', '.join(update_fields)} WHERE id = ?"
-
-            cursor.execute(update_query, update_values)
-            conn.commit()
             conn.close()
+            employee = submit_write('update_employee', employee_id=employee_id, fields=update_fields)
+            clear_rejected_pins()
+            invalidate_terminal_prefetch()
+
+            # Поддерживаем данные сотрудника в реестре присутствия
+            registry_update_employee(employee_id, employee['full_name'], employee['department'], employee['position'])
 
             return jsonify({'success': True, 'message': 'Данные сотрудника обновлены'})
 
@@ -2433,14 +7085,10 @@ def api_employee_detail(employee_id):
                     'message': 'Нельзя удалить сотрудника, который находится в лаборатории'
                 }), 400
 
-            # Удаляем расписание доступа
-            cursor.execute("DELETE FROM access_schedules WHERE employee_id = ?", (employee_id,))
-
-            # Удаляем сотрудника
-            cursor.execute("DELETE FROM employees WHERE id = ?", (employee_id,))
-
-            conn.commit()
+            # Удаляем сотрудника вместе с расписанием доступа
             conn.close()
+            submit_write('delete_employee', employee_id=employee_id)
+            invalidate_terminal_prefetch()
 
             return jsonify({'success': True, 'message': 'Сотрудник удален'})
 
@@ -2477,7 +7125,7 @@ def api_employee_access(employee_id):
                 ORDER BY l.name
             ''', (employee_id,))
 
-            access_rights = [dict(row) for row in cursor.fetchall()]
+            access_rights = attach_access_windows(cursor, [dict(row) for row in cursor.fetchall()])
 
             # Получаем все лаборатории для выпадающего списка
             cursor.execute('''
@@ -2501,11 +7149,16 @@ def api_employee_access(employee_id):
             # Добавление/обновление прав доступа
             data = request.get_json()
 
-            required_fields = ['laboratory_id', 'days_of_week', 'time_start', 'time_end']
-            for field in required_fields:
-                if field not in data:
-                    conn.close()
-                    return jsonify({'success': False, 'message': f'Не указано поле: {field}'}), 400
+            if 'laboratory_id' not in data:
+                conn.close()
+                return jsonify({'success': False, 'message': 'Не указано поле: laboratory_id'}), 400
+
+            # Одно окно (days_of_week, time_start, time_end) или список windows
+            try:
+                windows = parse_access_windows(data)
+            except ValueError as e:
+                conn.close()
+                return jsonify({'success': False, 'message': str(e)}), 400
 
             # Проверяем существование лаборатории
             cursor.execute(
@@ -2516,34 +7169,10 @@ def api_employee_access(employee_id):
                 conn.close()
                 return jsonify({'success': False, 'message': 'Лаборатория не найдена'}), 404
 
-            # Преобразуем список дней в строку
-            days_str = ','.join(map(str, data['days_of_week']))
-
-            # Проверяем, существует ли уже запись для этого сотрудника и лаборатории
-            cursor.execute('''
-                SELECT id FROM access_schedules 
-                WHERE employee_id = ? AND laboratory_id = ?
-            ''', (employee_id, data['laboratory_id']))
-
-            existing = cursor.fetchone()
-
-            if existing:
-                # Обновляем существующую запись
-                cursor.execute('''
-                    UPDATE access_schedules 
-                    SET days_of_week = ?, time_start = ?, time_end = ?
-                    WHERE id = ?
-                ''', (days_str, data['time_start'], data['time_end'], existing['id']))
-            else:
-                # Добавляем новую запись
-                cursor.execute('''
-                    INSERT INTO access_schedules (employee_id, laboratory_id, days_of_week, time_start, time_end)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (employee_id, data['laboratory_id'], days_str,
-                      data['time_start'], data['time_end']))
-
-            conn.commit()
+            # Создаём или заменяем правило со всеми его окнами
             conn.close()
+            submit_write('save_access_rule', employee_id=employee_id, laboratory_id=data['laboratory_id'], windows=windows)
+            invalidate_terminal_prefetch()
 
             return jsonify({'success': True, 'message': 'Права доступа обновлены'})
 
@@ -2571,9 +7200,9 @@ def api_delete_access_schedule(employee_id, schedule_id):
             conn.close()
             return jsonify({'success': False, 'message': 'Расписание не найдено'}), 404
 
-        cursor.execute("DELETE FROM access_schedules WHERE id = ?", (schedule_id,))
-        conn.commit()
         conn.close()
+        submit_write('delete_access_rule', rule_id=schedule_id)
+        invalidate_terminal_prefetch()
 
         return jsonify({'success': True, 'message': 'Расписание удалено'})
 
@@ -2582,6 +7211,23 @@ def api_delete_access_schedule(employee_id, schedule_id):
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
+@write_command('add_report')
+def write_add_report(cursor, name, report_type, period_start, period_end, created_by):
+    """Команда записи: запись о сформированном отчёте или экспорте; возвращает её id"""
+    cursor.execute('''
+        INSERT INTO reports (name, report_type, period_start, period_end, created_by)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (name, report_type, period_start, period_end, created_by))
+    return cursor.lastrowid
+
+
+@write_command('delete_report')
+def write_delete_report(cursor, report_id):
+    """Команда записи: удаление записи об отчёте"""
+    cursor.execute("DELETE FROM reports WHERE id = ?", (report_id,))
+    return cursor.rowcount
+
+
 @app.route('/api/admin/generate_report', methods=['POST'])
 @login_required
 @admin_required
@@ -2723,16 +7369,15 @@ def api_generate_report():
             writer.writerow(headers)
             writer.writerow(['Нет данных за выбранный период'])
 
-        # Сохраняем отчет в базе
-        cursor.execute('''
-            INSERT INTO reports (name, report_type, period_start, period_end, created_by)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (filename, report_type, period_start or datetime.now().strftime('%Y-%m-%d'),
-              period_end or datetime.now().strftime('%Y-%m-%d'), session['user_id']))
-
-        conn.commit()
         conn.close()
 
+        # Сохраняем отчет в базе
+        submit_write(
+            'add_report', name=filename, report_type=report_type,
+            period_start=period_start or datetime.now().strftime('%Y-%m-%d'),
+            period_end=period_end or datetime.now().strftime('%Y-%m-%d'), created_by=session['user_id']
+        )
+
         output.seek(0)
 
         return send_file(
@@ -2746,6 +7391,115 @@ def api_generate_report():
         print(f"Ошибка при генерации отчета: {e}")
         return jsonify({'success': False, 'message': str(e)})
 
+@app.route('/api/admin/timesheets')
+@login_required
+@admin_required
+def api_timesheets():
+    """Табель за месяц: отработанные минуты по сотрудникам, лабораториям и дням (JSON или CSV)"""
+    try:
+        month = request.args.get('month', datetime.now().strftime('%Y-%m'))
+        output_format = request.args.get('format', 'json')
+        department = request.args.get('department')
+
+        try:
+            month_start = datetime.strptime(month, '%Y-%m')
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Месяц указывается в формате YYYY-MM'}), 400
+
+        month_end = (month_start + timedelta(days=32)).replace(day=1)
+        days = [(month_start + timedelta(days=i)).strftime('%Y-%m-%d') for i in range((month_end - month_start).days)]
+
+        query = '''
+            SELECT
+                t.employee_id,
+                e.full_name,
+                e.department,
+                t.laboratory_id,
+                l.name as laboratory,
+                t.day,
+                t.worked_seconds,
+                t.visits
+            FROM timesheet_days t
+            JOIN employees e ON t.employee_id = e.id
+            JOIN laboratories l ON t.laboratory_id = l.id
+            WHERE t.day >= ? AND t.day < ?
+        '''
+        params = [month_start.strftime('%Y-%m-%d'), month_end.strftime('%Y-%m-%d')]
+        if department:
+            query += " AND e.department = ?"
+            params.append(department)
+        query += " ORDER BY e.full_name, t.employee_id, l.name, t.day"
+
+        def timesheet_rows():
+            """Строки табеля, сгруппированные по паре сотрудник/лаборатория"""
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute(query, params)
+                current = None
+                for row in cursor:
+                    key = (row['employee_id'], row['laboratory_id'])
+                    if current is None or current['key'] != key:
+                        if current is not None:
+                            yield current
+                        current = {
+                            'key': key,
+                            'employee_id': row['employee_id'],
+                            'full_name': row['full_name'],
+                            'department': row['department'],
+                            'laboratory_id': row['laboratory_id'],
+                            'laboratory': row['laboratory'],
+                            'minutes': {},
+                            'visits': 0
+                        }
+                    current['minutes'][row['day']] = round(row['worked_seconds'] / 60)
+                    current['visits'] += row['visits']
+                if current is not None:
+                    yield current
+            finally:
+                conn.close()
+
+        if output_format == 'csv':
+            def generate():
+                output = io.StringIO()
+                writer = csv.writer(output)
+                writer.writerow(['Сотрудник', 'Отдел', 'Лаборатория'] + [day[8:] for day in days] +
+                                ['Итого минут', 'Итого часов'])
+                yield '\ufeff' + output.getvalue()
+
+                for item in timesheet_rows():
+                    output.seek(0)
+                    output.truncate()
+                    total = sum(item['minutes'].values())
+                    writer.writerow([item['full_name'], item['department'] or '', item['laboratory']] +
+                                    [item['minutes'].get(day, 0) for day in days] +
+                                    [total, round(total / 60, 2)])
+                    yield output.getvalue()
+
+            return Response(
+                generate(),
+                mimetype='text/csv',
+                headers={'Content-Disposition': f'attachment; filename=timesheet_{month}.csv'}
+            )
+
+        timesheet = []
+        for item in timesheet_rows():
+            item.pop('key')
+            item['total_minutes'] = sum(item['minutes'].values())
+            timesheet.append(item)
+
+        return jsonify({
+            'success': True,
+            'month': month,
+            'days': days,
+            'timesheet': timesheet
+        })
+
+    except Exception as e:
+        print(f"Ошибка при формировании табеля: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
 @app.route('/api/admin/export/excel')
 @login_required
 @admin_required
@@ -2793,20 +7547,14 @@ def api_export_excel():
         output.seek(0)
 
         # Сохраняем информацию об экспорте
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO reports (name, report_type, period_start, period_end, created_by)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (
-            f'excel_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx',
-            'export',
-            datetime.now().strftime('%Y-%m-%d'),
-            datetime.now().strftime('%Y-%m-%d'),
-            session['user_id']
-        ))
-        conn.commit()
-        conn.close()
+        submit_write(
+            'add_report',
+            name=f'excel_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx',
+            report_type='export',
+            period_start=datetime.now().strftime('%Y-%m-%d'),
+            period_end=datetime.now().strftime('%Y-%m-%d'),
+            created_by=session['user_id']
+        )
 
         return send_file(
             output,
@@ -2952,7 +7700,7 @@ def generate_report_file(report):
                 row_dict['event_time'],
                 row_dict['full_name'],
                 row_dict['name'],
-                'Вход' if row_dict['event_type'] == 'entry' else 'Выход',
+                EVENT_TYPE_LABELS.get(row_dict['event_type'], row_dict['event_type']),
                 'Успешно' if row_dict['success'] else 'Отказ',
                 row_dict['reason'] or ''
             ])
@@ -2986,9 +7734,10 @@ def api_export_csv():
             conn = get_db_connection()
             cursor = conn.cursor()
 
-            # 1. Экспорт сотрудников
+            # 1. Экспорт сотрудников без пароля и HMAC PIN-кодов (EMPLOYEE_SECRET_COLUMNS):
+            # HMAC привязан к ключу этой установки, при импорте PIN-код задаётся заново
             cursor.execute('''
-                SELECT id, login, password, pin_code, full_name, department, 
+                SELECT id, login, full_name, department, 
                        position, phone, email, is_active, user_type, created_at
                 FROM employees
                 ORDER BY id
@@ -2998,7 +7747,7 @@ def api_export_csv():
             writer = csv.writer(employees_data)
 
             # Заголовки
-            writer.writerow(['id', 'login', 'password', 'pin_code', 'full_name', 'department',
+            writer.writerow(['id', 'login', 'full_name', 'department',
                              'position', 'phone', 'email', 'is_active', 'user_type', 'created_at'])
 
             # Данные
@@ -3064,20 +7813,14 @@ def api_export_csv():
         zip_buffer.seek(0)
 
         # Сохраняем информацию об экспорте в базу
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO reports (name, report_type, period_start, period_end, created_by)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (
-            f'export_full_{datetime.now().strftime("%Y%m%d_%H%M%S")}.zip',
-            'export',
-            datetime.now().strftime('%Y-%m-%d'),
-            datetime.now().strftime('%Y-%m-%d'),
-            session['user_id']
-        ))
-        conn.commit()
-        conn.close()
+        submit_write(
+            'add_report',
+            name=f'export_full_{datetime.now().strftime("%Y%m%d_%H%M%S")}.zip',
+            report_type='export',
+            period_start=datetime.now().strftime('%Y-%m-%d'),
+            period_end=datetime.now().strftime('%Y-%m-%d'),
+            created_by=session['user_id']
+        )
 
         return send_file(
             zip_buffer,
@@ -3091,6 +7834,131 @@ def api_export_csv():
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
+def import_employee_row(cursor, row):
+    """Строка импорта сотрудников; False - строка пропущена"""
+    # Проверяем обязательные поля. PIN принимается только открытым (pin_code): HMAC
+    # из другой установки не проверить текущим ключом PIN_HMAC_KEY
+    if not all(k in row for k in ['login', 'full_name']):
+        return False
+
+    if not (row.get('pin_code') or '').strip():
+        return False
+    digest = pin_digest(row['pin_code'])
+    terminal_digest = terminal_pin_digest(row['pin_code'])
+
+    # Проверяем уникальность логина
+    cursor.execute("SELECT id FROM employees WHERE login = ?", (row['login'],))
+    if cursor.fetchone():
+        return False
+
+    # Проверяем уникальность PIN-кода
+    cursor.execute("SELECT id FROM employees WHERE pin_digest = ?", (digest,))
+    if cursor.fetchone():
+        return False
+
+    # Добавляем сотрудника
+    cursor.execute('''
+        INSERT INTO employees (login, password, pin_digest, terminal_digest, full_name, department, 
+                              position, phone, email, is_active, user_type)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        row.get('login', ''),
+        row.get('password', '123456'),  # Пароль по умолчанию
+        digest,
+        terminal_digest,
+        row.get('full_name', ''),
+        row.get('department', ''),
+        row.get('position', ''),
+        row.get('phone', ''),
+        row.get('email', ''),
+        bool(int(row.get('is_active', 1))),
+        row.get('user_type', 'employee')
+    ))
+    return True
+
+
+def import_laboratory_row(cursor, row):
+    """Строка импорта лабораторий; False - строка пропущена"""
+    # Проверяем обязательные поля
+    if not all(k in row for k in ['name', 'code', 'location']):
+        return False
+
+    # Проверяем уникальность кода
+    cursor.execute("SELECT id FROM laboratories WHERE code = ?", (row['code'],))
+    if cursor.fetchone():
+        return False
+
+    # Добавляем лабораторию
+    cursor.execute('''
+        INSERT INTO laboratories (name, code, location, description, capacity, is_active)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (
+        row.get('name', ''),
+        row.get('code', ''),
+        row.get('location', ''),
+        row.get('description', ''),
+        int(row.get('capacity', 10)),
+        bool(int(row.get('is_active', 1)))
+    ))
+    return True
+
+
+def import_access_row(cursor, row):
+    """Строка импорта прав доступа; False - строка пропущена"""
+    # Проверяем обязательные поля
+    if not all(k in row for k in ['employee_id', 'laboratory_id']):
+        return False
+
+    # Проверяем существование сотрудника и лаборатории
+    cursor.execute("SELECT id FROM employees WHERE id = ?", (row['employee_id'],))
+    if not cursor.fetchone():
+        return False
+
+    cursor.execute("SELECT id FROM laboratories WHERE id = ?", (row['laboratory_id'],))
+    if not cursor.fetchone():
+        return False
+
+    # Добавляем право доступа
+    cursor.execute('''
+        INSERT INTO access_schedules (employee_id, laboratory_id, days_of_week, time_start, time_end)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (
+        int(row['employee_id']),
+        int(row['laboratory_id']),
+        row.get('days_of_week', '0,1,2,3,4'),
+        row.get('time_start', '08:00'),
+        row.get('time_end', '18:00')
+    ))
+    return True
+
+
+# Тип импорта (по имени файла, в порядке проверки) -> обработчик строки и область сброса кэшей
+IMPORT_ROW_HANDLERS = {
+    'employees': (import_employee_row, 'employees'),
+    'laboratories': (import_laboratory_row, 'laboratories'),
+    'access': (import_access_row, 'schedules'),
+}
+
+
+@write_command('import_csv')
+def write_import_csv(cursor, kind, rows):
+    """Команда записи: часть строк CSV-импорта; возвращает [импортировано, пропущено]"""
+    import_row, scope = IMPORT_ROW_HANDLERS[kind]
+    imported = skipped = 0
+    for row in rows:
+        try:
+            if import_row(cursor, row):
+                imported += 1
+            else:
+                skipped += 1
+        except Exception as e:
+            print(f"Ошибка при импорте строки ({kind}): {e}")
+            skipped += 1
+
+    publish_invalidation(cursor, scope)
+    return [imported, skipped]
+
+
 @app.route('/api/admin/import/csv', methods=['POST'])
 @login_required
 @admin_required
@@ -3115,131 +7983,25 @@ def api_import_csv():
         csv_reader = csv.DictReader(stream)
 
         filename = file.filename.lower()
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        kind = next((kind for kind in IMPORT_ROW_HANDLERS if kind in filename), None)
+        if kind is None:
+            return jsonify({'success': False, 'message': 'Неизвестный тип файла'}), 400
 
         records_imported = 0
         records_skipped = 0
 
-        if 'employees' in filename:
-            # Импорт сотрудников
-            for row in csv_reader:
-                try:
-                    # Проверяем обязательные поля
-                    if not all(k in row for k in ['login', 'pin_code', 'full_name']):
-                        records_skipped += 1
-                        continue
-
-                    # Проверяем уникальность логина
-                    cursor.execute("SELECT id FROM employees WHERE login = ?", (row['login'],))
-                    if cursor.fetchone():
-                        records_skipped += 1
-                        continue
-
-                    # Проверяем уникальность PIN-кода
-                    cursor.execute("SELECT id FROM employees WHERE pin_code = ?", (row['pin_code'],))
-                    if cursor.fetchone():
-                        records_skipped += 1
-                        continue
-
-                    # Добавляем сотрудника
-                    cursor.execute('''
-                        INSERT INTO employees (login, password, pin_code, full_name, department, 
-                                              position, phone, email, is_active, user_type)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        row.get('login', ''),
-                        row.get('password', '123456'),  # Пароль по умолчанию
-                        row.get('pin_code', ''),
-                        row.get('full_name', ''),
-                        row.get('department', ''),
-                        row.get('position', ''),
-                        row.get('phone', ''),
-                        row.get('email', ''),
-                        bool(int(row.get('is_active', 1))),
-                        row.get('user_type', 'employee')
-                    ))
-
-                    records_imported += 1
-                except Exception as e:
-                    print(f"Ошибка при импорте строки сотрудника: {e}")
-                    records_skipped += 1
-
-        elif 'laboratories' in filename:
-            # Импорт лабораторий
-            for row in csv_reader:
-                try:
-                    # Проверяем обязательные поля
-                    if not all(k in row for k in ['name', 'code', 'location']):
-                        records_skipped += 1
-                        continue
-
-                    # Проверяем уникальность кода
-                    cursor.execute("SELECT id FROM laboratories WHERE code = ?", (row['code'],))
-                    if cursor.fetchone():
-                        records_skipped += 1
-                        continue
-
-                    # Добавляем лабораторию
-                    cursor.execute('''
-                        INSERT INTO laboratories (name, code, location, description, capacity, is_active)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    ''', (
-                        row.get('name', ''),
-                        row.get('code', ''),
-                        row.get('location', ''),
-                        row.get('description', ''),
-                        int(row.get('capacity', 10)),
-                        bool(int(row.get('is_active', 1)))
-                    ))
-
-                    records_imported += 1
-                except Exception as e:
-                    print(f"Ошибка при импорте строки лаборатории: {e}")
-                    records_skipped += 1
-
-        elif 'access' in filename:
-            # Импорт прав доступа
-            for row in csv_reader:
-                try:
-                    # Проверяем обязательные поля
-                    if not all(k in row for k in ['employee_id', 'laboratory_id']):
-                        records_skipped += 1
-                        continue
-
-                    # Проверяем существование сотрудника и лаборатории
-                    cursor.execute("SELECT id FROM employees WHERE id = ?", (row['employee_id'],))
-                    if not cursor.fetchone():
-                        records_skipped += 1
-                        continue
-
-                    cursor.execute("SELECT id FROM laboratories WHERE id = ?", (row['laboratory_id'],))
-                    if not cursor.fetchone():
-                        records_skipped += 1
-                        continue
-
-                    # Добавляем право доступа
-                    cursor.execute('''
-                        INSERT INTO access_schedules (employee_id, laboratory_id, days_of_week, time_start, time_end)
-                        VALUES (?, ?, ?, ?, ?)
-                    ''', (
-                        int(row['employee_id']),
-                        int(row['laboratory_id']),
-                        row.get('days_of_week', '0,1,2,3,4'),
-                        row.get('time_start', '08:00'),
-                        row.get('time_end', '18:00')
-                    ))
-
-                    records_imported += 1
-                except Exception as e:
-                    print(f"Ошибка при импорте строки прав доступа: {e}")
-                    records_skipped += 1
-        else:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Неизвестный тип файла'}), 400
+        # Строки уходят процессу записи частями: между ними он успевает записать проходы
+        while True:
+            rows = [dict(row) for row in islice(csv_reader, WRITER_IMPORT_CHUNK_ROWS)]
+            if not rows:
+                break
+            imported, skipped = submit_write('import_csv', kind=kind, rows=rows)
+            records_imported += imported
+            records_skipped += skipped
 
-        conn.commit()
-        conn.close()
+        invalidate_laboratory_directory()
+        clear_rejected_pins()
+        invalidate_terminal_prefetch()
 
         return jsonify({
             'success': True,
@@ -3294,9 +8056,8 @@ def api_delete_report(report_id):
             conn.close()
             return jsonify({'success': False, 'message': 'Отчет не найден'}), 404
 
-        cursor.execute("DELETE FROM reports WHERE id = ?", (report_id,))
-        conn.commit()
         conn.close()
+        submit_write('delete_report', report_id=report_id)
 
         return jsonify({'success': True, 'message': 'Отчет удален'})
 
@@ -3362,19 +8123,9 @@ def api_dashboard_stats():
 
         top_employees = [dict(row) for row in cursor.fetchall()]
 
-        # Среднее время пребывания (примерно)
-        cursor.execute('''
-            SELECT 
-                AVG(
-                    CAST(
-                        (strftime('%s', cp.expected_exit_time) - strftime('%s', cp.entry_time)) / 3600.0 
-                        AS REAL
-                    )
-                ) as avg_hours
-            FROM current_presence cp
-        ''')
-
-        avg_hours = cursor.fetchone()[0] or 0
+        # Среднее время пребывания по визитам за последние 7 дней
+        week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
+        avg_hours = get_dwell_time_stats(cursor, week_ago, datetime.now().strftime('%Y-%m-%d'))['avg_hours']
 
         conn.close()
 
@@ -3469,18 +8220,12 @@ def api_system_info():
     conn = get_db_connection()
     cursor = conn.cursor()
 
-    # Статистика базы данных
-    cursor.execute("SELECT COUNT(*) FROM employees")
-    employees_count = cursor.fetchone()[0]
-
-    cursor.execute("SELECT COUNT(*) FROM laboratories")
-    labs_count = cursor.fetchone()[0]
-
-    cursor.execute("SELECT COUNT(*) FROM access_events")
-    events_count = cursor.fetchone()[0]
-
-    cursor.execute("SELECT COUNT(*) FROM access_schedules")
-    schedules_count = cursor.fetchone()[0]
+    # Статистика базы данных (из таблицы счётчиков)
+    counters = read_counters(cursor)
+    employees_count = counters['employees_total']
+    labs_count = counters['laboratories_total']
+    events_count = counters['access_events_total']
+    schedules_count = counters['access_schedules_total']
 
     # Размер базы данных
     import os
@@ -3505,7 +8250,9 @@ def api_system_info():
             'min_pin_length': MIN_PIN_LENGTH,
             'max_pin_length': MAX_PIN_LENGTH,
             'min_password_length': MIN_PASSWORD_LENGTH
-        }
+        },
+        'pin_limiter': get_pin_limiter_metrics(),
+        'terminals': get_terminal_metrics()
     }
 
     return jsonify({'success': True, 'info': info})
@@ -3561,32 +8308,29 @@ def api_admin_employees_post():
             conn.close()
             return jsonify({'success': False, 'message': 'Логин уже существует'}), 400
 
-        cursor.execute("SELECT id FROM employees WHERE pin_code = ?", (pin_code,))
+        cursor.execute("SELECT id FROM employees WHERE pin_digest = ?", (pin_digest(pin_code),))
         if cursor.fetchone():
             conn.close()
             return jsonify({'success': False, 'message': 'PIN-код уже используется'}), 400
 
-        # Добавление сотрудника
-        cursor.execute('''
-            INSERT INTO employees (login, password, pin_code, full_name, department, 
-                                  position, phone, email, is_active, user_type)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            data['login'].strip(),
-            data['password'].strip(),
-            pin_code,
-            data['full_name'].strip(),
-            data.get('department', '').strip(),
-            data.get('position', '').strip(),
-            data.get('phone', '').strip(),
-            data.get('email', '').strip(),
-            data.get('is_active', True),
-            data.get('user_type', 'employee')
-        ))
-
-        conn.commit()
         conn.close()
 
+        # Добавление сотрудника
+        submit_write(
+            'add_employee',
+            login=data['login'].strip(),
+            password=data['password'].strip(),
+            pin_code=pin_code,
+            full_name=data['full_name'].strip(),
+            department=data.get('department', '').strip(),
+            position=data.get('position', '').strip(),
+            phone=data.get('phone', '').strip(),
+            email=data.get('email', '').strip(),
+            is_active=data.get('is_active', True),
+            user_type=data.get('user_type', 'employee')
+        )
+        clear_rejected_pins()
+
         return jsonify({'success': True, 'message': 'Сотрудник добавлен'})
 
     except Exception as e:
@@ -3616,14 +8360,10 @@ def api_get_employees():
     params.append(limit)
 
     cursor.execute(query, params)
-    employees = [dict(row) for row in cursor.fetchall()]
+    employees = [employee_public_dict(row) for row in cursor.fetchall()]
 
     conn.close()
 
-    # Убираем пароли из ответа
-    for emp in employees:
-        emp.pop('password', None)
-
     return jsonify(employees)
 
 
@@ -3683,20 +8423,15 @@ def api_get_current_presence():
     """
     Получение списка сотрудников в лабораториях
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        SELECT cp.employee_id, e.full_name, l.name as lab_name, cp.entry_time
-        FROM current_presence cp
-        JOIN employees e ON cp.employee_id = e.id
-        JOIN laboratories l ON cp.laboratory_id = l.id
-        ORDER BY cp.entry_time DESC
-    ''')
-
-    presence = [dict(row) for row in cursor.fetchall()]
-
-    conn.close()
+    presence = [
+        {
+            'employee_id': person['employee_id'],
+            'full_name': person['full_name'],
+            'lab_name': person['laboratory_name'],
+            'entry_time': person['entry_time']
+        }
+        for person in reversed(get_presence())
+    ]
 
     return jsonify({
         "count": len(presence),
@@ -3719,65 +8454,59 @@ def api_check_access():
         }), 400
 
     pin_code = data['pin_code']
-    lab_id = data['laboratory_id']
+    lab_id = request_laboratory_id(data, None)
+    if lab_id is None:
+        return jsonify({
+            "success": False,
+            "message": "laboratory_id должен быть целым числом"
+        }), 400
+
+    # Без токена терминала перебор ограничивается по IP
+    digest = pin_digest(pin_code)
+    verdict = pin_limiter_check(request.remote_addr, None, digest)
+    if verdict == 'locked':
+        return pin_lockout_response()
 
     conn = get_db_connection()
     cursor = conn.cursor()
 
-    # Поиск сотрудника по PIN-коду
-    cursor.execute('''
-        SELECT e.* 
-        FROM employees e 
-        WHERE e.pin_code = ? AND e.is_active = TRUE
-    ''', (pin_code,))
+    employee = None
+    if verdict is None:
+        # Поиск сотрудника по PIN-коду
+        cursor.execute('''
+            SELECT e.*
+            FROM employees e
+            WHERE e.pin_digest = ? AND e.is_active = TRUE
+        ''', (digest,))
 
-    employee = cursor.fetchone()
+        employee = cursor.fetchone()
 
     if not employee:
         conn.close()
+        if pin_limiter_failure(request.remote_addr, None, digest):
+            return pin_lockout_response()
         return jsonify({
             "success": False,
             "message": "Неверный PIN-код или сотрудник неактивен"
         }), 403
 
-    employee_dict = dict(employee)
-
-    # Проверка прав доступа
-    day_of_week = datetime.now().weekday()  # 0-понедельник, 6-воскресенье
-    current_time = datetime.now().strftime('%H:%M')
-
-    cursor.execute('''
-        SELECT * FROM access_schedules 
-        WHERE employee_id = ? 
-        AND laboratory_id = ? 
-        AND days_of_week LIKE ?
-        AND time_start <= ? 
-        AND time_end >= ?
-    ''', (employee_dict['id'], lab_id, f'%{day_of_week}%', current_time, current_time))
-
-    has_access = cursor.fetchone() is not None
-
-    # Запись события
-    cursor.execute('''
-        INSERT INTO access_events 
-        (employee_id, laboratory_id, event_type, success, reason, method)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (
-        employee_dict['id'],
-        lab_id,
-        'entry' if has_access else 'entry_denied',
-        has_access,
-        'По расписанию' if has_access else 'Нет доступа в это время',
-        'pin'
-    ))
+    employee_dict = employee_public_dict(employee)
 
-    conn.commit()
+    # Проверка прав доступа по расписанию дня с учётом календаря исключений
+    has_access = check_schedule(cursor, employee_dict['id'], lab_id, datetime.now())[0] is None
     conn.close()
 
-    if has_access:
-        # Убираем пароль из ответа
-        employee_dict.pop('password', None)
+    # Запись события через процесс записи
+    try:
+        submit_write('check', employee_id=employee_dict['id'], laboratory_id=lab_id, has_access=has_access)
+    except (RuntimeError, OSError, sqlite3.Error) as e:
+        print(f"Ошибка записи проверки доступа: {e}")
+        return jsonify({
+            "success": False,
+            "message": "Внутренняя ошибка сервера"
+        }), 500
 
+    if has_access:
         return jsonify({
             "success": True,
             "message": "Доступ разрешен",
@@ -3821,6 +8550,14 @@ if __name__ == '__main__':
     # Запускаем миграцию старых данных
     migrate_old_data()
 
+    # python app.py --writer: только процесс записи для воркеров с ASKUD_WRITER_SOCKET
+    if '--writer' in sys.argv:
+        run_writer(os.environ.get('ASKUD_WRITER_SOCKET', 'askud_writer.sock'))
+        sys.exit(0)
+
+    # Загружаем реестр присутствия в память
+    ensure_presence_registry()
+
     print(f"\n🚀 Запуск АСКУД версии 2.0")
     print("📍 Главная страница: http://localhost:5000")
     print("📍 Терминал доступа: http://localhost:5000/terminal")
@@ -0,0 +1,290 @@
+"""
+Замеры производительности подсистем АСКУД на синтетических данных
+
+Запуск:
+    python benchmark.py                     # все замеры
+    python benchmark.py statistics          # только выбранный замер
+    python benchmark.py statistics --events 500000
+    python benchmark.py occupancy --days 365
+
+Каждый замер создаёт временную базу access_system.db во временном каталоге,
+заполняет её событиями доступа и печатает время работы старого и нового
+способа расчёта.
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time as time_module
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+DENIAL_REASONS = ['Нет расписания доступа', 'День недели не разрешен', 'Вне времени доступа', None]
+
+
+def prepare_database(events_count, days, employees_count=200, seed=42):
+    """Создание временной базы с синтетическими событиями доступа"""
+    workdir = tempfile.mkdtemp(prefix='askud_bench_')
+    os.chdir(workdir)
+
+    import app
+    app.init_database()
+
+    rnd = random.Random(seed)
+    conn = sqlite3.connect('access_system.db')
+    cursor = conn.cursor()
+
+    cursor.executemany(
+        "INSERT INTO employees (login, password, pin_digest, full_name, department, user_type) VALUES (?, ?, ?, ?, ?, 'employee')",
+        [(f'bench{i}', 'bench123', app.pin_digest(f'{100000 + i}'), f'Сотрудник {i}', 'Отдел')
+         for i in range(employees_count)]
+    )
+
+    cursor.execute("SELECT id FROM employees")
+    employee_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT id FROM laboratories")
+    lab_ids = [row[0] for row in cursor.fetchall()]
+
+    # Пары вход/выход в рабочее время и небольшая доля отказов
+    start = datetime.now() - timedelta(days=days)
+    rows = []
+    while len(rows) < events_count:
+        employee_id = rnd.choice(employee_ids)
+        lab_id = rnd.choice(lab_ids)
+        entered = start + timedelta(days=rnd.randrange(days), minutes=rnd.randrange(7 * 60, 19 * 60))
+        if rnd.random() < 0.1:
+            rows.append((employee_id, lab_id, 'entry', entered.strftime('%Y-%m-%d %H:%M:%S'), False,
+                         rnd.choice(DENIAL_REASONS)))
+            continue
+        exited = entered + timedelta(minutes=rnd.randrange(5, 240))
+        rows.append((employee_id, lab_id, 'entry', entered.strftime('%Y-%m-%d %H:%M:%S'), True, None))
+        rows.append((employee_id, lab_id, 'exit', exited.strftime('%Y-%m-%d %H:%M:%S'), True, None))
+
+    rows.sort(key=lambda row: row[3])
+    cursor.executemany(
+        "INSERT INTO access_events (employee_id, laboratory_id, event_type, event_time, success, reason) VALUES (?, ?, ?, ?, ?, ?)",
+        rows[:events_count]
+    )
+    conn.commit()
+    conn.close()
+
+    return app
+
+
+def measure(func, repeat=5):
+    """Лучшее время выполнения функции из нескольких повторов (мс)"""
+    best = None
+    for _ in range(repeat):
+        started = time_module.perf_counter()
+        func()
+        elapsed = (time_module.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def legacy_statistics_queries(cursor, date_from, date_to, prev_date_from, prev_date_to):
+    """Прежний набор запросов api_statistics_charts (по одному проходу на ряд)"""
+    queries = [
+        '''SELECT COUNT(*), SUM(CASE WHEN event_type = 'entry' AND success = TRUE THEN 1 ELSE 0 END),
+                  SUM(CASE WHEN success = FALSE THEN 1 ELSE 0 END)
+           FROM access_events WHERE DATE(event_time) BETWEEN ? AND ?''',
+        '''SELECT strftime('%H', event_time) as hour, COUNT(*) as count FROM access_events
+           WHERE DATE(event_time) BETWEEN ? AND ? GROUP BY strftime('%H', event_time) ORDER BY count DESC LIMIT 1''',
+        '''SELECT DATE(event_time) as date,
+                  SUM(CASE WHEN event_type = 'entry' AND success = TRUE THEN 1 ELSE 0 END),
+                  SUM(CASE WHEN event_type = 'exit' AND success = TRUE THEN 1 ELSE 0 END)
+           FROM access_events WHERE DATE(event_time) BETWEEN ? AND ? GROUP BY DATE(event_time) ORDER BY date''',
+        '''SELECT l.name, COUNT(ae.id) as count FROM access_events ae JOIN laboratories l ON ae.laboratory_id = l.id
+           WHERE ae.success = TRUE AND ae.event_type = 'entry' AND DATE(ae.event_time) BETWEEN ? AND ?
+           GROUP BY l.id ORDER BY count DESC LIMIT 8''',
+        '''SELECT strftime('%H', event_time) as hour, COUNT(*) FROM access_events
+           WHERE DATE(event_time) BETWEEN ? AND ? GROUP BY strftime('%H', event_time) ORDER BY hour''',
+        '''SELECT COALESCE(reason, 'Не указана') as reason, COUNT(*) as count FROM access_events
+           WHERE success = FALSE AND DATE(event_time) BETWEEN ? AND ? GROUP BY reason ORDER BY count DESC LIMIT 10''',
+    ]
+    for query in queries:
+        cursor.execute(query, (date_from, date_to))
+        cursor.fetchall()
+
+    cursor.execute(queries[0], (prev_date_from, prev_date_to))
+    cursor.fetchall()
+
+
+def bench_statistics(args):
+    """Графики статистики: восемь проходов против одного"""
+    app = prepare_database(args.events, args.days)
+    period = 30
+    date_from = (datetime.now() - timedelta(days=period)).strftime('%Y-%m-%d')
+    date_to = datetime.now().strftime('%Y-%m-%d')
+    prev_date_from = (datetime.now() - timedelta(days=2 * period)).strftime('%Y-%m-%d')
+
+    conn = app.get_db_connection()
+    cursor = conn.cursor()
+
+    legacy = measure(lambda: legacy_statistics_queries(cursor, date_from, date_to, prev_date_from, date_from))
+    single = measure(lambda: app.aggregate_access_events(cursor, date_from, date_to, prev_date_from, date_from))
+    conn.close()
+
+    print(f"statistics: {args.events} событий, период {period} дн.")
+    print(f"  прежние запросы:      {legacy:8.1f} мс")
+    print(f"  однопроходный агрегат: {single:8.1f} мс  (x{legacy / max(single, 0.001):.1f})")
+
+
+def bench_occupancy(args):
+    """Заполненность лабораторий за год: расчёт заметающей прямой и чтение из кэша"""
+    app = prepare_database(args.events, args.days)
+    conn = app.get_db_connection()
+    cursor = conn.cursor()
+
+    started = time_module.perf_counter()
+    app.sync_event_views(cursor)
+    conn.commit()
+    pairing = (time_module.perf_counter() - started) * 1000
+
+    cursor.execute("SELECT id FROM laboratories")
+    lab_ids = [row[0] for row in cursor.fetchall()]
+    date_to = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    date_from = (datetime.now() - timedelta(days=args.days)).strftime('%Y-%m-%d')
+
+    cold = measure(lambda: app.compute_occupancy(cursor, lab_ids, date_from, date_to), repeat=3)
+    app.get_occupancy(cursor, lab_ids, date_from, date_to)
+    conn.commit()
+    warm = measure(lambda: app.get_occupancy(cursor, lab_ids, date_from, date_to))
+    conn.close()
+
+    print(f"occupancy: {args.events} событий, {args.days} дн., {len(lab_ids)} лабораторий")
+    print(f"  сопоставление визитов: {pairing:8.1f} мс")
+    print(f"  расчёт без кэша:       {cold:8.1f} мс")
+    print(f"  чтение из кэша:        {warm:8.1f} мс")
+
+
+def bench_presence(args):
+    """Присутствие на момент времени: полное воспроизведение против контрольных точек"""
+    app = prepare_database(args.events, args.days)
+    conn = app.get_db_connection()
+    cursor = conn.cursor()
+    app.sync_event_views(cursor)
+    conn.commit()
+
+    rnd = random.Random(7)
+    moments = [
+        (datetime.now() - timedelta(minutes=rnd.randrange(args.days * 24 * 60))).strftime('%Y-%m-%d %H:%M:%S')
+        for _ in range(20)
+    ]
+
+    def full_replay():
+        for at in moments:
+            cursor.execute('''
+                SELECT employee_id, laboratory_id, event_type, event_time FROM access_events
+                WHERE success = TRUE AND event_type IN ('entry', 'exit') AND event_time <= ?
+                ORDER BY id
+            ''', (at,))
+            state = {}
+            for employee_id, lab_id, event_type, event_time in cursor.fetchall():
+                app.apply_presence_event(state, employee_id, lab_id, event_type, event_time)
+
+    def checkpoints():
+        for at in moments:
+            app.get_presence_at(cursor, at)
+
+    replay = measure(full_replay, repeat=1) / len(moments)
+    checkpoint = measure(checkpoints) / len(moments)
+    conn.close()
+
+    print(f"presence: {args.events} событий, {args.days} дн.")
+    print(f"  воспроизведение с начала: {replay:8.2f} мс на запрос")
+    print(f"  от контрольной точки:     {checkpoint:8.2f} мс на запрос  (x{replay / max(checkpoint, 0.001):.0f})")
+
+
+def bench_contacts(args):
+    """Контакты сотрудника за месяц: самосоединение визитов против заметания"""
+    app = prepare_database(args.events, args.days)
+    conn = app.get_db_connection()
+    cursor = conn.cursor()
+    app.sync_event_views(cursor)
+    conn.commit()
+
+    date_from = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+    date_to = datetime.now().strftime('%Y-%m-%d')
+    cursor.execute("SELECT employee_id FROM visits GROUP BY employee_id ORDER BY COUNT(*) DESC LIMIT 10")
+    employee_ids = [row[0] for row in cursor.fetchall()]
+
+    def self_join():
+        for employee_id in employee_ids:
+            cursor.execute('''
+                SELECT b.employee_id, MAX(a.entered_at, b.entered_at), MIN(a.exited_at, b.exited_at)
+                FROM visits a JOIN visits b
+                  ON b.laboratory_id = a.laboratory_id AND b.employee_id != a.employee_id
+                 AND b.entered_at < a.exited_at AND b.exited_at > a.entered_at
+                WHERE a.employee_id = ? AND a.status = 'closed' AND b.status = 'closed'
+                  AND a.entered_at BETWEEN ? AND ?
+            ''', (employee_id, date_from, app.next_day(date_to)))
+            cursor.fetchall()
+
+    def sweep():
+        for employee_id in employee_ids:
+            list(app.find_contacts(cursor, employee_id, date_from, date_to))
+
+    joined = measure(self_join, repeat=3) / len(employee_ids)
+    swept = measure(sweep, repeat=3) / len(employee_ids)
+    conn.close()
+
+    print(f"contacts: {args.events} событий, окно 30 дн.")
+    print(f"  самосоединение визитов: {joined:8.2f} мс на сотрудника")
+    print(f"  сортировка и заметание: {swept:8.2f} мс на сотрудника  (x{joined / max(swept, 0.001):.1f})")
+
+
+def bench_what_if(args):
+    """Проигрывание предлагаемого расписания по истории: NumPy и чистый Python"""
+    app = prepare_database(args.events, args.days)
+    conn = app.get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT id FROM laboratories")
+    proposals = [
+        (row[0], None, None, app.compile_proposed_windows([('0,1,2,3,4', '09:00', '17:00')]))
+        for row in cursor.fetchall()
+    ]
+    date_from = (datetime.now() - timedelta(days=args.days)).strftime('%Y-%m-%d')
+    date_to = datetime.now().strftime('%Y-%m-%d')
+
+    timings = {}
+    for engine, enabled in (('numpy', True), ('python', False)):
+        if enabled and not app.HAS_NUMPY:
+            continue
+        has_numpy, app.HAS_NUMPY = app.HAS_NUMPY, enabled
+        timings[engine] = measure(lambda: app.replay_schedule_proposal(cursor, proposals, date_from, date_to), repeat=3)
+        app.HAS_NUMPY = has_numpy
+    conn.close()
+
+    print(f"what_if: {args.events} событий, {args.days} дн., все лаборатории")
+    for engine, elapsed in timings.items():
+        print(f"  {engine + ':':8} {elapsed:8.1f} мс")
+
+
+BENCHMARKS = {
+    'statistics': bench_statistics,
+    'occupancy': bench_occupancy,
+    'presence': bench_presence,
+    'contacts': bench_contacts,
+    'what_if': bench_what_if,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замеры производительности АСКУД')
+    parser.add_argument('names', nargs='*', help='Имена замеров: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--events', type=int, default=200000, help='Количество событий доступа')
+    parser.add_argument('--days', type=int, default=365, help='Глубина истории в днях')
+    args = parser.parse_args()
+
+    for name in args.names or list(BENCHMARKS):
+        BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import copy
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Ключи сессий и PIN-кодов создаются при импорте приложения - не в домашнем каталоге
+os.environ.setdefault('ASKUD_KEY_DIR', tempfile.mkdtemp(prefix='askud-keys-'))
+os.environ.pop('ASKUD_WRITER_SOCKET', None)
+
+import app as askud  # noqa: E402
+
+# test_system.py - не модуль Python, а список команд pip install
+collect_ignore = ['test_system.py']
+
+# Кэши и реестры процесса, которые между тестами возвращаются к начальному состоянию
+PROCESS_STATE = (
+    'compiled_schedules', 'daily_schedules', 'authorisation_index', 'presence_registry', 'roll_call',
+    'overstay_timers', 'swipe_cache', 'pin_limiter', 'terminal_registry', 'terminal_stats',
+    'terminal_auth_sets', 'terminal_channels', 'terminal_snapshots', 'invalidation_listener'
+)
+INITIAL_STATE = {name: copy.deepcopy(getattr(askud, name)) for name in PROCESS_STATE}
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Новая база с демонстрационными данными в каталоге теста; соединение с ней"""
+    monkeypatch.chdir(tmp_path)
+    # Фоновые потоки процесса тестам не нужны: таймеры и шину они проверяют напрямую
+    monkeypatch.setattr(askud, 'start_overstay_monitor', lambda: None)
+    monkeypatch.setattr(askud, 'start_invalidation_listener', lambda: None)
+    for name, value in INITIAL_STATE.items():
+        state = getattr(askud, name)
+        state.clear()
+        state.update(copy.deepcopy(value))
+
+    askud.init_database()
+    conn = askud.get_db_connection()
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def admin_client(db):
+    """Клиент Flask с сессией администратора"""
+    client = askud.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+        session['user_type'] = 'admin'
+    return client
+
+
+@pytest.fixture
+def local_timezone():
+    """Местное время сервера UTC+3, чтобы тесты отличали его от UTC событий"""
+    previous = os.environ.get('TZ')
+    os.environ['TZ'] = 'MSK-3'
+    time.tzset()
+    yield
+    if previous is None:
+        os.environ.pop('TZ', None)
+    else:
+        os.environ['TZ'] = previous
+    time.tzset()
@@ -0,0 +1,199 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import app as askud
+
+EMPLOYEE_ID = 2  # демонстрационный сотрудник с PIN 1234
+LABORATORY_ID = 1
+
+
+@pytest.fixture
+def open_all_week(db):
+    """Допуск сотрудника в лабораторию круглосуточно, чтобы проход не зависел от времени запуска"""
+    askud.save_access_windows(db.cursor(), EMPLOYEE_ID, LABORATORY_ID, [('0,1,2,3,4,5,6', '00:00', '23:59')])
+    db.commit()
+    return db
+
+
+def access_events(db):
+    return [tuple(row) for row in db.execute(
+        "SELECT event_type, method FROM access_events WHERE employee_id = ? ORDER BY id", (EMPLOYEE_ID,)
+    )]
+
+
+def visits(db):
+    return [tuple(row) for row in db.execute(
+        "SELECT entered_at, exited_at, status FROM visits WHERE employee_id = ? ORDER BY entered_at, id",
+        (EMPLOYEE_ID,)
+    )]
+
+
+def utc(delta):
+    """Момент в базе времени событий (UTC) со сдвигом delta"""
+    return (datetime.now(timezone.utc).replace(tzinfo=None) + delta).replace(microsecond=0)
+
+
+def test_pin_limiter_lockout_and_expiry(db, monkeypatch):
+    monkeypatch.setitem(askud.PIN_LIMITS, 'ip', 3)
+    monkeypatch.setattr(askud, 'PIN_LOCKOUT_SECONDS', 0.2)
+
+    # Лимит - число неудач в окне, на котором ключ блокируется
+    for pin in ('a', 'b'):
+        assert not askud.pin_limiter_failure('10.0.0.1', None, pin)
+    assert askud.pin_limiter_check('10.0.0.1', None) is None
+    assert askud.pin_limiter_failure('10.0.0.1', None, 'c')
+
+    assert askud.pin_limiter_check('10.0.0.1', None) == 'locked'
+    # Другой IP без токена терминала не заблокирован
+    assert askud.pin_limiter_check('10.0.0.2', None) is None
+    # Отклонённый PIN не проверяется по базе повторно
+    assert askud.pin_limiter_check('10.0.0.2', None, 'a') == 'rejected'
+
+    time.sleep(0.25)
+    assert askud.pin_limiter_check('10.0.0.1', None) is None
+    assert askud.get_pin_limiter_metrics()['tracked_terminals'] == 0
+
+
+def test_pin_limiter_locks_registered_terminal(db, monkeypatch):
+    monkeypatch.setitem(askud.PIN_LIMITS, 'terminal', 2)
+
+    assert not askud.pin_limiter_failure('10.0.0.1', 7)
+    assert askud.pin_limiter_failure('10.0.0.2', 7)
+
+    assert askud.pin_limiter_check('10.0.0.4', 7) == 'locked'
+    assert askud.pin_limiter_check('10.0.0.4', 8) is None
+
+
+@pytest.mark.parametrize('limit', [1, 2, 5])
+def test_pin_limiter_locks_exactly_at_limit(db, monkeypatch, limit):
+    monkeypatch.setitem(askud.PIN_LIMITS, 'ip', limit)
+
+    locked = [askud.pin_limiter_failure('10.0.0.9', None) for _ in range(limit)]
+
+    assert locked == [False] * (limit - 1) + [True]
+    assert askud.pin_limiter_check('10.0.0.9', None) == 'locked'
+
+
+def test_pin_limiter_forgets_failures_outside_window(db, monkeypatch):
+    monkeypatch.setitem(askud.PIN_LIMITS, 'ip', 2)
+    monkeypatch.setattr(askud, 'PIN_LIMIT_WINDOW_SECONDS', 0.1)
+
+    assert not askud.pin_limiter_failure('10.0.0.9', None)
+    time.sleep(0.15)
+    assert not askud.pin_limiter_failure('10.0.0.9', None)
+    assert askud.pin_limiter_failure('10.0.0.9', None)
+
+
+def test_swipe_debounce_returns_first_decision(open_all_week):
+    first = askud.debounced_verify_access(EMPLOYEE_ID, LABORATORY_ID)
+    second = askud.debounced_verify_access(EMPLOYEE_ID, LABORATORY_ID)
+
+    assert first[:3] == (True, 'Вход разрешён', 'entry') and first[3] is False
+    assert second[:3] == first[:3] and second[3] is True
+    assert access_events(open_all_week) == [('entry', 'pin')]
+
+
+def test_swipe_request_id_is_idempotent(open_all_week, monkeypatch):
+    monkeypatch.setattr(askud, 'SWIPE_DEBOUNCE_SECONDS', 0)
+
+    first = askud.debounced_verify_access(EMPLOYEE_ID, LABORATORY_ID, request_id='r1')
+    repeated = askud.debounced_verify_access(EMPLOYEE_ID, LABORATORY_ID, request_id='r1')
+    second = askud.debounced_verify_access(EMPLOYEE_ID, LABORATORY_ID, request_id='r2')
+
+    assert repeated[2] == first[2] == 'entry' and repeated[3] is True
+    assert second[2] == 'exit'
+    assert access_events(open_all_week) == [('entry', 'pin'), ('exit', 'pin')]
+
+
+def test_swipes_alternate_through_writer(open_all_week):
+    actions = [
+        askud.submit_write('swipe', employee_id=EMPLOYEE_ID, laboratory_id=LABORATORY_ID, method='pin',
+                           expected_exit=None)['action']
+        for _ in range(3)
+    ]
+
+    assert actions == ['entry', 'exit', 'entry']
+    assert access_events(open_all_week) == [('entry', 'pin'), ('exit', 'pin'), ('entry', 'pin')]
+    assert [status for _, _, status in visits(open_all_week)] == ['closed', 'open']
+    assert open_all_week.execute(
+        "SELECT COUNT(*) FROM current_presence WHERE employee_id = ?", (EMPLOYEE_ID,)
+    ).fetchone()[0] == 1
+
+
+def test_writer_batch_isolates_failed_command(open_all_week):
+    conn = askud.get_db_connection()
+    try:
+        results = askud.run_write_batch(conn, [
+            ('swipe', {'employee_id': EMPLOYEE_ID, 'laboratory_id': LABORATORY_ID, 'method': 'pin', 'expected_exit': None}),
+            ('unknown', {}),
+            ('swipe', {'employee_id': EMPLOYEE_ID, 'laboratory_id': LABORATORY_ID, 'method': 'pin', 'expected_exit': None}),
+        ])
+    finally:
+        conn.close()
+
+    assert [ok for ok, _ in results] == [True, False, True]
+    assert [result['action'] for ok, result in results if ok] == ['entry', 'exit']
+    assert [status for _, _, status in visits(open_all_week)] == ['closed']
+
+
+def test_check_access_does_not_open_visit(open_all_week):
+    client = askud.app.test_client()
+    response = client.post('/api/check_access', json={'pin_code': '1234', 'laboratory_id': LABORATORY_ID})
+
+    assert response.status_code == 200
+    assert 'pin_digest' not in response.get_json()['employee']
+    assert access_events(open_all_week) == [('check', 'pin')]
+    assert visits(open_all_week) == []
+
+
+def test_offline_events_are_ordered_by_time(open_all_week):
+    # Сервер уже записал вход сейчас, терминал позже присылает более ранние события
+    askud.submit_write('swipe', employee_id=EMPLOYEE_ID, laboratory_id=LABORATORY_ID, method='pin', expected_exit=None)
+    entered = utc(timedelta(hours=-3))
+    exited = utc(timedelta(hours=-2))
+    events = [
+        {'offline_id': 'x2', 'employee_id': EMPLOYEE_ID, 'event_type': 'exit', 'event_time': exited.isoformat() + '+00:00'},
+        {'offline_id': 'x1', 'employee_id': EMPLOYEE_ID, 'event_type': 'entry', 'event_time': entered.isoformat() + '+00:00'},
+    ]
+
+    result = askud.submit_write('offline_events', laboratory_id=LABORATORY_ID, events=events)
+    assert (result['accepted'], result['duplicates'], result['rejected']) == (2, 0, 0)
+    # Последнее по времени событие - вход на сервере, присутствие не меняется
+    assert result['presence'] == []
+
+    rows = visits(open_all_week)
+    assert [status for _, _, status in rows] == ['closed', 'open']
+    assert rows[0][:2] == (str(entered), str(exited))
+
+    worked = open_all_week.execute(
+        "SELECT SUM(worked_seconds) FROM timesheet_days WHERE employee_id = ?", (EMPLOYEE_ID,)
+    ).fetchone()[0]
+    assert worked == 3600
+
+    repeated = askud.submit_write('offline_events', laboratory_id=LABORATORY_ID, events=events)
+    assert (repeated['accepted'], repeated['duplicates']) == (0, 2)
+
+
+def test_offline_exit_after_server_entry_updates_presence(open_all_week):
+    askud.submit_write('swipe', employee_id=EMPLOYEE_ID, laboratory_id=LABORATORY_ID, method='pin', expected_exit=None)
+    events = [{'offline_id': 'x1', 'employee_id': EMPLOYEE_ID, 'event_type': 'exit',
+               'event_time': utc(timedelta(seconds=30)).isoformat() + '+00:00'}]
+
+    result = askud.submit_write('offline_events', laboratory_id=LABORATORY_ID, events=events)
+
+    assert result['presence'] == [[EMPLOYEE_ID, None]]
+    assert open_all_week.execute(
+        "SELECT COUNT(*) FROM current_presence WHERE employee_id = ?", (EMPLOYEE_ID,)
+    ).fetchone()[0] == 0
+    assert [status for _, _, status in visits(open_all_week)] == ['closed']
+
+
+def test_offline_events_from_the_future_are_rejected(open_all_week):
+    events = [{'employee_id': EMPLOYEE_ID, 'event_type': 'entry',
+               'event_time': utc(timedelta(hours=2)).isoformat() + '+00:00'}]
+
+    result = askud.submit_write('offline_events', laboratory_id=LABORATORY_ID, events=events)
+
+    assert (result['accepted'], result['rejected']) == (0, 1)
@@ -0,0 +1,56 @@
+import csv
+import io
+import zipfile
+
+import pytest
+
+import app as askud
+
+
+def test_csv_import_goes_through_writer_in_chunks(admin_client, db, monkeypatch):
+    monkeypatch.setattr(askud, 'WRITER_IMPORT_CHUNK_ROWS', 2)
+    commands = []
+    submit_write = askud.submit_write
+
+    def recording_submit_write(command, **args):
+        commands.append(command)
+        return submit_write(command, **args)
+
+    monkeypatch.setattr(askud, 'submit_write', recording_submit_write)
+
+    rows = ''.join(f'imp{i},Сотрудник {i},{70000 + i}\n' for i in range(5))
+    csv_file = io.BytesIO(('login,full_name,pin_code\n' + rows + 'imp0,Повтор,71111\n').encode('utf-8'))
+    response = admin_client.post('/api/admin/import/csv', data={'csv_file': (csv_file, 'employees.csv')})
+
+    assert response.get_json()['message'] == 'Импорт завершен: 5 записей импортировано, 1 пропущено'
+    assert commands == ['import_csv'] * 3
+    assert db.execute("SELECT COUNT(*) FROM employees WHERE login LIKE 'imp%'").fetchone()[0] == 5
+
+
+def test_update_command_rejects_unknown_columns(db):
+    with pytest.raises(RuntimeError):
+        askud.submit_write('update_employee', employee_id=2, fields={'login': 'admin'})
+
+    assert db.execute("SELECT login FROM employees WHERE id = 2").fetchone()[0] != 'admin'
+
+
+def test_laboratory_with_rules_is_deactivated_not_deleted(admin_client, db):
+    response = admin_client.delete('/api/admin/laboratories/1')
+
+    assert response.get_json()['message'].startswith('Лаборатория деактивирована')
+    assert db.execute("SELECT is_active FROM laboratories WHERE id = 1").fetchone()[0] == 0
+    assert db.execute("SELECT COUNT(*) FROM cache_invalidations WHERE scope = 'laboratories'").fetchone()[0] == 1
+
+
+def test_csv_export_leaves_out_secrets_and_import_requires_pin(admin_client, db):
+    archive = zipfile.ZipFile(io.BytesIO(admin_client.get('/api/admin/export/csv').data))
+    header = next(csv.reader(io.StringIO(archive.read('employees.csv').decode('utf-8'))))
+    assert not set(header) & set(askud.EMPLOYEE_SECRET_COLUMNS)
+
+    # HMAC PIN-кода из другой установки не принимается
+    digest = askud.pin_digest('98765')
+    csv_file = io.BytesIO(f'login,full_name,pin_digest\nforeign,Чужой,{digest}\n'.encode('utf-8'))
+    response = admin_client.post('/api/admin/import/csv', data={'csv_file': (csv_file, 'employees.csv')})
+
+    assert response.get_json()['message'] == 'Импорт завершен: 0 записей импортировано, 1 пропущено'
+    assert db.execute("SELECT COUNT(*) FROM employees WHERE login = 'foreign'").fetchone()[0] == 0
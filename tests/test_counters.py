@@ -0,0 +1,40 @@
+import os
+import time
+
+import app as askud
+
+
+def daily_events(db):
+    return [tuple(row) for row in db.execute("SELECT day, events, entries FROM daily_event_counters ORDER BY day")]
+
+
+def test_daily_counters_use_local_date(db, local_timezone):
+    # 22:30 UTC 7 января - это 01:30 8 января по местному времени (UTC+3)
+    db.execute(
+        "INSERT INTO access_events (employee_id, laboratory_id, event_type, event_time, success) "
+        "VALUES (2, 1, 'entry', '2030-01-07 22:30:00', TRUE)"
+    )
+    db.commit()
+    assert daily_events(db) == [('2030-01-08', 1, 1)]
+
+    askud.reconcile_counters(db.cursor())
+    assert daily_events(db) == [('2030-01-08', 1, 1)]
+
+    db.execute("DELETE FROM access_events")
+    assert daily_events(db) == [('2030-01-08', 0, 0)]
+
+
+def test_statistics_count_events_of_local_today(db):
+    # Смещение выбирается так, чтобы местная дата сейчас отличалась от даты UTC
+    previous = os.environ.get('TZ')
+    os.environ['TZ'] = 'UTC+12' if askud.utc_now().hour < 12 else 'UTC-13'
+    time.tzset()
+    try:
+        askud.submit_write('swipe', employee_id=2, laboratory_id=1, method='pin', expected_exit=None)
+        assert askud.get_statistics()['today_events'] == 1
+    finally:
+        if previous is None:
+            os.environ.pop('TZ', None)
+        else:
+            os.environ['TZ'] = previous
+        time.tzset()
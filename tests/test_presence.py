@@ -0,0 +1,42 @@
+import app as askud
+
+EMPLOYEE_ID = 2
+LABORATORY_ID = 1
+
+
+def add_event(db, event_type, event_time):
+    db.execute(
+        "INSERT INTO access_events (employee_id, laboratory_id, event_type, event_time, success) VALUES (?, ?, ?, ?, TRUE)",
+        (EMPLOYEE_ID, LABORATORY_ID, event_type, event_time)
+    )
+    db.commit()
+
+
+def presence_at(client, at):
+    return client.get('/api/admin/presence_at', query_string={'at': at}).get_json()
+
+
+def test_presence_at_takes_local_time(admin_client, db, local_timezone):
+    # 22:30-23:30 UTC - это 01:30-02:30 следующего дня по местному времени (UTC+3)
+    add_event(db, 'entry', '2030-01-07 22:30:00')
+    add_event(db, 'exit', '2030-01-07 23:30:00')
+
+    inside = presence_at(admin_client, '2030-01-08 02:00')
+    assert inside['at'] == '2030-01-08 02:00:00'
+    assert [(item['employee_id'], item['entry_time']) for item in inside['people']] == [
+        (EMPLOYEE_ID, '2030-01-08 01:30:00')
+    ]
+
+    # То же время на часах, но по UTC сотрудник ещё не вошёл
+    assert presence_at(admin_client, '2030-01-07 23:00')['people'] == []
+    assert presence_at(admin_client, '2030-01-08 03:00')['people'] == []
+
+
+def test_presence_at_uses_checkpoint_in_utc(admin_client, db, local_timezone):
+    add_event(db, 'entry', '2030-01-07 22:30:00')
+    askud.sync_presence_checkpoints(db.cursor())
+    db.commit()
+    add_event(db, 'exit', '2030-01-07 23:30:00')
+
+    assert [item['employee_id'] for item in presence_at(admin_client, '2030-01-08 02:29')['people']] == [EMPLOYEE_ID]
+    assert presence_at(admin_client, '2030-01-08 02:31')['people'] == []
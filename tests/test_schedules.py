@@ -0,0 +1,109 @@
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+
+import app as askud
+
+MONDAY = 1 << 0
+SUNDAY = 1 << 6
+
+# Даты вне окна предрасчёта: расписание дня строится по требованию
+FUTURE_MONDAY = date(2030, 1, 7)
+FUTURE_SUNDAY = date(2030, 1, 6)
+
+
+def week_allows(rule, weekday, hour, minute):
+    """Попадает ли момент недели в скомпилированные интервалы правила"""
+    moment = weekday * askud.MINUTES_PER_DAY + hour * 60 + minute
+    starts, ends = rule[0], rule[1]
+    index = bisect_right(starts, moment) - 1
+    return index >= 0 and moment < ends[index]
+
+
+def at(day, hour, minute=0):
+    return datetime.combine(day, datetime.min.time()) + timedelta(hours=hour, minutes=minute)
+
+
+def test_window_across_midnight_belongs_to_start_day():
+    rule = askud.compile_schedule([(MONDAY, 22 * 60, 6 * 60)])
+
+    assert week_allows(rule, 0, 22, 0)
+    assert week_allows(rule, 1, 6, 0)
+    assert not week_allows(rule, 1, 6, 1)
+    assert not week_allows(rule, 0, 21, 59)
+    # Вторник в покрытых днях: окно понедельника заканчивается в нём
+    assert rule[2] == MONDAY | (1 << 1)
+
+
+def test_sunday_window_wraps_to_monday():
+    rule = askud.compile_schedule([(SUNDAY, 22 * 60, 2 * 60)])
+
+    assert list(rule[0]) == [0, 6 * askud.MINUTES_PER_DAY + 22 * 60]
+    assert list(rule[1]) == [2 * 60 + 1, askud.MINUTES_PER_WEEK]
+    assert week_allows(rule, 6, 23, 59)
+    assert week_allows(rule, 0, 1, 30)
+    assert not week_allows(rule, 0, 2, 1)
+    assert rule[2] == SUNDAY | MONDAY
+
+
+def test_overlapping_windows_are_merged():
+    rule = askud.compile_schedule([(MONDAY, 8 * 60, 12 * 60), (MONDAY, 11 * 60, 18 * 60)])
+
+    assert list(rule[0]) == [8 * 60]
+    assert list(rule[1]) == [18 * 60 + 1]
+
+
+def test_check_schedule_sunday_night_expected_exit_on_monday(db):
+    assert FUTURE_SUNDAY.weekday() == 6
+    cursor = db.cursor()
+    askud.save_access_windows(cursor, 2, 1, [('6', '22:00', '02:00')])
+    db.commit()
+
+    reason, expected_exit = askud.check_schedule(cursor, 2, 1, at(FUTURE_SUNDAY, 23, 15))
+    assert reason is None
+    assert expected_exit == at(FUTURE_MONDAY, 2, 0)
+
+    reason, _ = askud.check_schedule(cursor, 2, 1, at(FUTURE_MONDAY, 1, 0))
+    assert reason is None
+
+    reason, expected_exit = askud.check_schedule(cursor, 2, 1, at(FUTURE_MONDAY, 3, 0))
+    assert reason == 'Вне времени доступа'
+    assert expected_exit is None
+
+
+def test_check_schedule_day_not_allowed(db):
+    cursor = db.cursor()
+    # Демонстрационное правило сотрудника 2: лаборатория 1, пн-пт 08:00-20:00
+    reason, _ = askud.check_schedule(cursor, 2, 1, at(FUTURE_SUNDAY, 12))
+    assert reason == 'День недели не разрешен'
+
+    reason, _ = askud.check_schedule(cursor, 2, 2, at(FUTURE_MONDAY, 12))
+    assert reason == 'Нет расписания доступа'
+
+
+def test_check_schedule_with_exceptions(db):
+    cursor = db.cursor()
+    day = FUTURE_MONDAY.strftime('%Y-%m-%d')
+    saturday = (FUTURE_MONDAY + timedelta(days=5)).strftime('%Y-%m-%d')
+    cursor.execute('''
+        INSERT INTO access_exceptions (kind, date_from, date_to, laboratory_id, time_start, time_end)
+        VALUES ('closed', ?, ?, 1, '12:00', '12:59')
+    ''', (day, day))
+    cursor.execute('''
+        INSERT INTO access_exceptions (kind, date_from, date_to, employee_id, laboratory_id, time_start, time_end)
+        VALUES ('open', ?, ?, 2, 1, '10:00', '11:59')
+    ''', (saturday, saturday))
+    db.commit()
+
+    assert askud.check_schedule(cursor, 2, 1, at(FUTURE_MONDAY, 11, 59))[0] is None
+    assert askud.check_schedule(cursor, 2, 1, at(FUTURE_MONDAY, 12, 30))[0] == askud.EXCEPTION_CLOSED_REASON
+
+    reason, expected_exit = askud.check_schedule(cursor, 2, 1, at(FUTURE_MONDAY, 13, 0))
+    assert reason is None
+    assert expected_exit == at(FUTURE_MONDAY, 20, 0)
+
+    # Разовый допуск в субботу, когда правило не действует
+    saturday_date = FUTURE_MONDAY + timedelta(days=5)
+    assert askud.check_schedule(cursor, 2, 1, at(saturday_date, 10, 30))[0] is None
+    assert askud.check_schedule(cursor, 2, 1, at(saturday_date, 12, 30))[0] == 'День недели не разрешен'
+    # Исключение другого сотрудника не действует
+    assert askud.check_schedule(cursor, 3, 1, at(saturday_date, 10, 30))[0] == 'Нет расписания доступа'
@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+
+import app as askud
+
+SLOT = askud.OCCUPANCY_SLOT_MINUTES * 60
+DAY = 24 * 60 * 60
+BASE = datetime(2030, 1, 7)
+
+
+def visit(visit_id, employee_id, start_minutes, end_minutes, laboratory_id=1):
+    """Интервал визита: id, сотрудник, лаборатория, начало, конец"""
+    return (visit_id, employee_id, laboratory_id,
+            BASE + timedelta(minutes=start_minutes), BASE + timedelta(minutes=end_minutes))
+
+
+def test_sweep_overlaps_reports_overlap_bounds():
+    target = visit(1, 1, 60, 180)
+    other = visit(2, 2, 120, 240)
+
+    [(found_target, found_other, start, end)] = list(askud.sweep_overlaps([target], [other]))
+    assert (found_target, found_other) == (target, other)
+    assert start == BASE + timedelta(minutes=120)
+    assert end == BASE + timedelta(minutes=180)
+
+
+def test_sweep_overlaps_touching_intervals_do_not_overlap():
+    target = visit(1, 1, 60, 120)
+    before = visit(2, 2, 0, 60)
+    after = visit(3, 3, 120, 180)
+
+    assert list(askud.sweep_overlaps([target], [before, after])) == []
+
+
+def test_sweep_overlaps_nested_and_same_start():
+    target = visit(1, 1, 0, 300)
+    inner = visit(2, 2, 100, 200)
+    same_start = visit(3, 3, 0, 50)
+
+    overlaps = {other[0]: (start, end) for _, other, start, end in askud.sweep_overlaps([target], [inner, same_start])}
+    assert overlaps == {
+        2: (BASE + timedelta(minutes=100), BASE + timedelta(minutes=200)),
+        3: (BASE, BASE + timedelta(minutes=50)),
+    }
+
+
+def test_sweep_occupancy_exit_before_entry_at_same_moment():
+    # Один вышел в тот же момент, когда другой вошёл: одновременно внутри один человек
+    peak, average = askud.sweep_occupancy([(0, SLOT), (SLOT, 2 * SLOT)], 1)
+
+    assert peak[:3] == [1, 1, 0]
+    assert average[:3] == [1.0, 1.0, 0]
+
+
+def test_sweep_occupancy_partial_slot_average():
+    peak, average = askud.sweep_occupancy([(SLOT // 2, SLOT), (0, 2 * SLOT)], 1)
+
+    assert peak[:2] == [2, 1]
+    assert average[:2] == [1.5, 1.0]
+
+
+def test_sweep_occupancy_clips_to_range():
+    days = 2
+    # Визит начался до диапазона и закончился после него
+    peak, average = askud.sweep_occupancy([(-DAY, 3 * DAY)], days)
+
+    assert len(peak) == days * askud.OCCUPANCY_SLOTS_PER_DAY
+    assert set(peak) == {1}
+    assert set(average) == {1.0}
+
+    # Визиты целиком вне диапазона не учитываются
+    peak, _ = askud.sweep_occupancy([(-2 * SLOT, -SLOT), (days * DAY, days * DAY + SLOT)], days)
+    assert set(peak) == {0}
+
+
+def test_sweep_occupancy_last_slot():
+    days = 1
+    last = days * askud.OCCUPANCY_SLOTS_PER_DAY - 1
+    peak, average = askud.sweep_occupancy([(last * SLOT, days * DAY)], days)
+
+    assert peak[last] == 1
+    assert average[last] == 1.0
+    assert peak[last - 1] == 0
+
+
+def test_occupancy_slots_are_local(admin_client, db, local_timezone):
+    # Визит 22:30-23:30 UTC - это 01:30-02:30 8 января по местному времени (UTC+3)
+    for event_type, event_time in (('entry', '2030-01-07 22:30:00'), ('exit', '2030-01-07 23:30:00')):
+        db.execute(
+            "INSERT INTO access_events (employee_id, laboratory_id, event_type, event_time, success) VALUES (2, 1, ?, ?, TRUE)",
+            (event_type, event_time)
+        )
+    askud.sync_event_views(db.cursor())
+    db.commit()
+
+    response = admin_client.get('/api/admin/statistics/occupancy', query_string={
+        'date_from': '2030-01-07', 'date_to': '2030-01-08', 'laboratory_id': 1
+    })
+    [laboratory] = response.get_json()['laboratories']
+    first_day, second_day = laboratory['days']
+
+    assert first_day['max_peak'] == 0
+    busy = [slot for slot, value in enumerate(second_day['peak']) if value]
+    assert busy == list(range(6, 10))
+    assert laboratory['peak_slot'] == '01:30'
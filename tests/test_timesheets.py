@@ -0,0 +1,45 @@
+import app as askud
+
+EMPLOYEE_ID = 2
+LABORATORY_ID = 1
+
+
+def add_event(db, event_type, event_time):
+    db.execute(
+        "INSERT INTO access_events (employee_id, laboratory_id, event_type, event_time, success) VALUES (?, ?, ?, ?, TRUE)",
+        (EMPLOYEE_ID, LABORATORY_ID, event_type, event_time)
+    )
+    db.commit()
+
+
+def timesheet(db):
+    return [tuple(row) for row in db.execute(
+        "SELECT day, worked_seconds, visits FROM timesheet_days WHERE employee_id = ? ORDER BY day", (EMPLOYEE_ID,)
+    )]
+
+
+def test_visit_is_split_at_local_midnight(local_timezone):
+    # 20:00-22:00 UTC - это 23:00-01:00 по местному времени (UTC+3)
+    parts = askud.split_visit_by_days(askud.parse_event_time('2030-01-07 20:00:00'),
+                                      askud.parse_event_time('2030-01-07 22:00:00'))
+    assert parts == [('2030-01-07', 3600), ('2030-01-08', 3600)]
+
+    # По UTC визит проходит через полночь, по местному времени целиком во вторых сутках
+    parts = askud.split_visit_by_days(askud.parse_event_time('2030-01-07 23:30:00'),
+                                      askud.parse_event_time('2030-01-08 00:30:00'))
+    assert parts == [('2030-01-08', 3600)]
+
+
+def test_timesheet_days_are_local(db, local_timezone):
+    add_event(db, 'entry', '2030-01-07 22:30:00')
+    add_event(db, 'exit', '2030-01-07 23:30:00')
+    cursor = db.cursor()
+    askud.sync_event_views(cursor)
+    db.commit()
+
+    assert timesheet(db) == [('2030-01-08', 3600, 1)]
+
+    # Пересчёт после поздних событий сохраняет местные дни
+    askud.reprocess_late_events(cursor, [EMPLOYEE_ID], '2030-01-07 22:30:00')
+    db.commit()
+    assert timesheet(db) == [('2030-01-08', 3600, 1)]